@@ -1,16 +1,38 @@
 # app.py - Complete Flask Backend for Bingo Game
 # Customized for Telegram Bot & Render Deployment
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime
 import sqlite3
 import os
 import random
 import json
+import hmac
+import logging
+import io
+import threading
+import time
 from pathlib import Path
 from telegram import Update
-from telegram_bot import build_bot   # use your filename
+from telegram_bot import build_bot, TOKEN   # use your filename
+from rate_limit import RateLimiter
+from auth import InitDataVerifier
+from identity import UserIdCache
+from assets import AssetBundle
+from compression import compress_response
+from lifecycle import GameSweeper, create_archive_tables
+from rooms import FORWARDED_KEY, TELEGRAM_ID_KEY, RoomRouter, RoomStore
+from referrals import ReferralPayer, attribute_referral, create_referral_tables, make_referral_code
+from importer import import_users, read_rows
+from settlement import SettlementEngine, create_settlement_tables
+from cards import accepts_compact_cards, card_payload, decode_card, encode_card, generate_card, is_bingo, marked_mask
+from matchmaking import Matchmaker, create_matchmaking_tables
+import dashboard
+from logs import bind_request_id, configure_logging, logging_stats, slow_queries, tag_update
+from idempotency import IdempotencyStore, fingerprint
+from resilience import GuardedConnection, LoadShedder, StaleCache, breaker, db_fault_var, faults
 
 telegram_app = build_bot()
 
@@ -27,20 +49,72 @@ app = Flask(
 
 CORS(app)
 
+# ===================== LOGGING =====================
+
+# JSON lines on stdout, written by a background thread
+configure_logging(os.environ.get('LOG_LEVEL', 'INFO'))
+slow_queries.threshold_ms = float(os.environ.get('SLOW_QUERY_MS', 100))
+slow_queries.sample_rate = float(os.environ.get('SLOW_QUERY_SAMPLE', 1.0))
+
+access_log = logging.getLogger('bingo.access')
+
+@app.before_request
+def start_request_trace():
+    """Adopt the caller's X-Request-ID or start a new one"""
+    g.request_id = bind_request_id(request.headers.get('X-Request-ID'))
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def finish_request_trace(response):
+    """Echo the request ID and write one access log line"""
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - g.get('request_started', time.perf_counter())) * 1000, 2),
+        'telegram_id': g.get('telegram_id'),
+    }
+    if response.status_code >= 500:
+        # Handlers turn exceptions into {'message': str(e)} bodies; 503s are deliberate degradation
+        body = None if response.is_streamed or response.content_encoding else response.get_json(silent=True)
+        level = logging.WARNING if response.status_code == 503 else logging.ERROR
+        access_log.log(level, 'request failed', extra={**fields, 'error': (body or {}).get('message')})
+    else:
+        access_log.info('request', extra=fields)
+    return response
+
 # Database setup
-DB_PATH = os.path.join(os.path.dirname(__file__), 'bingo.db')
+DB_PATH = os.environ.get('DB_PATH', os.path.join(os.path.dirname(__file__), 'bingo.db'))
+
+# Bounded wait for SQLite's write lock; the default would hold a worker for 5s
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 2.0))
 
 def get_db():
     """Get database connection"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, factory=GuardedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
+def add_column_if_missing(cursor, table, column, definition):
+    """Add a column to a table created by an older version of init_db"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in {row['name'] for row in cursor.fetchall()}:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return True
+    return False
+
 def init_db():
     """Initialize database with tables"""
     conn = get_db()
     cursor = conn.cursor()
     
+    # Lets the sweeper hand freed pages back to the OS a little at a time. This
+    # only takes effect on a new database; convert an existing one offline with
+    # `python lifecycle.py vacuum`.
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
     # Users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -54,9 +128,13 @@ def init_db():
             bonus_balance REAL DEFAULT 0.0,
             profile_pic TEXT,
             referral_code TEXT UNIQUE,
+            referred_by INTEGER,
+            referral_count INTEGER DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    add_column_if_missing(cursor, 'users', 'referred_by', 'INTEGER')
+    add_column_if_missing(cursor, 'users', 'referral_count', 'INTEGER DEFAULT 0')
     
     # Games table
     cursor.execute('''
@@ -70,10 +148,17 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             ended_at TIMESTAMP,
             winner_id INTEGER,
+            version INTEGER DEFAULT 0,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     ''')
     
+    add_column_if_missing(cursor, 'games', 'version', 'INTEGER DEFAULT 0')
+    # Last card selection, call or mark; the sweeper expires games idle since then
+    add_column_if_missing(cursor, 'games', 'last_active_at', 'TIMESTAMP')
+    # Sum of the stakes in a shared room; NULL for single-player games
+    add_column_if_missing(cursor, 'games', 'total_stake', 'REAL')
+    
     # Cards table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS cards (
@@ -82,9 +167,13 @@ def init_db():
             card_number INTEGER,
             card_data TEXT,
             marked_numbers TEXT,
+            marks_version INTEGER DEFAULT 0,
             FOREIGN KEY (game_id) REFERENCES games(id)
         )
     ''')
+    add_column_if_missing(cursor, 'cards', 'marks_version', 'INTEGER DEFAULT 0')
+    # Buyer of the card in shared rooms; NULL for cards of single-player games
+    add_column_if_missing(cursor, 'cards', 'user_id', 'INTEGER')
     
     # Transactions table
     cursor.execute('''
@@ -106,10 +195,93 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             game_id INTEGER NOT NULL,
             number INTEGER NOT NULL,
+            seq INTEGER,
             called_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (game_id) REFERENCES games(id)
         )
     ''')
+    if add_column_if_missing(cursor, 'called_numbers', 'seq', 'INTEGER'):
+        # Number existing calls 1, 2, 3... within each game
+        cursor.execute('''
+            UPDATE called_numbers SET seq = (
+                SELECT COUNT(*) FROM called_numbers c
+                WHERE c.game_id = called_numbers.game_id AND c.id <= called_numbers.id
+            )
+        ''')
+    
+    # User Stats table (maintained incrementally by game routes)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'")
+    backfill_stats = cursor.fetchone() is None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            games_played INTEGER DEFAULT 0,
+            games_won INTEGER DEFAULT 0,
+            total_staked REAL DEFAULT 0.0,
+            total_winnings REAL DEFAULT 0.0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    
+    if backfill_stats:
+        cursor.execute('''
+            INSERT INTO user_stats (user_id, games_played, games_won, total_staked, total_winnings)
+            SELECT user_id,
+                   COUNT(*),
+                   SUM(winner_id = user_id),
+                   SUM(stake_amount),
+                   SUM(CASE WHEN winner_id = user_id THEN stake_amount * 2 ELSE 0 END)
+            FROM games
+            GROUP BY user_id
+        ''')
+    
+    # Indexes
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_id_id
+        ON transactions (user_id, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_games_user_id_created_at
+        ON games (user_id, created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cards_game_id
+        ON cards (game_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cards_user_id_game_id
+        ON cards (user_id, game_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_called_numbers_game_id_seq
+        ON called_numbers (game_id, seq)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_games_status_created_at
+        ON games (status, created_at)
+    ''')
+    
+    # Cold storage for finished games
+    create_archive_tables(cursor)
+    add_column_if_missing(cursor, 'games_archive', 'total_stake', 'REAL')
+    add_column_if_missing(cursor, 'cards_archive', 'user_id', 'INTEGER')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cards_archive_user_id_game_id
+        ON cards_archive (user_id, game_id)
+    ''')
+    
+    # Pending stakes of shared rooms
+    create_matchmaking_tables(cursor)
+    
+    # Referral bonus ledger
+    create_referral_tables(cursor)
+    
+    # Game settlements and per-card payouts
+    create_settlement_tables(cursor)
+    
+    # Admin dashboard aggregates
+    dashboard.create_dashboard_tables(cursor)
     
     conn.commit()
     conn.close()
@@ -117,15 +289,397 @@ def init_db():
 # Initialize database on startup
 init_db()
 
+# telegram_id -> user_id, shared by every route that acts on a user
+user_ids = UserIdCache()
+
+# Expire idle games and archive finished ones in the background
+game_sweeper = GameSweeper(
+    get_db,
+    idle_timeout=int(os.environ.get('GAME_IDLE_TIMEOUT', 1800)),
+    archive_after=int(os.environ.get('GAME_ARCHIVE_AFTER', 86400)),
+    interval=int(os.environ.get('GAME_SWEEP_INTERVAL', 60))
+)
+if os.environ.get('ENABLE_GAME_SWEEPER', '1') == '1':
+    game_sweeper.start()
+
+# Referral bonuses are queued at registration and credited in batches
+REFERRAL_BONUS = float(os.environ.get('REFERRAL_BONUS', 5.0))
+BOT_USERNAME = os.environ.get('BOT_USERNAME', 'YOUR_BOT_NAME')
+
+referral_payer = ReferralPayer(get_db, interval=int(os.environ.get('REFERRAL_PAYOUT_INTERVAL', 300)))
+if os.environ.get('ENABLE_REFERRAL_PAYER', '1') == '1':
+    referral_payer.start()
+
+# Shared rooms per stake tier, started at MATCH_ROOM_SIZE cards or after MATCH_MAX_WAIT seconds;
+# a number is called every MATCH_CALL_INTERVAL seconds once a room is in play
+matchmaker = Matchmaker(
+    get_db,
+    tiers=[int(stake) for stake in os.environ.get('MATCH_STAKE_TIERS', '10,20,25,30,50').split(',')],
+    room_size=int(os.environ.get('MATCH_ROOM_SIZE', 100)),
+    max_wait=float(os.environ.get('MATCH_MAX_WAIT', 30)),
+    call_interval=int(os.environ.get('MATCH_CALL_INTERVAL', 3)),
+    abandon_after=int(os.environ.get('MATCH_ABANDON_AFTER', 600))
+)
+if os.environ.get('ENABLE_MATCHMAKER', '1') == '1':
+    matchmaker.start()
+
+# Pot is stake * PAYOUT_MULTIPLIER (the stakes paid in, for shared rooms), less HOUSE_CUT
+# (a fraction), split between winning cards
+settlement_engine = SettlementEngine(
+    house_cut=float(os.environ.get('HOUSE_CUT', 0.0)),
+    pot_multiplier=float(os.environ.get('PAYOUT_MULTIPLIER', 2.0))
+)
+
+# ===================== RATE LIMITING =====================
+
+rate_limiter = RateLimiter()
+
+# Proxies in front of the app (Render runs one). Each appends the address it
+# saw to X-Forwarded-For, so only that many entries from the right are real;
+# anything further left was sent by the client. Set 0 when clients connect directly.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=0)
+
+def client_ip():
+    """Client address, as seen by the outermost trusted proxy"""
+    return request.remote_addr
+
+# JSON body fields that name the user a request acts as
+IDENTITY_FIELDS = ('telegram_id', 'from_telegram_id')
+
+def claimed_telegram_ids():
+    """Every telegram_id the client claims to act as, from the URL and JSON body"""
+    claimed = []
+    telegram_id = (request.view_args or {}).get('telegram_id')
+    if telegram_id is not None:
+        claimed.append(telegram_id)
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict):
+        claimed += [data[field] for field in IDENTITY_FIELDS if data.get(field) is not None]
+    return claimed
+
+def claimed_telegram_id():
+    """telegram_id the client claims to act as, from the URL or JSON body"""
+    claimed = claimed_telegram_ids()
+    return claimed[0] if claimed else None
+
+def throttled():
+    """Whether throttle hooks limit this request here"""
+    if request.endpoint not in rate_limiter.limits or request.environ.get(FORWARDED_KEY):
+        return False
+    # Keyed writes are limited by replay_idempotent on the worker holding the
+    # key, so retries are not
+    return not (request.endpoint in IDEMPOTENT_ENDPOINTS and request.headers.get('Idempotency-Key'))
+
+@app.before_request
+def throttle():
+    """Reject over-limit clients by IP before any auth or database work is done"""
+    return over_limit(('ip', client_ip())) if throttled() else None
+
+def over_limit(*keys):
+    """429 response if any of the given buckets for the endpoint is empty, else None"""
+    retry_after = rate_limiter.check(request.endpoint, list(keys))
+    if retry_after:
+        response = jsonify({'status': 'error', 'message': 'Too many requests'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    return None
+
+# ===================== AUTHENTICATION =====================
+
+# Set REQUIRE_TELEGRAM_AUTH=0 for local development without a bot token
+REQUIRE_TELEGRAM_AUTH = os.environ.get('REQUIRE_TELEGRAM_AUTH', '1') == '1'
+PUBLIC_ENDPOINTS = {
+    'test', 'get_leaderboard',
+    'get_rate_limit_metrics', 'get_auth_metrics', 'get_identity_metrics',
+    'get_lifecycle_metrics', 'get_room_metrics', 'get_referral_metrics',
+    'get_settlement_metrics', 'get_logging_metrics', 'get_resilience_metrics',
+    'get_matchmaking_metrics', 'get_idempotency_metrics'
+}
+
+# Admin routes use a shared operator token instead of Telegram initData
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+init_data_verifier = InitDataVerifier(
+    TOKEN,
+    max_age=int(os.environ.get('INIT_DATA_MAX_AGE', 86400))
+)
+
+@app.before_request
+def authenticate():
+    """Verify Telegram initData and reject requests acting as another user"""
+    if not request.path.startswith('/api/') or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    if request.path.startswith('/api/admin/'):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({'status': 'error', 'message': 'Admin token required'}), 403
+        return None
+    if request.environ.get(FORWARDED_KEY):
+        # Already verified by the worker that forwarded it
+        g.telegram_id = request.environ.get(TELEGRAM_ID_KEY)
+        return None
+    claimed = {str(telegram_id) for telegram_id in claimed_telegram_ids()}
+    if not REQUIRE_TELEGRAM_AUTH:
+        if len(claimed) > 1:
+            return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+        g.telegram_id = claimed_telegram_id()
+        return None
+    
+    telegram_id = init_data_verifier.verify(request.headers.get('X-Telegram-Init-Data'))
+    if telegram_id is None:
+        return jsonify({'status': 'error', 'message': 'Invalid or missing Telegram init data'}), 401
+    
+    # Every identity in the URL and body must be the verified one
+    if claimed - {str(telegram_id)}:
+        return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+    
+    g.telegram_id = telegram_id
+    return None
+
+@app.before_request
+def throttle_user():
+    """Per-user limit, keyed on the telegram_id authenticate() verified"""
+    telegram_id = g.get('telegram_id')
+    if telegram_id is None or not throttled():
+        return None
+    return over_limit(('tg', str(telegram_id)))
+
+# ===================== ROOM ROUTING =====================
+
+# Game routes are served by the worker that owns the game on the hash ring
+ROOM_ENDPOINTS = {'get_game', 'get_game_delta', 'select_cards', 'call_number', 'mark_number', 'check_bingo'}
+
+# Each stake tier's open room lives on the worker that owns the tier
+MATCHMAKING_ENDPOINTS = {'join_room', 'get_room_ticket'}
+
+# Longest a delta or ticket request may long-poll; a forward must outlast it.
+# Threaded routes hold a worker thread while they wait, so they stop at
+# SYNC_LONG_POLL_MAX; only the async routes in asgi.py wait the full time.
+DELTA_WAIT_MAX = 25  # seconds
+SYNC_LONG_POLL_MAX = float(os.environ.get('SYNC_LONG_POLL_MAX', 5))
+
+room_store = RoomStore(ttl=int(os.environ.get('ROOM_STATE_TTL', 30)))
+room_router = RoomRouter(
+    app,
+    os.environ.get('ROOM_SOCKET_DIR', '/tmp/bingo-rooms'),
+    timeout=float(os.environ.get('ROOM_FORWARD_TIMEOUT', DELTA_WAIT_MAX + 5))
+)
+if os.environ.get('ENABLE_ROOM_SHARDING', '1') == '1':
+    room_router.start()
+
+@app.before_request
+def route_to_room_owner():
+    """Forward game, matchmaking and keyed write requests to the owning worker; handle locally if we own it"""
+    if request.environ.get(FORWARDED_KEY):
+        return None
+    if request.endpoint in ROOM_ENDPOINTS:
+        key = request.view_args['game_id']
+    elif request.endpoint in MATCHMAKING_ENDPOINTS:
+        key = f"tier-{request.view_args['stake']}"
+    elif request.endpoint in IDEMPOTENT_ENDPOINTS and request.headers.get('Idempotency-Key'):
+        # Retries must reach the worker holding the first attempt's response
+        key = f"idem-{g.get('telegram_id')}:{request.headers['Idempotency-Key']}"
+    else:
+        return None
+    return room_router.forward(key, request, g.get('telegram_id'))
+
+# ===================== HTTP CACHING =====================
+
+# Distinguishes in-memory version counters of this worker from other workers'
+WORKER_ID = f'{os.getpid()}-{int(time.time())}'
+
+def with_etag(response, etag):
+    """Attach a version-based ETag; clients must revalidate before reuse"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def not_modified(etag):
+    """Empty 304 for a resource the client already has"""
+    return with_etag(Response(status=304), etag)
+
+def compact_cards_requested():
+    """True if the client asked for v2 (compact) cards in its Accept header"""
+    return accepts_compact_cards(request.headers.get('Accept'))
+
+@app.after_request
+def compress(response):
+    """gzip/brotli JSON bodies above the size threshold"""
+    return compress_response(response, request.headers.get('Accept-Encoding'))
+
+# ===================== IDEMPOTENCY =====================
+
+# Retries of these writes with the same Idempotency-Key replay the first response
+IDEMPOTENT_ENDPOINTS = {'create_game', 'select_cards', 'join_room', 'deposit', 'withdraw', 'transfer'}
+IDEMPOTENCY_KEY_MAX = 255
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 10))  # seconds a duplicate waits for the first
+
+idempotency_store = IdempotencyStore(
+    ttl=int(os.environ.get('IDEMPOTENCY_TTL', 86400)),
+    max_entries=int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 50000))
+)
+
+@app.before_request
+def replay_idempotent():
+    """Replay the stored response for a retried write, or claim its key"""
+    key = request.headers.get('Idempotency-Key')
+    if request.endpoint not in IDEMPOTENT_ENDPOINTS or not key:
+        return None
+    if len(key) > IDEMPOTENCY_KEY_MAX:
+        return jsonify({'status': 'error', 'message': 'Idempotency-Key is too long'}), 400
+    
+    # Keys are only unique per user
+    scoped_key = f"{g.get('telegram_id')}:{key}"
+    verdict, stored = idempotency_store.begin(
+        scoped_key, fingerprint(request.method, request.path, request.get_data()), IDEMPOTENCY_WAIT
+    )
+    if verdict == 'execute':
+        # Only the first attempt counts against the rate limit; retries replay
+        limited = None
+        if request.endpoint in rate_limiter.limits:
+            limited = over_limit(('ip', client_ip()), ('tg', str(g.get('telegram_id'))))
+        if limited is not None:
+            idempotency_store.abandon(scoped_key)
+            return limited
+        g.idempotency_key = scoped_key
+        return None
+    if verdict == 'replay':
+        status, headers, body = stored
+        response = Response(body, status=status, headers=headers)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    if verdict == 'conflict':
+        return jsonify({'status': 'error', 'message': 'Idempotency-Key was already used for a different request'}), 422
+    response = jsonify({'status': 'error', 'message': 'A request with this Idempotency-Key is still in progress'})
+    response.status_code = 409
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.after_request
+def remember_idempotent(response):
+    """Store the outcome of a claimed write; server errors leave the key free to retry"""
+    key = g.pop('idempotency_key', None)
+    if key is None:
+        return response
+    if response.status_code >= 500 or response.is_streamed:
+        idempotency_store.abandon(key)
+    else:
+        idempotency_store.complete(key, response.status_code, response.headers.items(), response.get_data())
+    return response
+
+@app.teardown_request
+def release_idempotency_key(error=None):
+    key = g.pop('idempotency_key', None)
+    if key is not None:
+        idempotency_store.abandon(key)
+
+# ===================== RESILIENCE =====================
+
+# Reads answered from memory while the circuit breaker is open
+STALE_READ_ENDPOINTS = {'get_balance', 'get_leaderboard', 'get_game'}
+
+breaker.failure_threshold = int(os.environ.get('DB_BREAKER_FAILURES', 5))
+breaker.reset_timeout = float(os.environ.get('DB_BREAKER_RESET', 10))
+breaker.slow_ms = float(os.environ.get('DB_BREAKER_SLOW_MS', 1000))
+
+# Fault injection for staging: DB_FAULT_DELAY_MS slows every statement,
+# DB_FAULT_LOCK_RATE fails that fraction of them with "database is locked"
+faults.delay_ms = float(os.environ.get('DB_FAULT_DELAY_MS', 0))
+faults.lock_rate = float(os.environ.get('DB_FAULT_LOCK_RATE', 0))
+
+load_shedder = LoadShedder(int(os.environ.get('MAX_IN_FLIGHT', 64)))
+stale_reads = StaleCache()
+
+def stale_key():
+    """Stale copies are kept per URL and card format"""
+    return request.full_path + ('#v2' if compact_cards_requested() else '')
+
+def unavailable(message, retry_after):
+    response = jsonify({'status': 'error', 'message': message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.before_request
+def protect_database():
+    """Shed load over MAX_IN_FLIGHT and fail fast while the breaker is open"""
+    db_fault_var.set(False)
+    if not request.path.startswith('/api/') or request.path.startswith('/api/metrics/'):
+        return None
+    if not load_shedder.enter():
+        return unavailable('Server busy, try again shortly', 1)
+    g.load_slot = True
+    
+    verdict = breaker.allow()
+    if verdict:
+        g.db_probe = verdict == 'probe'
+        return None
+    
+    if request.method == 'GET' and request.endpoint in STALE_READ_ENDPOINTS:
+        entry = stale_reads.get(stale_key())
+        if entry:
+            body, mimetype, stored_at = entry
+            response = Response(body, mimetype=mimetype)
+            response.headers['Age'] = str(int(time.time() - stored_at))
+            response.headers['Warning'] = '110 - "Response is Stale"'
+            return response
+    return unavailable('Database unavailable, try again shortly', int(breaker.reset_timeout))
+
+@app.after_request
+def remember_reads(response):
+    """Keep the last good copy of cacheable reads; report lock timeouts as 503
+
+    Bodies forwarded from a room owner arrive already compressed; the stale
+    copy is served without headers, so only unencoded bodies are kept.
+    """
+    if (request.method == 'GET' and request.endpoint in STALE_READ_ENDPOINTS
+            and response.status_code == 200 and not response.is_streamed
+            and 'Warning' not in response.headers and 'Content-Encoding' not in response.headers):
+        stale_reads.put(stale_key(), response.get_data(), response.mimetype)
+    elif response.status_code == 500 and db_fault_var.get():
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+    return response
+
+@app.teardown_request
+def release_load_slot(error=None):
+    if g.get('load_slot'):
+        load_shedder.leave()
+    if g.get('db_probe'):
+        breaker.release_probe()
+
 # ===================== FRONTEND ROUTES =====================
 FRONTEND_DIR = os.path.join(BASE_DIR, "..", "frontend")
 
+# Minified, fingerprinted and precompressed once per worker
+asset_bundle = AssetBundle(FRONTEND_DIR)
+
+def serve_asset(asset):
+    """Serve a prebuilt asset from memory, honouring If-None-Match"""
+    headers = {
+        'ETag': f'"{asset.etag}"',
+        'Cache-Control': asset.cache_control,
+        'Vary': 'Accept-Encoding'
+    }
+    if asset.etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    
+    encoding, body = asset.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(body, mimetype=asset.mimetype, headers=headers)
+
 @app.route("/")
 def index():
-    return send_from_directory(FRONTEND_DIR, "index.html")
+    return serve_asset(asset_bundle.get("index.html"))
 
 @app.route("/<path:path>")
 def static_files(path):
+    asset = asset_bundle.get(path)
+    if asset is not None:
+        return serve_asset(asset)
     return send_from_directory(FRONTEND_DIR, path)
 
 
@@ -147,6 +701,7 @@ def telegram_webhook():
         request.get_json(force=True),
         telegram_app.bot
     )
+    tag_update(update.update_id)
     telegram_app.update_queue.put(update)
     return "OK"
 
@@ -161,6 +716,7 @@ def register_user():
         username = data.get('username')
         phone = data.get('phone')
         name = data.get('name', username)
+        referred_with = data.get('referral_code')
         
         if not all([telegram_id, username, phone]):
             return jsonify({'status': 'error', 'message': 'Missing required fields'}), 400
@@ -168,24 +724,36 @@ def register_user():
         conn = get_db()
         cursor = conn.cursor()
         
-        # Check if user already exists
-        cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
+        # Transfers find their recipient by phone, so it must name one account
+        cursor.execute('SELECT 1 FROM users WHERE phone = ? AND telegram_id != ?', (phone, telegram_id))
         if cursor.fetchone():
             conn.close()
-            return jsonify({'status': 'error', 'message': 'User already registered'}), 400
+            return jsonify({'status': 'error', 'message': 'Phone number is already registered'}), 409
         
-        # Create referral code
-        referral_code = f"ref_{telegram_id}_{random.randint(1000, 9999)}"
+        # Insert user with welcome bonus; an existing user is a no-op
+        referral_code = make_referral_code(telegram_id)
+        try:
+            cursor.execute('''
+                INSERT INTO users (telegram_id, username, phone, name, referral_code, balance)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(telegram_id) DO NOTHING
+            ''', (telegram_id, username, phone, name, referral_code, 10.0))
+        except sqlite3.IntegrityError:
+            # Another user already has this username
+            conn.rollback()
+            conn.close()
+            return jsonify({'status': 'error', 'message': 'Username is already taken'}), 409
+        if cursor.rowcount == 0:
+            conn.close()
+            return jsonify({'status': 'error', 'message': 'User already registered'}), 400
+        user_id = cursor.lastrowid
         
-        # Insert user with welcome bonus
-        cursor.execute('''
-            INSERT INTO users (telegram_id, username, phone, name, referral_code, balance)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (telegram_id, username, phone, name, referral_code, 10.0))
+        # Credit whoever invited them (bonus is paid out later in a batch)
+        attribute_referral(cursor, user_id, telegram_id, referred_with, REFERRAL_BONUS)
         
         conn.commit()
-        user_id = cursor.lastrowid
         conn.close()
+        user_ids.remember(telegram_id, user_id)
         
         return jsonify({
             'status': 'success',
@@ -199,17 +767,35 @@ def register_user():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+PROFILE_COLUMNS = '''
+    id, telegram_id, username, phone, name, language,
+    balance, bonus_balance, profile_pic, referral_code, referral_count, created_at
+'''
+
+def user_to_dict(row):
+    """Convert a users row selected with PROFILE_COLUMNS to a profile dictionary"""
+    return {
+        'id': row['id'],
+        'telegram_id': row['telegram_id'],
+        'username': row['username'],
+        'phone': row['phone'],
+        'name': row['name'],
+        'language': row['language'],
+        'balance': row['balance'],
+        'bonus_balance': row['bonus_balance'],
+        'profile_pic': row['profile_pic'],
+        'referral_code': row['referral_code'],
+        'referral_count': row['referral_count'] or 0,
+        'created_at': row['created_at']
+    }
+
 @app.route('/api/users/<int:telegram_id>', methods=['GET'])
 def get_user(telegram_id):
     """Get user profile"""
     try:
         conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, telegram_id, username, phone, name, language, 
-                   balance, bonus_balance, profile_pic, referral_code, created_at
-            FROM users WHERE telegram_id = ?
-        ''', (telegram_id,))
+        cursor.execute(f'SELECT {PROFILE_COLUMNS} FROM users WHERE telegram_id = ?', (telegram_id,))
         user = cursor.fetchone()
         conn.close()
         
@@ -218,19 +804,7 @@ def get_user(telegram_id):
         
         return jsonify({
             'status': 'success',
-            'user': {
-                'id': user['id'],
-                'telegram_id': user['telegram_id'],
-                'username': user['username'],
-                'phone': user['phone'],
-                'name': user['name'],
-                'language': user['language'],
-                'balance': user['balance'],
-                'bonus_balance': user['bonus_balance'],
-                'profile_pic': user['profile_pic'],
-                'referral_code': user['referral_code'],
-                'created_at': user['created_at']
-            }
+            'user': user_to_dict(user)
         }), 200
     
     except Exception as e:
@@ -245,22 +819,21 @@ def update_user(telegram_id):
         cursor = conn.cursor()
         
         # Check if user exists
-        cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
-        user = cursor.fetchone()
-        if not user:
+        user_id = user_ids.resolve(cursor, telegram_id)
+        if not user_id:
             conn.close()
             return jsonify({'status': 'error', 'message': 'User not found'}), 404
         
         # Update fields if provided
         if 'name' in data:
-            cursor.execute('UPDATE users SET name = ? WHERE telegram_id = ?', 
-                         (data['name'], telegram_id))
+            cursor.execute('UPDATE users SET name = ? WHERE id = ?', 
+                         (data['name'], user_id))
         if 'phone' in data:
-            cursor.execute('UPDATE users SET phone = ? WHERE telegram_id = ?', 
-                         (data['phone'], telegram_id))
+            cursor.execute('UPDATE users SET phone = ? WHERE id = ?', 
+                         (data['phone'], user_id))
         if 'language' in data:
-            cursor.execute('UPDATE users SET language = ? WHERE telegram_id = ?', 
-                         (data['language'], telegram_id))
+            cursor.execute('UPDATE users SET language = ? WHERE id = ?', 
+                         (data['language'], user_id))
         
         conn.commit()
         conn.close()
@@ -275,12 +848,32 @@ def update_user(telegram_id):
 
 # ===================== GAME ROUTES =====================
 
+def may_play(cursor, game_id, card_id=None):
+    """True if the caller is the player of game_id, or owns card_id in it"""
+    telegram_id = g.get('telegram_id')
+    if telegram_id is None:
+        # Only without REQUIRE_TELEGRAM_AUTH, for a request naming no user
+        return not REQUIRE_TELEGRAM_AUTH
+    user_id = user_ids.resolve(cursor, telegram_id)
+    if card_id is None:
+        cursor.execute('SELECT 1 FROM games WHERE id = ? AND user_id = ?', (game_id, user_id))
+    else:
+        # Cards in shared rooms belong to their buyer, otherwise to the game's player
+        cursor.execute('''
+            SELECT 1 FROM cards c JOIN games g ON g.id = c.game_id
+            WHERE c.id = ? AND c.game_id = ? AND COALESCE(c.user_id, g.user_id) = ?
+        ''', (card_id, game_id, user_id))
+    return cursor.fetchone() is not None
+
+def forbidden():
+    return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+
 @app.route('/api/games/create', methods=['POST'])
 def create_game():
     """Create a new bingo game"""
     try:
         data = request.json
-        telegram_id = data.get('telegram_id')
+        telegram_id = g.get('telegram_id')
         stake_amount = data.get('stake_amount', 1.0)
         
         if not telegram_id:
@@ -290,29 +883,39 @@ def create_game():
         cursor = conn.cursor()
         
         # Get user
-        cursor.execute('SELECT id, balance FROM users WHERE telegram_id = ?', (telegram_id,))
-        user = cursor.fetchone()
-        if not user:
+        user_id = user_ids.resolve(cursor, telegram_id)
+        if not user_id:
             conn.close()
             return jsonify({'status': 'error', 'message': 'User not found'}), 404
         
-        # Check balance
-        if user['balance'] < stake_amount:
+        # Deduct stake from balance, only if the balance covers it
+        cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?', 
+                      (stake_amount, user_id, stake_amount))
+        if cursor.rowcount == 0:
             conn.close()
             return jsonify({'status': 'error', 'message': 'Insufficient balance'}), 400
         
-        # Deduct stake from balance
-        cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ?', 
-                      (stake_amount, user['id']))
-        
         # Create game
         cursor.execute('''
             INSERT INTO games (user_id, stake_amount, status, called_numbers)
             VALUES (?, ?, ?, ?)
-        ''', (user['id'], stake_amount, 'created', '[]'))
+        ''', (user_id, stake_amount, 'created', '[]'))
+        game_id = cursor.lastrowid
+        
+        # Update user stats
+        cursor.execute('''
+            INSERT INTO user_stats (user_id, games_played, total_staked)
+            VALUES (?, 1, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                games_played = games_played + 1,
+                total_staked = total_staked + excluded.total_staked,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (user_id, stake_amount))
+        
+        dashboard.adjust_gauge(cursor, 'games_in_play', 1, stake_amount)
+        dashboard.track(cursor, 'stakes', stake_amount)
         
         conn.commit()
-        game_id = cursor.lastrowid
         conn.close()
         
         return jsonify({
@@ -333,7 +936,7 @@ def get_game(game_id):
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT id, user_id, stake_amount, status, called_numbers, created_at
+            SELECT id, user_id, stake_amount, status, called_numbers, created_at, version
             FROM games WHERE id = ?
         ''', (game_id,))
         game = cursor.fetchone()
@@ -342,14 +945,24 @@ def get_game(game_id):
             conn.close()
             return jsonify({'status': 'error', 'message': 'Game not found'}), 404
         
+        # Unchanged since the client's copy: skip loading and serializing cards
+        compact = compact_cards_requested()
+        etag = f"game-{game_id}-{game['version']}{'-v2' if compact else ''}"
+        if etag in request.if_none_match:
+            conn.close()
+            return not_modified(etag)
+        
         # Get cards for this game
         cursor.execute('SELECT id, card_number, card_data, marked_numbers FROM cards WHERE game_id = ?', 
                       (game_id,))
-        cards = cursor.fetchall()
+        cards = [
+            card_payload(card['id'], card['card_number'], card['card_data'], card['marked_numbers'], compact)
+            for card in cursor.fetchall()
+        ]
         
         conn.close()
         
-        return jsonify({
+        response = jsonify({
             'status': 'success',
             'game': {
                 'id': game['id'],
@@ -357,14 +970,88 @@ def get_game(game_id):
                 'stake_amount': game['stake_amount'],
                 'status': game['status'],
                 'called_numbers': json.loads(game['called_numbers']),
-                'cards': [dict(card) for card in cards],
+                'cards': cards,
                 'created_at': game['created_at']
             }
-        }), 200
+        })
+        response.vary.add('Accept')
+        return with_etag(response, etag), 200
     
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+DELTA_POLL_INTERVAL = 0.25
+
+@app.route('/api/games/<int:game_id>/delta', methods=['GET'])
+def get_game_delta(game_id):
+    """Get changes since the client's last sync: new calls, re-marked cards, status
+
+    With wait=<seconds> the request long-polls until the game changes, for
+    at most SYNC_LONG_POLL_MAX seconds here.
+    """
+    try:
+        since_seq = request.args.get('since', 0, type=int)
+        since_version = request.args.get('version', 0, type=int)
+        wait = max(0.0, min(request.args.get('wait', 0, type=float), SYNC_LONG_POLL_MAX))
+        deadline = time.monotonic() + wait
+        
+        while True:
+            conn = get_db()
+            cursor = conn.cursor()
+            cursor.execute('SELECT status, version FROM games WHERE id = ?', (game_id,))
+            game = cursor.fetchone()
+            if not game:
+                conn.close()
+                return jsonify({'status': 'error', 'message': 'Game not found'}), 404
+            if game['version'] != since_version or time.monotonic() >= deadline:
+                break
+            # Hold no connection while waiting
+            conn.close()
+            time.sleep(DELTA_POLL_INTERVAL)
+        
+        delta = {
+            'status': 'success',
+            'game_status': game['status'],
+            'version': game['version'],
+            'seq': since_seq,
+            'numbers': [],
+            'cards': []
+        }
+        if game['version'] == since_version:
+            conn.close()
+            return jsonify(delta), 200
+        
+        cursor.execute('''
+            SELECT number, seq FROM called_numbers
+            WHERE game_id = ? AND seq > ?
+            ORDER BY seq
+        ''', (game_id, since_seq))
+        calls = cursor.fetchall()
+        if calls:
+            delta['numbers'] = [call['number'] for call in calls]
+            delta['seq'] = calls[-1]['seq']
+        
+        cursor.execute('''
+            SELECT id, card_data, marked_numbers FROM cards
+            WHERE game_id = ? AND marks_version > ?
+        ''', (game_id, since_version))
+        delta['cards'] = [marks_payload(card, compact_cards_requested()) for card in cursor.fetchall()]
+        
+        conn.close()
+        response = jsonify(delta)
+        response.vary.add('Accept')
+        return response, 200
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def marks_payload(card, compact):
+    """A card's marks for a delta: a position bitmask in v2, the marked numbers in v1"""
+    marked = json.loads(card['marked_numbers'])
+    if compact:
+        return {'id': card['id'], 'marked': marked_mask(decode_card(card['card_data'])['numbers'], marked)}
+    return {'id': card['id'], 'marked_numbers': marked}
+
 @app.route('/api/games/<int:game_id>/select-cards', methods=['POST'])
 def select_cards(game_id):
     """Select 1-2 cards for the game"""
@@ -384,37 +1071,47 @@ def select_cards(game_id):
         if not game:
             conn.close()
             return jsonify({'status': 'error', 'message': 'Game not found'}), 404
+        if not may_play(cursor, game_id):
+            conn.close()
+            return forbidden()
+        # Cards are bought once, before play; shared rooms sell theirs through matchmaking
+        if game['status'] != 'created':
+            conn.close()
+            return jsonify({'status': 'error', 'message': 'Cards have already been selected'}), 409
         
-        # Generate cards
+        # Generate cards, stored as 25 bytes of base64 rather than JSON
+        compact = compact_cards_requested()
         cards_data = []
         for i in range(num_cards):
             # Create a random bingo card (1-75 numbers in 5x5 grid)
-            card_numbers = random.sample(range(1, 76), 25)
-            card_data = {
-                'numbers': card_numbers,
-                'grid': [card_numbers[j*5:(j+1)*5] for j in range(5)]
-            }
+            card_data = generate_card()
+            stored = encode_card(card_data['numbers'])
             
             cursor.execute('''
                 INSERT INTO cards (game_id, card_number, card_data, marked_numbers)
                 VALUES (?, ?, ?, ?)
-            ''', (game_id, i+1, json.dumps(card_data), '[]'))
+            ''', (game_id, i+1, stored, '[]'))
             
-            cards_data.append(card_data)
+            cards_data.append(card_payload(cursor.lastrowid, i+1, stored, '[]', True) if compact else card_data)
         
         # Update game status
-        cursor.execute('UPDATE games SET status = ?, cards_selected = ? WHERE id = ?', 
-                      ('playing', num_cards, game_id))
+        cursor.execute('''
+            UPDATE games SET status = ?, cards_selected = ?, version = version + 1, last_active_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', ('playing', num_cards, game_id))
         
         conn.commit()
         conn.close()
+        room_store.bump(game_id)
         
-        return jsonify({
+        response = jsonify({
             'status': 'success',
             'game_id': game_id,
             'cards': cards_data,
             'message': f'{num_cards} card(s) selected'
-        }), 200
+        })
+        response.vary.add('Accept')
+        return response, 200
     
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -426,34 +1123,53 @@ def call_number(game_id):
         conn = get_db()
         cursor = conn.cursor()
         
-        # Get game and existing called numbers
-        cursor.execute('SELECT called_numbers FROM games WHERE id = ?', (game_id,))
-        game = cursor.fetchone()
-        if not game:
-            conn.close()
-            return jsonify({'status': 'error', 'message': 'Game not found'}), 404
-        
-        called_numbers = json.loads(game['called_numbers'])
-        
-        # Find next number to call
-        available = [n for n in range(1, 76) if n not in called_numbers]
-        if not available:
+        # Shared rooms belong to the house, whose caller is the only one calling
+        if not may_play(cursor, game_id):
+            cursor.execute('SELECT 1 FROM games WHERE id = ?', (game_id,))
+            found = cursor.fetchone()
             conn.close()
-            return jsonify({'status': 'error', 'message': 'All numbers have been called'}), 400
-        
-        number = random.choice(available)
-        called_numbers.append(number)
-        
-        # Update game
-        cursor.execute('UPDATE games SET called_numbers = ? WHERE id = ?', 
-                      (json.dumps(called_numbers), game_id))
+            return forbidden() if found else (jsonify({'status': 'error', 'message': 'Game not found'}), 404)
+        
+        # The owning worker usually has the called numbers in memory. The
+        # update is guarded by the version they were read at; if another
+        # writer got there first, reload from the database and try again.
+        state = room_store.get(game_id)
+        while True:
+            if state is None:
+                cursor.execute('SELECT called_numbers, version FROM games WHERE id = ?', (game_id,))
+                game = cursor.fetchone()
+                if not game:
+                    conn.close()
+                    room_store.drop(game_id)
+                    return jsonify({'status': 'error', 'message': 'Game not found'}), 404
+                state = (json.loads(game['called_numbers']), game['version'])
+            called_numbers, version = state
+            
+            # Find next number to call
+            available = [n for n in range(1, 76) if n not in called_numbers]
+            if not available:
+                conn.close()
+                return jsonify({'status': 'error', 'message': 'All numbers have been called'}), 400
+            
+            number = random.choice(available)
+            called_numbers.append(number)
+            
+            # Update game
+            cursor.execute('''
+                UPDATE games SET called_numbers = ?, version = version + 1, last_active_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND version = ?
+            ''', (json.dumps(called_numbers), game_id, version))
+            if cursor.rowcount:
+                break
+            state = None
         
         # Log called number
-        cursor.execute('INSERT INTO called_numbers (game_id, number) VALUES (?, ?)', 
-                      (game_id, number))
+        cursor.execute('INSERT INTO called_numbers (game_id, number, seq) VALUES (?, ?, ?)', 
+                      (game_id, number, len(called_numbers)))
         
         conn.commit()
         conn.close()
+        room_store.put(game_id, called_numbers, version + 1)
         
         return jsonify({
             'status': 'success',
@@ -478,22 +1194,37 @@ def mark_number(game_id):
         conn = get_db()
         cursor = conn.cursor()
         
-        # Get card
-        cursor.execute('SELECT marked_numbers FROM cards WHERE id = ?', (card_id,))
+        # Get card, with the numbers called in its game
+        cursor.execute('''
+            SELECT c.marked_numbers, g.called_numbers FROM cards c JOIN games g ON g.id = c.game_id
+            WHERE c.id = ? AND c.game_id = ?
+        ''', (card_id, game_id))
         card = cursor.fetchone()
         if not card:
             conn.close()
             return jsonify({'status': 'error', 'message': 'Card not found'}), 404
+        if not may_play(cursor, game_id, card_id):
+            conn.close()
+            return forbidden()
+        if number not in json.loads(card['called_numbers'] or '[]'):
+            conn.close()
+            return jsonify({'status': 'error', 'message': 'Number has not been called'}), 400
         
         marked = json.loads(card['marked_numbers'])
         if number not in marked:
             marked.append(number)
         
-        cursor.execute('UPDATE cards SET marked_numbers = ? WHERE id = ?', 
-                      (json.dumps(marked), card_id))
+        cursor.execute('UPDATE games SET version = version + 1, last_active_at = CURRENT_TIMESTAMP WHERE id = ?',
+                      (game_id,))
+        cursor.execute('''
+            UPDATE cards
+            SET marked_numbers = ?, marks_version = (SELECT version FROM games WHERE id = ?)
+            WHERE id = ?
+        ''', (json.dumps(marked), game_id, card_id))
         
         conn.commit()
         conn.close()
+        room_store.bump(game_id)
         
         return jsonify({
             'status': 'success',
@@ -505,61 +1236,254 @@ def mark_number(game_id):
 
 @app.route('/api/games/<int:game_id>/check-bingo', methods=['POST'])
 def check_bingo(game_id):
-    """Check if player won (full card marked)"""
+    """Check if player won (full card marked) and settle the game"""
     try:
         data = request.json
         card_id = data.get('card_id')
         
         conn = get_db()
-        cursor = conn.cursor()
-        
-        # Get card
-        cursor.execute('SELECT card_data, marked_numbers FROM cards WHERE id = ?', (card_id,))
-        card = cursor.fetchone()
-        if not card:
+        try:
+            cursor = conn.cursor()
+            
+            # Get card, with the numbers called in its game
+            cursor.execute('''
+                SELECT c.card_data, c.marked_numbers, g.called_numbers FROM cards c JOIN games g ON g.id = c.game_id
+                WHERE c.id = ? AND c.game_id = ?
+            ''', (card_id, game_id))
+            card = cursor.fetchone()
+            if not card:
+                return jsonify({'status': 'error', 'message': 'Card not found'}), 404
+            if not may_play(cursor, game_id, card_id):
+                return forbidden()
+            
+            called = set(json.loads(card['called_numbers'] or '[]'))
+            if not is_bingo(decode_card(card['card_data']), called.intersection(json.loads(card['marked_numbers']))):
+                return jsonify({
+                    'status': 'success',
+                    'is_bingo': False,
+                    'message': 'Not a bingo yet'
+                }), 200
+            
+            # Pays every card that is complete now, or replays an earlier settlement
+            settlement = settlement_engine.settle(conn, game_id)
+        finally:
             conn.close()
-            return jsonify({'status': 'error', 'message': 'Card not found'}), 404
         
-        card_data = json.loads(card['card_data'])
-        marked = json.loads(card['marked_numbers'])
+        if settlement is None:
+            return jsonify({'status': 'error', 'message': 'Game is not in play'}), 409
+        if not settlement['duplicate']:
+            room_store.bump(game_id)
         
-        # Check if all numbers are marked
-        all_numbers = card_data['numbers']
-        is_bingo = len(marked) == len(all_numbers) and all(n in marked for n in all_numbers)
+        winnings = settlement['payouts'].get(int(card_id), 0.0)
+        return jsonify({
+            'status': 'success',
+            'is_bingo': True,
+            'message': 'Congratulations! You won!' if winnings else 'This game has already been won',
+            'winnings': winnings,
+            'winners': len(settlement['payouts']),
+            'pot': settlement['pot']
+        }), 200
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def stats_to_dict(row):
+    """Convert a (possibly missing) user_stats row to a stats dictionary"""
+    games_played = row['games_played'] or 0
+    games_won = row['games_won'] or 0
+    return {
+        'games_played': games_played,
+        'games_won': games_won,
+        'win_rate': round(games_won * 100.0 / games_played, 2) if games_played else 0.0,
+        'total_staked': row['total_staked'] or 0.0,
+        'total_winnings': row['total_winnings'] or 0.0
+    }
+
+GAME_HISTORY_PAGE_SIZE = 20
+GAME_HISTORY_PAGE_MAX = 100
+
+@app.route('/api/games/history/<int:telegram_id>', methods=['GET'])
+def get_game_history(telegram_id):
+    """Get a user's stats and game history, newest first"""
+    try:
+        limit = request.args.get('limit', GAME_HISTORY_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, GAME_HISTORY_PAGE_MAX))
+        # Cursor is "<created_at>|<id>" of the last game on the previous page
+        keyset_params = []
+        cursor_value = request.args.get('cursor')
+        if cursor_value:
+            created_at, _, last_id = cursor_value.rpartition('|')
+            if not created_at or not last_id.isdigit():
+                return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+            keyset_params = [created_at, int(last_id)]
         
-        if is_bingo:
-            # Get game and stake amount
-            cursor.execute('SELECT user_id, stake_amount FROM games WHERE id = ?', (game_id,))
-            game = cursor.fetchone()
-            
-            # Award winnings (2x stake)
-            winnings = game['stake_amount'] * 2
-            cursor.execute('UPDATE users SET balance = balance + ? WHERE id = ?', 
-                          (winnings, game['user_id']))
-            
-            # Update game status
-            cursor.execute('UPDATE games SET status = ?, ended_at = CURRENT_TIMESTAMP, winner_id = ? WHERE id = ?', 
-                          ('won', game['user_id'], game_id))
-            
-            conn.commit()
-            
-            return jsonify({
-                'status': 'success',
-                'is_bingo': True,
-                'message': 'Congratulations! You won!',
-                'winnings': winnings
-            }), 200
+        conn = get_db()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT u.id, s.games_played, s.games_won, s.total_staked, s.total_winnings
+            FROM users u LEFT JOIN user_stats s ON s.user_id = u.id
+            WHERE u.telegram_id = ?
+        ''', (telegram_id,))
+        user = cursor.fetchone()
+        if not user:
+            conn.close()
+            return jsonify({'status': 'error', 'message': 'User not found'}), 404
         
+        # Live and archived games the user played alone, and shared rooms they
+        # bought cards in; each side read in index order up to the page size.
+        # winner_id names only the first of a split pot, so payouts decide won.
+        page = '''
+            SELECT * FROM (
+                SELECT id, stake_amount, status, cards_selected, created_at, ended_at,
+                       winner_id = ? OR EXISTS (
+                           SELECT 1 FROM payouts p WHERE p.game_id = {table}.id AND p.user_id = ?
+                       ) AS won
+                FROM {table}
+                WHERE {owner} {keyset}
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            )
+        '''
+        owners = [
+            ('user_id = ?', user['id']),
+            ('id IN (SELECT game_id FROM {cards} WHERE user_id = ?)', user['id']),
+        ]
+        keyset = 'AND (created_at, id) < (?, ?)' if keyset_params else ''
+        
+        pages = []
+        params = []
+        for table, cards in (('games', 'cards'), ('games_archive', 'cards_archive')):
+            for owner, owner_id in owners:
+                pages.append(page.format(table=table, owner=owner.format(cards=cards), keyset=keyset))
+                params += [user['id'], user['id'], owner_id, *keyset_params, limit + 1]
+        query = ' UNION ALL '.join(pages) + ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        cursor.execute(query, params + [limit + 1])
+        rows = cursor.fetchall()
         conn.close()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
         return jsonify({
             'status': 'success',
-            'is_bingo': False,
-            'message': 'Not a bingo yet'
+            'stats': stats_to_dict(user),
+            'games': [
+                {
+                    'id': row['id'],
+                    'stake_amount': row['stake_amount'],
+                    'status': row['status'],
+                    'cards_selected': row['cards_selected'],
+                    'won': bool(row['won']),
+                    'created_at': row['created_at'],
+                    'ended_at': row['ended_at']
+                }
+                for row in rows
+            ],
+            'next_cursor': f"{rows[-1]['created_at']}|{rows[-1]['id']}" if has_more else None
         }), 200
     
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+# ===================== MATCHMAKING ROUTES =====================
+
+MATCH_MAX_CARDS = 2
+
+def ticket_to_dict(room, ticket):
+    """Room status, plus the ticket's cards once the room has started"""
+    result = room.to_dict()
+    if room.error:
+        result['error'] = room.error
+    if room.card_ids is not None:
+        user_id, card_data, _ = room.tickets[ticket]
+        compact = compact_cards_requested()
+        result['cards'] = [
+            card_payload(card_id, i + 1, encode_card(card['numbers']), '[]', compact)
+            for i, (card_id, card) in enumerate(zip(room.card_ids[ticket], card_data))
+        ]
+    return result
+
+@app.route('/api/matchmaking/<int:stake>/join', methods=['POST'])
+def join_room(stake):
+    """Buy cards in the open room of a stake tier"""
+    try:
+        data = request.json
+        telegram_id = g.get('telegram_id')
+        num_cards = data.get('num_cards', 1)
+        
+        if stake not in matchmaker.tiers:
+            return jsonify({'status': 'error', 'message': f'Stake must be one of {matchmaker.tiers}'}), 400
+        if not telegram_id:
+            return jsonify({'status': 'error', 'message': 'Missing telegram_id'}), 400
+        if not isinstance(num_cards, int) or num_cards < 1 or num_cards > MATCH_MAX_CARDS:
+            return jsonify({'status': 'error', 'message': f'Select 1 to {MATCH_MAX_CARDS} cards'}), 400
+        
+        cost = stake * num_cards
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            user_id = user_ids.resolve(cursor, telegram_id)
+            if not user_id:
+                return jsonify({'status': 'error', 'message': 'User not found'}), 404
+            
+            # Charge first; the room is only joined once the stake is paid
+            cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?',
+                          (cost, user_id, cost))
+            if cursor.rowcount == 0:
+                return jsonify({'status': 'error', 'message': 'Insufficient balance'}), 400
+            cursor.execute('''
+                INSERT INTO user_stats (user_id, games_played, total_staked)
+                VALUES (?, 1, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    games_played = games_played + 1,
+                    total_staked = total_staked + excluded.total_staked,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (user_id, cost))
+            dashboard.track(cursor, 'stakes', cost, num_cards)
+            # Pending until the room starts; refunded if the room is never started
+            cursor.execute('''
+                INSERT INTO transactions (user_id, type, amount, method, status)
+                VALUES (?, 'stake', ?, ?, 'pending')
+            ''', (user_id, cost, f'tier_{stake}'))
+            stake_id = cursor.lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+        
+        room, ticket, closed = matchmaker.admit(stake, user_id, num_cards, stake_id)
+        if closed is not None:
+            # This join filled the room, so this request starts it
+            matchmaker.start_room(closed)
+        
+        return jsonify({'status': 'success', 'ticket': ticket, **ticket_to_dict(room, ticket)}), 201
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def holds_ticket(room, ticket):
+    """True if the caller bought the ticket; like may_play for requests naming no user"""
+    telegram_id = g.get('telegram_id')
+    if telegram_id is None:
+        return not REQUIRE_TELEGRAM_AUTH
+    conn = get_db()
+    try:
+        return user_ids.resolve(conn.cursor(), telegram_id) == room.tickets[ticket][0]
+    finally:
+        conn.close()
+
+@app.route('/api/matchmaking/<int:stake>/rooms/<int:room_id>/tickets/<int:ticket>', methods=['GET'])
+def get_room_ticket(stake, room_id, ticket):
+    """Room status for a ticket; ?wait=N long-polls until the room starts"""
+    room = matchmaker.room(room_id)
+    if room is None or room.stake != stake or ticket >= len(room.tickets) or not holds_ticket(room, ticket):
+        return jsonify({'status': 'error', 'message': 'Ticket not found'}), 404
+    
+    wait = max(0.0, min(request.args.get('wait', 0, type=float), SYNC_LONG_POLL_MAX))
+    if wait:
+        room.started.wait(wait)
+    
+    return jsonify({'status': 'success', 'ticket': ticket, **ticket_to_dict(room, ticket)}), 200
+
 # ===================== WALLET ROUTES =====================
 
 @app.route('/api/wallet/balance/<int:telegram_id>', methods=['GET'])
@@ -589,7 +1513,7 @@ def deposit():
     """Deposit funds"""
     try:
         data = request.json
-        telegram_id = data.get('telegram_id')
+        telegram_id = g.get('telegram_id')
         amount = data.get('amount')
         method = data.get('method', 'TeleBirr')
         
@@ -600,24 +1524,25 @@ def deposit():
         cursor = conn.cursor()
         
         # Get user
-        cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
-        user = cursor.fetchone()
-        if not user:
+        user_id = user_ids.resolve(cursor, telegram_id)
+        if not user_id:
             conn.close()
             return jsonify({'status': 'error', 'message': 'User not found'}), 404
         
         # Add balance
         cursor.execute('UPDATE users SET balance = balance + ? WHERE id = ?', 
-                      (amount, user['id']))
+                      (amount, user_id))
         
         # Log transaction
         cursor.execute('''
             INSERT INTO transactions (user_id, type, amount, method, status)
             VALUES (?, ?, ?, ?, ?)
-        ''', (user['id'], 'deposit', amount, method, 'completed'))
+        ''', (user_id, 'deposit', amount, method, 'completed'))
+        trans_id = cursor.lastrowid
+        
+        dashboard.track(cursor, 'deposits', amount)
         
         conn.commit()
-        trans_id = cursor.lastrowid
         conn.close()
         
         return jsonify({
@@ -634,7 +1559,7 @@ def withdraw():
     """Withdraw funds"""
     try:
         data = request.json
-        telegram_id = data.get('telegram_id')
+        telegram_id = g.get('telegram_id')
         amount = data.get('amount')
         method = data.get('method', 'Bank')
         
@@ -645,29 +1570,29 @@ def withdraw():
         cursor = conn.cursor()
         
         # Get user
-        cursor.execute('SELECT id, balance FROM users WHERE telegram_id = ?', (telegram_id,))
-        user = cursor.fetchone()
-        if not user:
+        user_id = user_ids.resolve(cursor, telegram_id)
+        if not user_id:
             conn.close()
             return jsonify({'status': 'error', 'message': 'User not found'}), 404
         
-        # Check balance
-        if user['balance'] < amount:
+        # Deduct balance, only if the balance covers it
+        cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?', 
+                      (amount, user_id, amount))
+        if cursor.rowcount == 0:
             conn.close()
             return jsonify({'status': 'error', 'message': 'Insufficient balance'}), 400
         
-        # Deduct balance
-        cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ?', 
-                      (amount, user['id']))
-        
         # Log transaction
         cursor.execute('''
             INSERT INTO transactions (user_id, type, amount, method, status)
             VALUES (?, ?, ?, ?, ?)
-        ''', (user['id'], 'withdraw', amount, method, 'pending'))
+        ''', (user_id, 'withdraw', amount, method, 'pending'))
+        trans_id = cursor.lastrowid
+        
+        dashboard.adjust_gauge(cursor, 'pending_withdrawals', 1, amount)
+        dashboard.track(cursor, 'withdrawals_requested', amount)
         
         conn.commit()
-        trans_id = cursor.lastrowid
         conn.close()
         
         return jsonify({
@@ -684,7 +1609,7 @@ def transfer():
     """Transfer funds to another user"""
     try:
         data = request.json
-        from_telegram_id = data.get('from_telegram_id')
+        from_telegram_id = g.get('telegram_id')
         to_phone = data.get('to_phone')
         amount = data.get('amount')
         
@@ -695,17 +1620,11 @@ def transfer():
         cursor = conn.cursor()
         
         # Get sender
-        cursor.execute('SELECT id, balance FROM users WHERE telegram_id = ?', (from_telegram_id,))
-        sender = cursor.fetchone()
-        if not sender:
+        sender_id = user_ids.resolve(cursor, from_telegram_id)
+        if not sender_id:
             conn.close()
             return jsonify({'status': 'error', 'message': 'Sender not found'}), 404
         
-        # Check balance
-        if sender['balance'] < amount:
-            conn.close()
-            return jsonify({'status': 'error', 'message': 'Insufficient balance'}), 400
-        
         # Get recipient
         cursor.execute('SELECT id FROM users WHERE phone = ?', (to_phone,))
         recipient = cursor.fetchone()
@@ -713,9 +1632,12 @@ def transfer():
             conn.close()
             return jsonify({'status': 'error', 'message': 'Recipient not found'}), 404
         
-        # Transfer
-        cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ?', 
-                      (amount, sender['id']))
+        # Transfer, debiting only if the sender's balance covers it
+        cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?', 
+                      (amount, sender_id, amount))
+        if cursor.rowcount == 0:
+            conn.close()
+            return jsonify({'status': 'error', 'message': 'Insufficient balance'}), 400
         cursor.execute('UPDATE users SET balance = balance + ? WHERE id = ?', 
                       (amount, recipient['id']))
         
@@ -723,7 +1645,7 @@ def transfer():
         cursor.execute('''
             INSERT INTO transactions (user_id, type, amount, method, status)
             VALUES (?, ?, ?, ?, ?)
-        ''', (sender['id'], 'transfer', amount, f'to_{to_phone}', 'completed'))
+        ''', (sender_id, 'transfer', amount, f'to_{to_phone}', 'completed'))
         
         conn.commit()
         conn.close()
@@ -736,38 +1658,185 @@ def transfer():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-# ===================== LEADERBOARD ROUTES =====================
+TRANSACTION_PAGE_SIZE = 20
+TRANSACTION_PAGE_MAX = 100
+TRANSACTION_EXPORT_BATCH = 500
 
-@app.route('/api/leaderboard', methods=['GET'])
-def get_leaderboard():
-    """Get top 50 players by balance"""
+def build_transaction_filters(user_id, args):
+    """Build the WHERE clause and params for a transaction history query"""
+    clauses = ['user_id = ?']
+    params = [user_id]
+    
+    if args.get('type'):
+        clauses.append('type = ?')
+        params.append(args['type'])
+    if args.get('status'):
+        clauses.append('status = ?')
+        params.append(args['status'])
+    if args.get('from'):
+        clauses.append('created_at >= ?')
+        params.append(args['from'])
+    if args.get('to'):
+        # A bare YYYY-MM-DD takes in the whole of that day
+        if len(args['to']) == 10:
+            clauses.append("created_at < date(?, '+1 day')")
+        else:
+            clauses.append('created_at <= ?')
+        params.append(args['to'])
+    
+    return clauses, params
+
+def transaction_to_dict(row):
+    """Convert a transaction row to a dictionary"""
+    return {
+        'id': row['id'],
+        'type': row['type'],
+        'amount': row['amount'],
+        'method': row['method'],
+        'status': row['status'],
+        'created_at': row['created_at']
+    }
+
+def transaction_query(user_id, args, cursor_id=None):
+    """Newest-first transaction query, starting below cursor_id if given"""
+    clauses, params = build_transaction_filters(user_id, args)
+    if cursor_id:
+        clauses.append('id < ?')
+        params.append(cursor_id)
+    query = f'''
+        SELECT id, type, amount, method, status, created_at
+        FROM transactions
+        WHERE {' AND '.join(clauses)}
+        ORDER BY id DESC
+    '''
+    return query, params
+
+def transaction_page(cursor, query, params, limit):
+    """Run a transaction query for one page plus the cursor of the next"""
+    # Fetch one extra row to know whether another page exists
+    cursor.execute(query + ' LIMIT ?', params + [limit + 1])
+    rows = cursor.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    return {
+        'transactions': [transaction_to_dict(row) for row in rows],
+        'next_cursor': rows[-1]['id'] if has_more else None
+    }
+
+@app.route('/api/wallet/transactions/<int:telegram_id>', methods=['GET'])
+def get_transactions(telegram_id):
+    """Get transaction history, newest first, using keyset pagination on (user_id, id)"""
     try:
+        limit = request.args.get('limit', TRANSACTION_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, TRANSACTION_PAGE_MAX))
+        cursor_id = request.args.get('cursor', type=int)
+        export = request.args.get('export') == '1'
+        
         conn = get_db()
         cursor = conn.cursor()
         
+        user_id = user_ids.resolve(cursor, telegram_id)
+        if not user_id:
+            conn.close()
+            return jsonify({'status': 'error', 'message': 'User not found'}), 404
+        
+        query, params = transaction_query(user_id, request.args, cursor_id)
+        
+        if export:
+            return Response(
+                stream_with_context(stream_transactions(conn, query, params)),
+                mimetype='application/json'
+            )
+        
+        page = transaction_page(cursor, query, params, limit)
+        conn.close()
+        
+        return jsonify({'status': 'success', **page}), 200
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def stream_transactions(conn, query, params):
+    """Stream a full transaction export as a JSON document, one batch at a time"""
+    try:
+        cursor = conn.execute(query, params)
+        yield '{"status": "success", "transactions": ['
+        first = True
+        while True:
+            rows = cursor.fetchmany(TRANSACTION_EXPORT_BATCH)
+            if not rows:
+                break
+            for row in rows:
+                yield ('' if first else ',') + json.dumps(transaction_to_dict(row))
+                first = False
+        yield ']}'
+    finally:
+        conn.close()
+
+# ===================== LEADERBOARD ROUTES =====================
+
+LEADERBOARD_TTL = 5  # seconds
+
+# Last computed leaderboard; version only changes when the rows do
+leaderboard_cache = {'rows': None, 'version': 0, 'expires': 0.0}
+leaderboard_lock = threading.Lock()
+
+def current_leaderboard(cursor=None):
+    """Return (rows, version), re-querying at most once per LEADERBOARD_TTL.
+    A caller's cursor is always read through so its snapshot stays consistent."""
+    with leaderboard_lock:
+        if cursor is None and leaderboard_cache['rows'] is not None and leaderboard_cache['expires'] > time.monotonic():
+            return leaderboard_cache['rows'], leaderboard_cache['version']
+        
+        conn = None
+        if cursor is None:
+            conn = get_db()
+            cursor = conn.cursor()
+        
         cursor.execute('''
-            SELECT username, balance, bonus_balance, created_at
-            FROM users
-            ORDER BY balance DESC
+            SELECT u.username, u.balance, u.bonus_balance, COALESCE(s.games_won, 0) AS games_won
+            FROM users u LEFT JOIN user_stats s ON s.user_id = u.id
+            ORDER BY u.balance DESC
             LIMIT 50
         ''')
         users = cursor.fetchall()
-        conn.close()
+        if conn is not None:
+            conn.close()
         
         leaderboard = [
             {
                 'rank': i+1,
                 'username': user['username'],
                 'balance': user['balance'],
-                'bonus_balance': user['bonus_balance']
+                'bonus_balance': user['bonus_balance'],
+                'games_won': user['games_won']
             }
             for i, user in enumerate(users)
         ]
         
-        return jsonify({
+        if leaderboard != leaderboard_cache['rows']:
+            leaderboard_cache['rows'] = leaderboard
+            leaderboard_cache['version'] += 1
+        leaderboard_cache['expires'] = time.monotonic() + LEADERBOARD_TTL
+        return leaderboard_cache['rows'], leaderboard_cache['version']
+
+@app.route('/api/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """Get top 50 players by balance"""
+    try:
+        leaderboard, version = current_leaderboard()
+        
+        etag = f'leaderboard-{WORKER_ID}-{version}'
+        if etag in request.if_none_match:
+            return not_modified(etag)
+        
+        response = jsonify({
             'status': 'success',
             'leaderboard': leaderboard
-        }), 200
+        })
+        return with_etag(response, etag), 200
     
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -780,7 +1849,7 @@ def get_referrals(telegram_id):
         cursor = conn.cursor()
         
         cursor.execute(
-            'SELECT referral_code FROM users WHERE telegram_id = ?',
+            'SELECT referral_code, referral_count FROM users WHERE telegram_id = ?',
             (telegram_id,)
         )
         user = cursor.fetchone()
@@ -795,13 +1864,305 @@ def get_referrals(telegram_id):
         return jsonify({
             'status': 'success',
             'referral_code': referral_code,
-            'referral_link': f'https://t.me/YOUR_BOT_NAME?start={referral_code}',
-            'referral_count': 0
+            'referral_link': f'https://t.me/{BOT_USERNAME}?start={referral_code}',
+            'referral_count': user['referral_count'] or 0
+        }), 200
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# ===================== BATCH ROUTES =====================
+
+BATCH_MAX_OPS = 10
+
+def batch_profile(cursor, user, op):
+    return {'user': user_to_dict(user)}
+
+def batch_balance(cursor, user, op):
+    return {'balance': user['balance'], 'bonus_balance': user['bonus_balance']}
+
+def batch_stats(cursor, user, op):
+    cursor.execute('''
+        SELECT games_played, games_won, total_staked, total_winnings
+        FROM user_stats WHERE user_id = ?
+    ''', (user['id'],))
+    row = cursor.fetchone() or {'games_played': 0, 'games_won': 0, 'total_staked': 0.0, 'total_winnings': 0.0}
+    return {'stats': stats_to_dict(row)}
+
+def batch_transactions(cursor, user, op):
+    limit = max(1, min(int(op.get('limit', TRANSACTION_PAGE_SIZE)), TRANSACTION_PAGE_MAX))
+    cursor_id = int(op['cursor']) if op.get('cursor') else None
+    query, params = transaction_query(user['id'], op, cursor_id)
+    return transaction_page(cursor, query, params, limit)
+
+def batch_referrals(cursor, user, op):
+    return {
+        'referral_code': user['referral_code'],
+        'referral_link': f"https://t.me/{BOT_USERNAME}?start={user['referral_code']}",
+        'referral_count': user['referral_count'] or 0
+    }
+
+def batch_leaderboard(cursor, user, op):
+    leaderboard, version = current_leaderboard(cursor)
+    return {'leaderboard': leaderboard, 'version': version}
+
+# Read operations /api/batch can combine; each gets the caller's users row
+BATCH_OPS = {
+    'profile': batch_profile,
+    'balance': batch_balance,
+    'stats': batch_stats,
+    'transactions': batch_transactions,
+    'referrals': batch_referrals,
+    'leaderboard': batch_leaderboard,
+}
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Answer several reads for one user from a single connection and snapshot
+    
+    Body: {"telegram_id": ..., "ops": [{"op": "balance"}, {"op": "transactions", "limit": 10}, ...]}
+    Results come back in the same order; a failed op does not fail the others.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        telegram_id = data.get('telegram_id')
+        ops = data.get('ops')
+        
+        if not telegram_id or not isinstance(ops, list) or not ops:
+            return jsonify({'status': 'error', 'message': 'telegram_id and ops are required'}), 400
+        if len(ops) > BATCH_MAX_OPS:
+            return jsonify({'status': 'error', 'message': f'At most {BATCH_MAX_OPS} ops per batch'}), 400
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        try:
+            # One read transaction, so every op sees the same state
+            cursor.execute('BEGIN')
+            cursor.execute(f'SELECT {PROFILE_COLUMNS} FROM users WHERE telegram_id = ?', (telegram_id,))
+            user = cursor.fetchone()
+            if not user:
+                return jsonify({'status': 'error', 'message': 'User not found'}), 404
+            
+            results = []
+            for op in ops:
+                handler = BATCH_OPS.get(op.get('op')) if isinstance(op, dict) else None
+                if handler is None:
+                    results.append({'status': 'error', 'message': 'Unknown op'})
+                    continue
+                try:
+                    results.append({'status': 'success', **handler(cursor, user, op)})
+                except (TypeError, ValueError) as e:
+                    results.append({'status': 'error', 'message': str(e)})
+        finally:
+            conn.close()
+        
+        return jsonify({'status': 'success', 'results': results}), 200
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# ===================== ADMIN ROUTES =====================
+
+@app.route('/api/admin/users/import', methods=['POST'])
+def import_users_route():
+    """Bulk-register users streamed from a CSV or JSONL request body"""
+    try:
+        fmt = request.args.get('format', 'jsonl' if 'json' in (request.mimetype or '') else 'csv')
+        if fmt not in ('csv', 'jsonl'):
+            return jsonify({'status': 'error', 'message': 'format must be csv or jsonl'}), 400
+        chunk_size = min(max(request.args.get('chunk_size', 1000, type=int), 1), 10000)
+        
+        upload = request.files.get('file')
+        stream = upload.stream if upload else request.stream
+        rows = read_rows(io.TextIOWrapper(stream, encoding='utf-8', newline=''), fmt)
+        
+        conn = get_db()
+        try:
+            stats = import_users(conn, rows, chunk_size)
+        finally:
+            conn.close()
+        
+        return jsonify({'status': 'success', **stats})
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/admin/dashboard', methods=['GET'])
+def get_admin_dashboard():
+    """Games in play, pending withdrawals and daily money volumes"""
+    try:
+        days = max(1, min(request.args.get('days', 7, type=int), 90))
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        stats = dashboard.snapshot(cursor, days)
+        conn.close()
+        
+        return jsonify({'status': 'success', 'days': days, **stats}), 200
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+WITHDRAWAL_QUEUE_PAGE_SIZE = 50
+WITHDRAWAL_QUEUE_PAGE_MAX = 500
+
+@app.route('/api/admin/withdrawals', methods=['GET'])
+def get_pending_withdrawals():
+    """Pending withdrawals, oldest first"""
+    try:
+        limit = request.args.get('limit', WITHDRAWAL_QUEUE_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, WITHDRAWAL_QUEUE_PAGE_MAX))
+        after_id = request.args.get('cursor', 0, type=int)
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT t.id, t.amount, t.method, t.created_at, u.telegram_id, u.username, u.phone
+            FROM transactions t JOIN users u ON u.id = t.user_id
+            WHERE t.type = 'withdraw' AND t.status = 'pending' AND t.id > ?
+            ORDER BY t.id
+            LIMIT ?
+        ''', (after_id, limit + 1))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return jsonify({
+            'status': 'success',
+            'withdrawals': [dict(row) for row in rows],
+            'next_cursor': rows[-1]['id'] if has_more else None
         }), 200
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/admin/withdrawals/review', methods=['POST'])
+def review_withdrawals():
+    """Approve or reject a batch of pending withdrawals"""
+    try:
+        data = request.json
+        transaction_ids = data.get('transaction_ids') or []
+        action = data.get('action')
+        
+        if action not in ('approve', 'reject'):
+            return jsonify({'status': 'error', 'message': 'action must be approve or reject'}), 400
+        if not isinstance(transaction_ids, list) or not all(isinstance(i, int) for i in transaction_ids):
+            return jsonify({'status': 'error', 'message': 'transaction_ids must be a list of ids'}), 400
+        
+        conn = get_db()
+        try:
+            result = dashboard.review_withdrawals(conn, transaction_ids, action == 'approve')
+        finally:
+            conn.close()
+        
+        return jsonify({'status': 'success', 'action': action, **result}), 200
+    
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+# ===================== METRICS ROUTES =====================
+
+@app.route('/api/metrics/rate-limits', methods=['GET'])
+def get_rate_limit_metrics():
+    """Get allowed/throttled counters per rate-limited endpoint"""
+    return jsonify({
+        'status': 'success',
+        'rate_limits': rate_limiter.stats()
+    }), 200
+
+@app.route('/api/metrics/auth', methods=['GET'])
+def get_auth_metrics():
+    """Get initData verification cache counters"""
+    return jsonify({
+        'status': 'success',
+        'auth': init_data_verifier.stats()
+    }), 200
+
+@app.route('/api/metrics/identity', methods=['GET'])
+def get_identity_metrics():
+    """Get telegram_id -> user_id cache counters"""
+    return jsonify({
+        'status': 'success',
+        'identity': user_ids.stats()
+    }), 200
+
+@app.route('/api/metrics/lifecycle', methods=['GET'])
+def get_lifecycle_metrics():
+    """Get game sweeper counters"""
+    return jsonify({
+        'status': 'success',
+        'lifecycle': dict(game_sweeper.stats)
+    }), 200
+
+@app.route('/api/metrics/referrals', methods=['GET'])
+def get_referral_metrics():
+    """Get referral payout counters"""
+    return jsonify({
+        'status': 'success',
+        'referrals': dict(referral_payer.stats)
+    }), 200
+
+@app.route('/api/metrics/settlement', methods=['GET'])
+def get_settlement_metrics():
+    """Get game settlement counters for this worker"""
+    return jsonify({
+        'status': 'success',
+        'settlement': dict(settlement_engine.stats)
+    }), 200
+
+@app.route('/api/metrics/logging', methods=['GET'])
+def get_logging_metrics():
+    """Get log queue and slow query counters for this worker"""
+    return jsonify({
+        'status': 'success',
+        'logging': logging_stats()
+    }), 200
+
+@app.route('/api/metrics/resilience', methods=['GET'])
+def get_resilience_metrics():
+    """Get circuit breaker, load shedding and stale read counters for this worker"""
+    return jsonify({
+        'status': 'success',
+        'resilience': {
+            'breaker': {'state': breaker.state, **breaker.stats},
+            'in_flight': load_shedder.in_flight,
+            'max_in_flight': load_shedder.max_in_flight,
+            **load_shedder.stats,
+            'stale_reads': {'entries': len(stale_reads), **stale_reads.stats},
+            'faults': {'delay_ms': faults.delay_ms, 'lock_rate': faults.lock_rate}
+        }
+    }), 200
+
+@app.route('/api/metrics/matchmaking', methods=['GET'])
+def get_matchmaking_metrics():
+    """Get open rooms per stake tier and matchmaking counters for this worker"""
+    return jsonify({
+        'status': 'success',
+        'matchmaking': matchmaker.snapshot()
+    }), 200
+
+@app.route('/api/metrics/idempotency', methods=['GET'])
+def get_idempotency_metrics():
+    """Get replay cache counters for this worker"""
+    return jsonify({
+        'status': 'success',
+        'idempotency': {'entries': len(idempotency_store), **idempotency_store.stats}
+    }), 200
+
+@app.route('/api/metrics/rooms', methods=['GET'])
+def get_room_metrics():
+    """Get room routing and room state counters for this worker"""
+    return jsonify({
+        'status': 'success',
+        'rooms': {
+            'node': room_router.node,
+            'ring': room_router.ring.nodes,
+            'routing': dict(room_router.stats),
+            'state': room_store.stats()
+        }
+    }), 200
+
           
 # ===================== ERROR HANDLERS =====================
 
@@ -818,10 +2179,3 @@ def server_error(error):
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
-
-
-
-
-
-
-
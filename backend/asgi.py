@@ -0,0 +1,339 @@
+# asgi.py - ASGI entry point sharing one event loop with the Telegram bot
+#
+# Run with: uvicorn asgi:application --host 0.0.0.0 --port $PORT
+#
+# I/O-bound endpoints (the Telegram webhook, game polling, balance) are
+# served natively on the event loop through aiosqlite, so a waiting client
+# holds no thread. They pass the same rate limits, load shedding and circuit
+# breaker as the Flask routes. Every other route is the unchanged Flask app,
+# run on a bounded thread pool behind a WSGI adapter.
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+import aiosqlite
+from a2wsgi import WSGIMiddleware
+from telegram import Update
+
+import app as backend
+from cards import accepts_compact_cards
+from logs import bind_request_id, request_id_var, tag_update
+from resilience import breaker
+
+logger = logging.getLogger(__name__)
+
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 16))
+ASYNC_DB_CONNECTIONS = int(os.environ.get('ASYNC_DB_CONNECTIONS', 4))
+
+wsgi_app = WSGIMiddleware(backend.app, workers=WSGI_THREADS)
+
+
+class AsyncDB:
+    """Fixed pool of aiosqlite connections; each one runs on its own thread"""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._pool = asyncio.Queue()
+
+    async def open(self):
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.path)
+            conn.row_factory = aiosqlite.Row
+            self._pool.put_nowait(conn)
+
+    async def close(self):
+        while not self._pool.empty():
+            await self._pool.get_nowait().close()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    async def fetchone(self, conn, query, params=()):
+        return await self._timed(conn, query, params, 'fetchone')
+
+    async def fetchall(self, conn, query, params=()):
+        return await self._timed(conn, query, params, 'fetchall')
+
+    async def _timed(self, conn, query, params, fetch):
+        # Feeds the same circuit breaker as the Flask routes' GuardedCursor
+        start = time.perf_counter()
+        error = None
+        try:
+            async with conn.execute(query, params) as cursor:
+                return await getattr(cursor, fetch)()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            breaker.record((time.perf_counter() - start) * 1000, error)
+
+
+db = AsyncDB(backend.DB_PATH, ASYNC_DB_CONNECTIONS)
+
+
+# ===================== HELPERS =====================
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*'),
+            (b'x-request-id', (request_id_var.get() or '').encode()),
+            *headers,
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_error(send, message, status, retry_after):
+    await send_json(send, {'status': 'error', 'message': message}, status,
+                    [(b'retry-after', str(retry_after).encode())])
+
+
+def header(scope, name):
+    name = name.lower().encode()
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def query_arg(scope, name, default, cast):
+    values = parse_qs(scope['query_string'].decode('latin-1')).get(name)
+    try:
+        return cast(values[0]) if values else default
+    except ValueError:
+        return default
+
+
+def client_ip(scope):
+    """Same address ProxyFix gives the Flask routes"""
+    forwarded = [ip.strip() for ip in (header(scope, 'X-Forwarded-For') or '').split(',')]
+    hops = backend.TRUSTED_PROXY_HOPS
+    if hops and len(forwarded) >= hops and forwarded[-hops]:
+        return forwarded[-hops]
+    return scope['client'][0] if scope.get('client') else None
+
+
+def guarded(endpoint):
+    """Run an async route through the Flask app's throttle, auth, load shedding and breaker hooks"""
+    def wrap(handler):
+        async def route(scope, receive, send, **params):
+            # Per-IP before auth; per-user only for the verified telegram_id
+            retry_after = backend.rate_limiter.check(endpoint, [('ip', client_ip(scope))])
+            if retry_after:
+                return await send_error(send, 'Too many requests', 429, retry_after)
+            verified, telegram_id = authenticated(scope, params.get('telegram_id'))
+            if not verified:
+                return await send_json(send, *unauthorized())
+            if telegram_id is not None:
+                retry_after = backend.rate_limiter.check(endpoint, [('tg', str(telegram_id))])
+                if retry_after:
+                    return await send_error(send, 'Too many requests', 429, retry_after)
+
+            if not backend.load_shedder.enter():
+                return await send_error(send, 'Server busy, try again shortly', 503, 1)
+            try:
+                verdict = breaker.allow()
+                if not verdict:
+                    return await stale_or_unavailable(scope, send, endpoint)
+                try:
+                    return await handler(scope, receive, remember_reads(scope, send, endpoint), **params)
+                finally:
+                    if verdict == 'probe':
+                        breaker.release_probe()
+            finally:
+                backend.load_shedder.leave()
+        return route
+    return wrap
+
+
+def stale_key(scope):
+    """Key of app.stale_key() for the same request"""
+    key = f"{scope['path']}?{scope['query_string'].decode('latin-1')}"
+    return key + ('#v2' if accepts_compact_cards(header(scope, 'accept')) else '')
+
+
+async def stale_or_unavailable(scope, send, endpoint):
+    """While the breaker is open, answer cacheable reads from memory and fail the rest fast"""
+    entry = backend.stale_reads.get(stale_key(scope)) if endpoint in backend.STALE_READ_ENDPOINTS else None
+    if entry is None:
+        return await send_error(send, 'Database unavailable, try again shortly', 503, int(breaker.reset_timeout))
+    body, mimetype, stored_at = entry
+    await send_json(send, body, 200, [
+        (b'age', str(int(time.time() - stored_at)).encode()),
+        (b'warning', b'110 - "Response is Stale"'),
+    ])
+
+
+def remember_reads(scope, send, endpoint):
+    """Wrap send to keep the last good body of cacheable reads, like app.remember_reads"""
+    if endpoint not in backend.STALE_READ_ENDPOINTS:
+        return send
+    status = []
+
+    async def remembering_send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+        elif message['type'] == 'http.response.body' and status == [200]:
+            backend.stale_reads.put(stale_key(scope), message['body'], 'application/json')
+        await send(message)
+    return remembering_send
+
+
+def authenticated(scope, telegram_id=None):
+    """Same initData check the Flask authenticate() hook applies: (ok, telegram_id)"""
+    if not backend.REQUIRE_TELEGRAM_AUTH:
+        return True, telegram_id
+    verified = backend.init_data_verifier.verify(header(scope, 'X-Telegram-Init-Data'))
+    if verified is None or (telegram_id is not None and str(verified) != str(telegram_id)):
+        return False, None
+    return True, verified
+
+
+def unauthorized():
+    return {'status': 'error', 'message': 'Invalid or missing Telegram init data'}, 401
+
+
+# ===================== ASYNC ROUTES =====================
+
+async def telegram_webhook(scope, receive, send):
+    """Hand the update to the bot running on this same event loop"""
+    payload = json.loads(await read_body(receive))
+    update = Update.de_json(payload, backend.telegram_app.bot)
+    tag_update(update.update_id)
+    await backend.telegram_app.update_queue.put(update)
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b'OK'})
+
+
+@guarded('get_game_delta')
+async def game_delta(scope, receive, send, game_id):
+    """Async twin of app.get_game_delta; long-polling here holds no thread"""
+    game_id = int(game_id)
+    since_seq = query_arg(scope, 'since', 0, int)
+    since_version = query_arg(scope, 'version', 0, int)
+    wait = min(query_arg(scope, 'wait', 0.0, float), backend.DELTA_WAIT_MAX)
+    deadline = time.monotonic() + wait
+
+    while True:
+        async with db.connection() as conn:
+            game = await db.fetchone(conn, 'SELECT status, version FROM games WHERE id = ?', (game_id,))
+            if not game:
+                return await send_json(send, {'status': 'error', 'message': 'Game not found'}, 404)
+
+            if game['version'] != since_version or time.monotonic() >= deadline:
+                delta = {
+                    'status': 'success',
+                    'game_status': game['status'],
+                    'version': game['version'],
+                    'seq': since_seq,
+                    'numbers': [],
+                    'cards': []
+                }
+                if game['version'] != since_version:
+                    calls = await db.fetchall(conn, '''
+                        SELECT number, seq FROM called_numbers
+                        WHERE game_id = ? AND seq > ?
+                        ORDER BY seq
+                    ''', (game_id, since_seq))
+                    if calls:
+                        delta['numbers'] = [call['number'] for call in calls]
+                        delta['seq'] = calls[-1]['seq']
+                    cards = await db.fetchall(conn, '''
+                        SELECT id, card_data, marked_numbers FROM cards
+                        WHERE game_id = ? AND marks_version > ?
+                    ''', (game_id, since_version))
+                    compact = accepts_compact_cards(header(scope, 'accept'))
+                    delta['cards'] = [backend.marks_payload(card, compact) for card in cards]
+                return await send_json(send, delta)
+
+        # Release the connection while waiting for the next check
+        await asyncio.sleep(backend.DELTA_POLL_INTERVAL)
+
+
+@guarded('get_balance')
+async def wallet_balance(scope, receive, send, telegram_id):
+    """Async twin of app.get_balance"""
+    async with db.connection() as conn:
+        user = await db.fetchone(
+            conn, 'SELECT balance, bonus_balance FROM users WHERE telegram_id = ?', (int(telegram_id),)
+        )
+    if not user:
+        return await send_json(send, {'status': 'error', 'message': 'User not found'}, 404)
+    await send_json(send, {
+        'status': 'success',
+        'balance': user['balance'],
+        'bonus_balance': user['bonus_balance']
+    })
+
+
+ROUTES = [
+    ('POST', re.compile(r'^/telegram/webhook$'), telegram_webhook),
+    ('GET', re.compile(r'^/api/games/(?P<game_id>\d+)/delta$'), game_delta),
+    ('GET', re.compile(r'^/api/wallet/balance/(?P<telegram_id>\d+)$'), wallet_balance),
+]
+
+
+# ===================== LIFESPAN =====================
+
+async def lifespan(receive, send):
+    """Open the async DB pool and run the bot inside the server's event loop"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await db.open()
+            try:
+                await backend.telegram_app.initialize()
+                await backend.telegram_app.start()
+            except Exception:
+                # The API keeps serving even if Telegram is unreachable at boot
+                logger.exception('Telegram bot failed to start')
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if backend.telegram_app.running:
+                await backend.telegram_app.stop()
+                await backend.telegram_app.shutdown()
+            await db.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http':
+        for method, pattern, handler in ROUTES:
+            if scope['method'] == method:
+                match = pattern.match(scope['path'])
+                if match:
+                    bind_request_id(header(scope, 'X-Request-ID'))
+                    return await handler(scope, receive, send, **match.groupdict())
+
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,107 @@
+# assets.py - Build and serve frontend assets from memory
+# Assets are minified, fingerprinted and precompressed once at startup.
+import gzip
+import hashlib
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'
+
+MIME_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+}
+
+# Files referenced from index.html that get a content hash in their name
+FINGERPRINTED = ('script.js', 'style.css')
+
+
+def minify_js(source):
+    """Conservative minification: drop indentation, blank lines and line comments
+
+    Newlines are kept so automatic semicolon insertion behaves exactly as
+    in the original file.
+    """
+    lines = []
+    for line in source.splitlines():
+        stripped = line.strip()
+        if stripped and not stripped.startswith('//'):
+            lines.append(stripped)
+    return '\n'.join(lines)
+
+
+def minify_css(source):
+    """Drop comments and collapse whitespace"""
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};:,>])\s*', r'\1', source)
+    return source.replace(';}', '}').strip()
+
+
+MINIFIERS = {
+    '.js': minify_js,
+    '.css': minify_css,
+}
+
+
+class Asset:
+    """A built asset with its precompressed variants"""
+
+    def __init__(self, body, mimetype, cache_control):
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, 9)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body, quality=11)
+
+    def negotiate(self, accept_encoding):
+        """Pick the smallest variant the client accepts"""
+        accepted = {part.split(';')[0].strip() for part in (accept_encoding or '').split(',')}
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.variants:
+                return encoding, self.variants[encoding]
+        return 'identity', self.variants['identity']
+
+
+class AssetBundle:
+    """All frontend assets, keyed by the URL path they are served under"""
+
+    def __init__(self, frontend_dir):
+        self.frontend_dir = frontend_dir
+        self.assets = {}
+        self.build()
+
+    def build(self):
+        """Minify, fingerprint and compress every frontend asset"""
+        assets = {}
+        renames = {}
+
+        for name in FINGERPRINTED:
+            ext = os.path.splitext(name)[1]
+            with open(os.path.join(self.frontend_dir, name), encoding='utf-8') as f:
+                body = MINIFIERS[ext](f.read()).encode('utf-8')
+            digest = hashlib.sha256(body).hexdigest()[:10]
+            hashed_name = f'{name[:-len(ext)]}.{digest}{ext}'
+            renames[name] = hashed_name
+            assets[hashed_name] = Asset(body, MIME_TYPES[ext], IMMUTABLE_CACHE)
+            # The plain name still works for old cached pages, but must revalidate
+            assets[name] = Asset(body, MIME_TYPES[ext], REVALIDATE_CACHE)
+
+        with open(os.path.join(self.frontend_dir, 'index.html'), encoding='utf-8') as f:
+            html = f.read()
+        for name, hashed_name in renames.items():
+            html = html.replace(f'"{name}"', f'"{hashed_name}"')
+        assets['index.html'] = Asset(html.encode('utf-8'), MIME_TYPES['.html'], REVALIDATE_CACHE)
+
+        self.assets = assets
+
+    def get(self, path):
+        return self.assets.get(path)
@@ -0,0 +1,85 @@
+# auth.py - Telegram WebApp initData verification with a verified-identity cache
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+
+
+class InitDataVerifier:
+    """Verify Telegram WebApp initData and cache the resulting identity
+
+    The HMAC check and query-string parsing run once per initData value;
+    repeat requests from the same Mini App session are answered from a
+    bounded LRU keyed by a digest of the raw initData.
+    """
+
+    def __init__(self, bot_token, max_age=86400, cache_ttl=300, max_entries=10000):
+        # secret_key = HMAC_SHA256(key="WebAppData", msg=bot_token)
+        self._secret = hmac.new(b'WebAppData', (bot_token or '').encode(), hashlib.sha256).digest()
+        self.max_age = max_age
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, init_data):
+        """Return the verified telegram_id for initData, or None if invalid"""
+        if not init_data:
+            return None
+        key = hashlib.sha256(init_data.encode()).digest()
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[1] > now:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        telegram_id = self._check_signature(init_data)
+        if telegram_id is None:
+            return None
+
+        with self._lock:
+            self._cache[key] = (telegram_id, now + self.cache_ttl)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return telegram_id
+
+    def _check_signature(self, init_data):
+        """Full HMAC verification of initData (uncached path)"""
+        fields = dict(parse_qsl(init_data, keep_blank_values=True))
+        received_hash = fields.pop('hash', None)
+        if not received_hash:
+            return None
+
+        data_check_string = '\n'.join(f'{k}={fields[k]}' for k in sorted(fields))
+        expected = hmac.new(self._secret, data_check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, received_hash):
+            return None
+
+        try:
+            auth_date = int(fields.get('auth_date', 0))
+            user = json.loads(fields.get('user', '{}'))
+            telegram_id = int(user['id'])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if self.max_age and time.time() - auth_date > self.max_age:
+            return None
+        return telegram_id
+
+    def stats(self):
+        """Cache counters"""
+        with self._lock:
+            return {
+                'entries': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,291 @@
+# bench.py - Micro-benchmarks for backend hot paths
+# Usage: python bench.py <scenario> [options]
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from urllib.parse import urlencode
+
+
+def timed(fn, iterations):
+    """Run fn iterations times and return microseconds per call"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) * 1e6 / iterations
+
+
+def bench_auth(args):
+    """Per-request cost of initData verification, uncached vs cached"""
+    from auth import InitDataVerifier
+
+    token = '123456:bench-token'
+    fields = {
+        'auth_date': str(int(time.time())),
+        'query_id': 'AAHdF6IQAAAAAN0XohDhrOrc',
+        'user': json.dumps({'id': 279058397, 'first_name': 'Bench', 'username': 'bench'}),
+    }
+    secret = hmac.new(b'WebAppData', token.encode(), hashlib.sha256).digest()
+    check = '\n'.join(f'{k}={fields[k]}' for k in sorted(fields))
+    fields['hash'] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    init_data = urlencode(fields)
+
+    verifier = InitDataVerifier(token)
+    assert verifier.verify(init_data) == 279058397
+
+    uncached = timed(lambda: verifier._check_signature(init_data), args.iterations)
+    cached = timed(lambda: verifier.verify(init_data), args.iterations)
+    print(f'initData HMAC verify : {uncached:8.2f} us/request')
+    print(f'cached identity      : {cached:8.2f} us/request')
+
+
+def bench_longpoll(args):
+    """Concurrent long-polling clients a running server can hold at once
+
+    Point --url at the threaded server (gunicorn app:app) and then at the
+    ASGI one (uvicorn asgi:application) with the same game and compare.
+    """
+    import asyncio
+    import httpx
+
+    async def run():
+        limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+        async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.wait * 20 + 30) as client:
+            path = f'/api/games/{args.game}/delta'
+            version = (await client.get(path)).json()['version']
+
+            async def poll():
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path, params={'version': version, 'wait': args.wait})
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                return ok, time.perf_counter() - start
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(poll() for _ in range(args.clients)))
+            elapsed = time.perf_counter() - start
+
+        latencies = sorted(latency for ok, latency in results if ok)
+        failed = sum(1 for ok, _ in results if not ok)
+        print(f'clients     : {args.clients} (each waits {args.wait}s)')
+        print(f'completed   : {len(latencies)}  failed: {failed}')
+        print(f'wall time   : {elapsed:.2f}s')
+        if latencies:
+            print(f'latency p50 : {latencies[len(latencies) // 2]:.2f}s')
+            print(f'latency p99 : {latencies[int(len(latencies) * 0.99) - 1]:.2f}s')
+
+    asyncio.run(run())
+
+
+def bench_settle(args):
+    """Settling one room with --cards cards of which --winners win on the same call"""
+    from dashboard import create_dashboard_tables
+    from settlement import SettlementEngine, create_settlement_tables
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(f'{tmp}/bench.db')
+        conn.row_factory = sqlite3.Row
+        conn.executescript('''
+            CREATE TABLE users (id INTEGER PRIMARY KEY, balance REAL DEFAULT 0.0);
+            CREATE TABLE user_stats (user_id INTEGER PRIMARY KEY, games_won INTEGER DEFAULT 0,
+                                     total_winnings REAL DEFAULT 0.0, updated_at TIMESTAMP);
+            CREATE TABLE games (id INTEGER PRIMARY KEY, user_id INTEGER, stake_amount REAL, total_stake REAL,
+                                status TEXT, called_numbers TEXT, created_at TIMESTAMP, ended_at TIMESTAMP,
+                                winner_id INTEGER, version INTEGER DEFAULT 0);
+            CREATE TABLE cards (id INTEGER PRIMARY KEY, game_id INTEGER, user_id INTEGER, card_data TEXT,
+                                marked_numbers TEXT);
+            CREATE INDEX idx_cards_game_id ON cards (game_id);
+            CREATE TABLE transactions (id INTEGER PRIMARY KEY, user_id INTEGER, type TEXT, amount REAL,
+                                       method TEXT, status TEXT, created_at TIMESTAMP);
+            INSERT INTO users (id) VALUES (1);
+            INSERT INTO user_stats (user_id) VALUES (1);
+        ''')
+        create_dashboard_tables(conn.cursor())
+        create_settlement_tables(conn.cursor())
+
+        engine = SettlementEngine(house_cut=0.1)
+        rounds = max(1, min(args.iterations, 50))
+        for game_id in range(1, rounds + 1):
+            conn.execute('''
+                INSERT INTO games (id, user_id, stake_amount, status, called_numbers)
+                VALUES (?, 1, 10.0, 'playing', ?)
+            ''', (game_id, json.dumps(list(range(1, 76)))))
+            cards = []
+            for i in range(args.cards):
+                numbers = random.sample(range(1, 76), 25)
+                marked = numbers if i < args.winners else numbers[:24]
+                cards.append((game_id, json.dumps({'numbers': numbers}), json.dumps(marked)))
+            conn.executemany('INSERT INTO cards (game_id, card_data, marked_numbers) VALUES (?, ?, ?)', cards)
+        conn.commit()
+
+        start = time.perf_counter()
+        for game_id in range(1, rounds + 1):
+            settlement = engine.settle(conn, game_id)
+            assert len(settlement['payouts']) == args.winners
+        settle_ms = (time.perf_counter() - start) * 1000 / rounds
+
+        start = time.perf_counter()
+        for game_id in range(1, rounds + 1):
+            assert engine.settle(conn, game_id)['duplicate']
+        replay_ms = (time.perf_counter() - start) * 1000 / rounds
+        conn.close()
+
+    print(f'room        : {args.cards} cards, {args.winners} winners, {rounds} rooms')
+    print(f'settle      : {settle_ms:8.2f} ms/room')
+    print(f'claim replay: {replay_ms:8.2f} ms/room')
+
+
+def bench_faults(args):
+    """Fault injection: slow the DB and check breaker, stale reads and load shedding"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    tmp = tempfile.mkdtemp()
+    os.environ.update({
+        'DB_PATH': f'{tmp}/faults.db', 'TELEGRAM_BOT_TOKEN': os.environ.get('TELEGRAM_BOT_TOKEN', '1:bench'),
+        'REQUIRE_TELEGRAM_AUTH': '0', 'ENABLE_ROOM_SHARDING': '0', 'ENABLE_GAME_SWEEPER': '0',
+        'ENABLE_REFERRAL_PAYER': '0', 'LOG_LEVEL': 'ERROR', 'DB_BREAKER_SLOW_MS': '100',
+        'DB_BREAKER_FAILURES': '3', 'DB_BREAKER_RESET': '1', 'MAX_IN_FLIGHT': '4',
+    })
+    import app as backend
+    from resilience import breaker, faults
+
+    client = backend.app.test_client()
+    client.post('/api/users/register', json={'telegram_id': 42, 'username': 'bench', 'phone': '0900'})
+    balance = '/api/wallet/balance/42'
+    assert client.get(balance).status_code == 200
+
+    def check(label, ok):
+        print(f"{label:44s}: {'ok' if ok else 'FAILED'}")
+        return ok
+
+    results = []
+    faults.delay_ms = 150
+    start = time.perf_counter()
+    for _ in range(breaker.failure_threshold):
+        client.get(balance)
+    results.append(check('breaker opens after slow statements', breaker.state == 'open'))
+
+    response = client.get(balance)
+    results.append(check('cached balance served while open',
+                         response.status_code == 200 and 'Warning' in response.headers))
+    response = client.post('/api/wallet/deposit', json={'telegram_id': 42, 'amount': 5})
+    results.append(check('writes fail fast with 503 while open',
+                         response.status_code == 503 and 'Retry-After' in response.headers))
+    uncached = client.get('/api/users/42')
+    results.append(check('uncached reads fail fast while open', uncached.status_code == 503))
+
+    faults.delay_ms = 0
+    time.sleep(breaker.reset_timeout)
+    client.get(balance)
+    results.append(check('probe closes breaker once DB recovers', breaker.state == 'closed'))
+
+    faults.delay_ms = 50
+    breaker.slow_ms = 10000
+    with ThreadPoolExecutor(16) as pool:
+        statuses = list(pool.map(lambda _: backend.app.test_client().get(balance).status_code, range(64)))
+    faults.delay_ms = 0
+    shed = statuses.count(503)
+    results.append(check(f'load shed over MAX_IN_FLIGHT ({shed}/64 shed)', 0 < shed < 64))
+
+    faults.lock_rate = 1.0
+    response = client.post('/api/wallet/deposit', json={'telegram_id': 42, 'amount': 5})
+    faults.lock_rate = 0
+    results.append(check('lock timeouts surface as 503', response.status_code == 503))
+
+    print(f'elapsed {time.perf_counter() - start:.2f}s, breaker {dict(breaker.stats)}')
+    if not all(results):
+        raise SystemExit(1)
+
+
+def bench_matchmaking(args):
+    """Admission latency for N joiners arriving at once, for each N in --joiners
+
+    Every joiner buys one card in the same stake tier, so all of them contend
+    for one tier lock; rooms close every --room-size cards and are written to
+    a scratch database by the joiner that filled them.
+    """
+    import threading
+    from dashboard import create_dashboard_tables
+    from matchmaking import Matchmaker
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def get_db():
+            conn = sqlite3.connect(f'{tmp}/bench.db', timeout=30)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        conn = get_db()
+        conn.executescript('''
+            CREATE TABLE games (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, stake_amount REAL,
+                                total_stake REAL, status TEXT, cards_selected INTEGER, called_numbers TEXT,
+                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            CREATE TABLE cards (id INTEGER PRIMARY KEY AUTOINCREMENT, game_id INTEGER, user_id INTEGER,
+                                card_number INTEGER, card_data TEXT, marked_numbers TEXT);
+            CREATE TABLE transactions (id INTEGER PRIMARY KEY, user_id INTEGER, type TEXT, amount REAL,
+                                       method TEXT, status TEXT, created_at TIMESTAMP);
+        ''')
+        create_dashboard_tables(conn.cursor())
+        conn.commit()
+        conn.close()
+
+        threading.stack_size(256 * 1024)
+        print(f"{'joiners':>8} {'p50 us':>9} {'p99 us':>9} {'max us':>9} {'rooms':>6} {'start ms':>9}")
+        for joiners in args.joiners:
+            matchmaker = Matchmaker(get_db, tiers=(10,), room_size=args.room_size, max_wait=3600)
+            barrier = threading.Barrier(joiners)
+            latencies = [0.0] * joiners
+            starts = []
+
+            def join(i):
+                barrier.wait()
+                start = time.perf_counter()
+                _, _, closed = matchmaker.admit(10, i)
+                latencies[i] = time.perf_counter() - start
+                if closed is not None:
+                    start = time.perf_counter()
+                    matchmaker.start_room(closed)
+                    starts.append(time.perf_counter() - start)
+
+            threads = [threading.Thread(target=join, args=(i,)) for i in range(joiners)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            latencies.sort()
+            start_ms = sum(starts) * 1000 / len(starts) if starts else 0.0
+            print(f'{joiners:8d} {latencies[joiners // 2] * 1e6:9.1f} '
+                  f'{latencies[max(0, int(joiners * 0.99) - 1)] * 1e6:9.1f} {latencies[-1] * 1e6:9.1f} '
+                  f'{len(starts):6d} {start_ms:9.2f}')
+
+
+SCENARIOS = {
+    'auth': bench_auth,
+    'longpoll': bench_longpoll,
+    'settle': bench_settle,
+    'faults': bench_faults,
+    'matchmaking': bench_matchmaking,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backend micro-benchmarks')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('-n', '--iterations', type=int, default=100000)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--wait', type=float, default=2.0)
+    parser.add_argument('--game', type=int, default=1)
+    parser.add_argument('--cards', type=int, default=5000)
+    parser.add_argument('--winners', type=int, default=500)
+    parser.add_argument('--joiners', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--room-size', type=int, default=100)
+    args = parser.parse_args()
+    SCENARIOS[args.scenario](args)
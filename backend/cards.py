@@ -0,0 +1,92 @@
+# cards.py - Bingo card generation, win patterns and storage/wire encodings
+import base64
+import json
+import random
+
+NUMBER_RANGE = 75
+CARD_SIZE = 25
+GRID_WIDTH = 5
+
+# Grid positions (row * 5 + column) each pattern needs marked; a pattern with
+# several alternatives wins when any one of them is complete.
+_ROWS = [tuple(r * GRID_WIDTH + c for c in range(GRID_WIDTH)) for r in range(GRID_WIDTH)]
+_COLUMNS = [tuple(r * GRID_WIDTH + c for r in range(GRID_WIDTH)) for c in range(GRID_WIDTH)]
+_DIAGONALS = [tuple(i * GRID_WIDTH + i for i in range(GRID_WIDTH)),
+              tuple(i * GRID_WIDTH + GRID_WIDTH - 1 - i for i in range(GRID_WIDTH))]
+
+PATTERNS = {
+    'full': [tuple(range(CARD_SIZE))],
+    'line': _ROWS + _COLUMNS + _DIAGONALS,
+    'four_corners': [(0, GRID_WIDTH - 1, CARD_SIZE - GRID_WIDTH, CARD_SIZE - 1)],
+}
+
+# What check_bingo pays out on
+DEFAULT_PATTERN = 'full'
+
+
+# Clients that send this in Accept get compact cards (v2); others get v1 JSON
+CARD_FORMAT_V2 = 'application/vnd.bingo.v2+json'
+
+
+def card_from_numbers(numbers):
+    """The v1 card dict: the numbers, also laid out as a 5x5 grid"""
+    return {
+        'numbers': numbers,
+        'grid': [numbers[j * GRID_WIDTH:(j + 1) * GRID_WIDTH] for j in range(GRID_WIDTH)]
+    }
+
+
+def generate_card(rng=random):
+    """A card of 25 distinct numbers from 1-75, also laid out as a 5x5 grid"""
+    return card_from_numbers(rng.sample(range(1, NUMBER_RANGE + 1), CARD_SIZE))
+
+
+def encode_card(numbers):
+    """Card numbers in grid order as one byte each, base64 (36 characters)"""
+    return base64.b64encode(bytes(numbers)).decode('ascii')
+
+
+def decode_card(card_data):
+    """Card dict from stored card_data, compact or legacy JSON"""
+    if card_data.startswith('{'):
+        return json.loads(card_data)
+    return card_from_numbers(list(base64.b64decode(card_data)))
+
+
+def marked_mask(numbers, marked):
+    """Bitmask with bit i set when the number at grid position i is marked"""
+    marked = set(marked)
+    return sum(1 << i for i, number in enumerate(numbers) if number in marked)
+
+
+def accepts_compact_cards(accept):
+    return CARD_FORMAT_V2 in (accept or '')
+
+
+def card_payload(card_id, card_number, card_data, marked_numbers, compact):
+    """One stored card as sent to clients
+
+    v2: {'card': base64 numbers, 'marked': bitmask}; v1 keeps the original
+    JSON-string fields.
+    """
+    if compact:
+        numbers = decode_card(card_data)['numbers']
+        return {
+            'id': card_id,
+            'card_number': card_number,
+            'card': card_data if not card_data.startswith('{') else encode_card(numbers),
+            'marked': marked_mask(numbers, json.loads(marked_numbers))
+        }
+    return {
+        'id': card_id,
+        'card_number': card_number,
+        'card_data': card_data if card_data.startswith('{') else json.dumps(decode_card(card_data)),
+        'marked_numbers': marked_numbers
+    }
+
+
+def is_bingo(card_data, marked, pattern=DEFAULT_PATTERN):
+    """True once every position of some alternative of the pattern is marked"""
+    numbers = card_data['numbers']
+    marked = set(marked)
+    return any(all(numbers[i] in marked for i in positions) for positions in PATTERNS[pattern])
@@ -0,0 +1,50 @@
+# compression.py - Negotiated gzip/brotli compression for API responses
+import gzip
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+# Bodies smaller than this are sent as-is; compressing them costs more than it saves
+MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def negotiate_encoding(accept_encoding):
+    """Pick br or gzip from an Accept-Encoding header, or None"""
+    accepted = {part.split(';')[0].strip() for part in (accept_encoding or '').split(',')}
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress_response(response, accept_encoding):
+    """Compress a buffered JSON response in place when it is worth it"""
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    body = response.get_data()
+    if len(body) < MIN_SIZE:
+        return response
+
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is None:
+        return response
+
+    if encoding == 'br':
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        body = gzip.compress(body, GZIP_LEVEL)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
@@ -35,7 +35,7 @@ class Config:
 class DevelopmentConfig(Config):
     """Development configuration"""
     DEBUG = True
-    SQLALCHEMY_ECHO = True  # Log SQL queries
+    SQLALCHEMY_ECHO = False  # Echo is synchronous; slow queries are sampled by logs.SlowQueryLog
 
 
 class ProductionConfig(Config):
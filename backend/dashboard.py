@@ -0,0 +1,169 @@
+# dashboard.py - Operational aggregates maintained alongside every money movement
+#
+# Handlers update these rows inside their own transactions, so the admin
+# dashboard reads a handful of rows instead of scanning games or transactions.
+DASHBOARD_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS ops_gauges (
+        metric TEXT PRIMARY KEY,
+        count INTEGER NOT NULL DEFAULT 0,
+        amount REAL NOT NULL DEFAULT 0.0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS ops_daily (
+        day TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        amount REAL NOT NULL DEFAULT 0.0,
+        PRIMARY KEY (day, metric)
+    )
+    ''',
+    # Only pending withdrawals are indexed, so the review queue stays tiny
+    '''
+    CREATE INDEX IF NOT EXISTS idx_transactions_pending_withdrawals
+    ON transactions (id) WHERE type = 'withdraw' AND status = 'pending'
+    ''',
+]
+
+# Current values: games not yet finished, withdrawals awaiting review
+GAUGES = ('games_in_play', 'pending_withdrawals')
+
+# Per-day volumes
+DAILY_METRICS = (
+    'stakes', 'payouts', 'house_take', 'refunds', 'deposits',
+    'withdrawals_requested', 'withdrawals_approved', 'withdrawals_rejected'
+)
+
+DAILY_BACKFILL = {
+    'stakes': "SELECT date(created_at) AS day, COUNT(*) AS n, SUM(stake_amount) AS total FROM games GROUP BY 1",
+    'deposits': '''
+        SELECT date(created_at) AS day, COUNT(*) AS n, SUM(amount) AS total FROM transactions
+        WHERE type = 'deposit' GROUP BY 1
+    ''',
+    'withdrawals_requested': '''
+        SELECT date(created_at) AS day, COUNT(*) AS n, SUM(amount) AS total FROM transactions
+        WHERE type = 'withdraw' GROUP BY 1
+    ''',
+}
+
+
+def create_dashboard_tables(cursor):
+    """Create the aggregate tables, backfilling them from history the first time"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ops_gauges'")
+    backfill = cursor.fetchone() is None
+    for statement in DASHBOARD_SCHEMA:
+        cursor.execute(statement)
+    if not backfill:
+        return
+
+    cursor.execute('''
+        INSERT INTO ops_gauges (metric, count, amount)
+        SELECT 'games_in_play', COUNT(*), COALESCE(SUM(stake_amount), 0)
+        FROM games WHERE status IN ('created', 'playing')
+    ''')
+    cursor.execute('''
+        INSERT INTO ops_gauges (metric, count, amount)
+        SELECT 'pending_withdrawals', COUNT(*), COALESCE(SUM(amount), 0)
+        FROM transactions WHERE type = 'withdraw' AND status = 'pending'
+    ''')
+    for metric, query in DAILY_BACKFILL.items():
+        cursor.execute(f'''
+            INSERT INTO ops_daily (day, metric, count, amount)
+            SELECT day, ?, n, total FROM ({query})
+            WHERE day IS NOT NULL
+        ''', (metric,))
+
+
+def adjust_gauge(cursor, metric, count, amount):
+    cursor.execute('''
+        INSERT INTO ops_gauges (metric, count, amount) VALUES (?, ?, ?)
+        ON CONFLICT(metric) DO UPDATE SET
+            count = count + excluded.count,
+            amount = amount + excluded.amount
+    ''', (metric, count, amount))
+
+
+def track(cursor, metric, amount, count=1):
+    """Add to today's total for a daily metric"""
+    cursor.execute('''
+        INSERT INTO ops_daily (day, metric, count, amount) VALUES (date('now'), ?, ?, ?)
+        ON CONFLICT(day, metric) DO UPDATE SET
+            count = count + excluded.count,
+            amount = amount + excluded.amount
+    ''', (metric, count, amount))
+
+
+def snapshot(cursor, days=7):
+    """Gauges plus per-day and window totals for the last `days` days"""
+    cursor.execute('SELECT metric, count, amount FROM ops_gauges')
+    gauges = {metric: {'count': 0, 'amount': 0.0} for metric in GAUGES}
+    gauges.update({row['metric']: {'count': row['count'], 'amount': row['amount']} for row in cursor.fetchall()})
+
+    cursor.execute('''
+        SELECT day, metric, count, amount FROM ops_daily
+        WHERE day > date('now', ?)
+        ORDER BY day DESC
+    ''', (f'-{int(days)} days',))
+    daily = {}
+    totals = {metric: {'count': 0, 'amount': 0.0} for metric in DAILY_METRICS}
+    for row in cursor.fetchall():
+        daily.setdefault(row['day'], {})[row['metric']] = {'count': row['count'], 'amount': row['amount']}
+        total = totals.setdefault(row['metric'], {'count': 0, 'amount': 0.0})
+        total['count'] += row['count']
+        total['amount'] += row['amount']
+
+    return {'gauges': gauges, 'totals': totals, 'daily': daily}
+
+
+def review_withdrawals(conn, transaction_ids, approve, chunk_size=500):
+    """Approve or reject pending withdrawals in one transaction
+
+    Rejected withdrawals are refunded with one balance update per user, and
+    a 'refund' ledger row per withdrawal so history still adds up.
+    Ids that are unknown or no longer pending are skipped, so a batch can
+    safely be resubmitted.
+    """
+    transaction_ids = list(dict.fromkeys(transaction_ids))
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        withdrawals = []
+        for start in range(0, len(transaction_ids), chunk_size):
+            chunk = transaction_ids[start:start + chunk_size]
+            cursor.execute(f'''
+                SELECT id, user_id, amount FROM transactions
+                WHERE id IN ({','.join('?' * len(chunk))})
+                  AND type = 'withdraw' AND status = 'pending'
+            ''', chunk)
+            withdrawals.extend(cursor.fetchall())
+
+        status = 'completed' if approve else 'rejected'
+        cursor.executemany('UPDATE transactions SET status = ? WHERE id = ?',
+                           [(status, row['id']) for row in withdrawals])
+        if not approve:
+            refunds = {}
+            for row in withdrawals:
+                refunds[row['user_id']] = refunds.get(row['user_id'], 0.0) + row['amount']
+            cursor.executemany('UPDATE users SET balance = balance + ? WHERE id = ?',
+                               [(amount, user_id) for user_id, amount in refunds.items()])
+            cursor.executemany('''
+                INSERT INTO transactions (user_id, type, amount, method, status)
+                VALUES (?, 'refund', ?, ?, 'completed')
+            ''', [(row['user_id'], row['amount'], f"withdraw_{row['id']}") for row in withdrawals])
+
+        amount = sum(row['amount'] for row in withdrawals)
+        if withdrawals:
+            adjust_gauge(cursor, 'pending_withdrawals', -len(withdrawals), -amount)
+            track(cursor, 'withdrawals_approved' if approve else 'withdrawals_rejected', amount, len(withdrawals))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return {
+        'processed': len(withdrawals),
+        'skipped': len(transaction_ids) - len(withdrawals),
+        'amount': amount
+    }
@@ -0,0 +1,109 @@
+# idempotency.py - Replay completed responses for retried mutating requests
+#
+# Clients send an Idempotency-Key header with each logical write and reuse
+# it on retries. The first request with a key executes; its response is kept
+# for ttl seconds and replayed, without touching the database, to any retry.
+# Duplicates that arrive while the first is still running wait for it
+# instead of executing a second time.
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Response headers that belong to one particular HTTP exchange
+_EXCHANGE_HEADERS = {'content-length', 'x-request-id', 'date', 'server', 'set-cookie'}
+
+
+def fingerprint(method, path, body):
+    """Identify a request, so a key reused for a different request is caught"""
+    return hashlib.sha256(b'%s %s\n%s' % (method.encode(), path.encode(), body)).hexdigest()
+
+
+class _Entry:
+    __slots__ = ('fingerprint', 'created', 'done', 'response')
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.created = time.monotonic()
+        self.done = threading.Event()
+        self.response = None
+
+
+class IdempotencyStore:
+    """Bounded, TTL-evicted map of idempotency key -> in-flight or completed response"""
+
+    def __init__(self, ttl=86400, max_entries=50000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'executed': 0, 'replayed': 0, 'collapsed': 0, 'conflicts': 0, 'evicted': 0}
+
+    def _evict(self, now):
+        # Entries are kept in creation order, so expired ones are at the front.
+        # In-flight entries stay, since duplicates may be waiting on them.
+        in_flight = []
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if len(self._entries) + len(in_flight) <= self.max_entries and now - entry.created < self.ttl:
+                break
+            del self._entries[key]
+            if entry.done.is_set():
+                self.stats['evicted'] += 1
+            else:
+                in_flight.append((key, entry))
+        for key, entry in reversed(in_flight):
+            self._entries[key] = entry
+            self._entries.move_to_end(key, last=False)
+
+    def begin(self, key, request_fingerprint, wait=10.0):
+        """Claim key for this request
+
+        Returns ('execute', None) if the caller should run the request,
+        ('replay', (status, headers, body)) if an earlier one already
+        completed, ('conflict', None) if the key was used for a different
+        request, or ('busy', None) if the earlier one is still running
+        after waiting `wait` seconds.
+        """
+        deadline = time.monotonic() + wait
+        collapsed = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._evict(now)
+                entry = self._entries.get(key)
+                if entry is None:
+                    self._entries[key] = _Entry(request_fingerprint)
+                    self.stats['executed'] += 1
+                    return 'execute', None
+                if entry.fingerprint != request_fingerprint:
+                    self.stats['conflicts'] += 1
+                    return 'conflict', None
+                if entry.done.is_set():
+                    self.stats['replayed'] += 1
+                    return 'replay', entry.response
+            if not collapsed:
+                self.stats['collapsed'] += 1
+                collapsed = True
+            # Wait for the first request; if it is abandoned the key is free again
+            if not entry.done.wait(max(0.0, deadline - time.monotonic())):
+                return 'busy', None
+
+    def complete(self, key, status, headers, body):
+        """Store the response of the request that claimed key and wake any duplicates"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry.response = (status, [(k, v) for k, v in headers if k.lower() not in _EXCHANGE_HEADERS], body)
+        entry.done.set()
+
+    def abandon(self, key):
+        """Forget a claimed key whose request failed, so a retry runs it again"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.done.set()
+
+    def __len__(self):
+        return len(self._entries)
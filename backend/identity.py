@@ -0,0 +1,74 @@
+# identity.py - In-process telegram_id -> user_id resolution cache
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserIdCache:
+    """Bounded LRU mapping telegram_id to users.id
+
+    A registered user's id never changes, so positive entries never go
+    stale. Unknown telegram_ids are cached too (as None) for a short TTL,
+    since another worker may register them in the meantime.
+    """
+
+    def __init__(self, max_entries=100000, negative_ttl=30):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def resolve(self, cursor, telegram_id):
+        """Return the user_id for telegram_id, or None if not registered"""
+        key = str(telegram_id)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                user_id, expires = entry
+                if user_id is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return user_id
+                if expires > now:
+                    self.negative_hits += 1
+                    return None
+            self.misses += 1
+
+        cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
+        row = cursor.fetchone()
+        user_id = row['id'] if row else None
+        self._store(key, user_id, now + self.negative_ttl)
+        return user_id
+
+    def remember(self, telegram_id, user_id):
+        """Record a newly registered user, replacing any negative entry"""
+        self._store(str(telegram_id), user_id, 0)
+
+    def invalidate(self, telegram_id):
+        """Drop any cached entry for telegram_id"""
+        with self._lock:
+            self._entries.pop(str(telegram_id), None)
+
+    def _store(self, key, user_id, expires):
+        with self._lock:
+            self._entries[key] = (user_id, expires)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Hit/miss counters; every hit is a users lookup that was skipped"""
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,124 @@
+# importer.py - Bulk user registration from CSV or JSONL
+# Usage: python importer.py users.csv [--format csv|jsonl] [--chunk-size 1000] [--db bingo.db]
+#
+# Rows are streamed, so the file is never held in memory, and inserted with
+# executemany in chunked transactions. Users that already exist (same
+# telegram_id or username) are skipped by ON CONFLICT DO NOTHING.
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import time
+
+from referrals import make_referral_code
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(__file__), 'bingo.db')
+WELCOME_BONUS = 10.0
+
+INSERT_USER = '''
+    INSERT INTO users (telegram_id, username, phone, name, referral_code, balance)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT DO NOTHING
+'''
+
+
+def read_rows(stream, fmt):
+    """Yield one dict per user from a text stream"""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    elif fmt == 'jsonl':
+        for line in stream:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    else:
+        raise ValueError(f'Unknown format: {fmt}')
+
+
+def user_params(row):
+    """Parameters for INSERT_USER, or None if the row is missing required fields"""
+    if not isinstance(row, dict):
+        return None
+    try:
+        telegram_id = int(row.get('telegram_id'))
+        # Only a missing or blank balance gets the bonus; an explicit 0 stays 0
+        balance = row.get('balance')
+        balance = WELCOME_BONUS if balance is None or balance == '' else float(balance)
+    except (TypeError, ValueError):
+        return None
+    username = (row.get('username') or '').strip()
+    phone = (row.get('phone') or '').strip()
+    if not username or not phone:
+        return None
+    name = (row.get('name') or '').strip() or username
+    return (telegram_id, username, phone, name, make_referral_code(telegram_id), balance)
+
+
+def import_users(conn, rows, chunk_size=1000):
+    """Insert users chunk by chunk; returns counts and throughput"""
+    stats = {'rows': 0, 'inserted': 0, 'skipped': 0, 'invalid': 0}
+    start = time.perf_counter()
+    cursor = conn.cursor()
+    chunk = []
+
+    def flush():
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.executemany(INSERT_USER, chunk)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        stats['inserted'] += cursor.rowcount
+        stats['skipped'] += len(chunk) - cursor.rowcount
+        chunk.clear()
+
+    for row in rows:
+        stats['rows'] += 1
+        params = user_params(row)
+        if params is None:
+            stats['invalid'] += 1
+            continue
+        chunk.append(params)
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    elapsed = time.perf_counter() - start
+    stats['seconds'] = round(elapsed, 3)
+    stats['rows_per_sec'] = round(stats['rows'] / elapsed) if elapsed else stats['rows']
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import users from CSV or JSONL')
+    parser.add_argument('path', help='input file, or - for stdin')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='defaults to the file extension')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='rows per transaction')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    args = parser.parse_args()
+
+    fmt = args.format or ('jsonl' if args.path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    try:
+        if args.path == '-':
+            stream = io.TextIOWrapper(os.fdopen(0, 'rb'), encoding='utf-8', newline='')
+        else:
+            stream = open(args.path, encoding='utf-8', newline='')
+        with stream:
+            stats = import_users(conn, read_rows(stream, fmt), args.chunk_size)
+    finally:
+        conn.close()
+
+    print(f"{stats['rows']} rows: {stats['inserted']} inserted, {stats['skipped']} already registered, "
+          f"{stats['invalid']} invalid in {stats['seconds']}s ({stats['rows_per_sec']} rows/sec)")
+
+
+if __name__ == '__main__':
+    main()
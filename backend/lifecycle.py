@@ -0,0 +1,263 @@
+# lifecycle.py - Background expiry, refund and archival of finished games
+# Usage: python lifecycle.py vacuum [--db bingo.db]   (offline maintenance)
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from dashboard import adjust_gauge, track
+
+ACTIVE_STATUSES = ('created', 'playing')
+FINISHED_STATUSES = ('won', 'expired', 'refunded')
+
+logger = logging.getLogger('bingo.lifecycle')
+
+DEFAULT_DB_PATH = os.environ.get('DB_PATH', os.path.join(os.path.dirname(__file__), 'bingo.db'))
+
+ARCHIVE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS games_archive (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        stake_amount REAL NOT NULL,
+        status TEXT,
+        cards_selected INTEGER,
+        called_numbers TEXT,
+        created_at TIMESTAMP,
+        ended_at TIMESTAMP,
+        winner_id INTEGER,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        total_stake REAL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS cards_archive (
+        id INTEGER PRIMARY KEY,
+        game_id INTEGER NOT NULL,
+        card_number INTEGER,
+        card_data TEXT,
+        marked_numbers TEXT,
+        user_id INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS called_numbers_archive (
+        id INTEGER PRIMARY KEY,
+        game_id INTEGER NOT NULL,
+        number INTEGER NOT NULL,
+        seq INTEGER,
+        called_at TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_games_archive_user_id_created_at ON games_archive (user_id, created_at)',
+]
+
+
+def create_archive_tables(cursor):
+    """Create the cold tables finished games are moved into"""
+    for statement in ARCHIVE_SCHEMA:
+        cursor.execute(statement)
+
+
+class GameSweeper:
+    """Periodically expires idle games, refunds unplayed stakes and archives old games
+
+    Runs on a daemon thread so request workers never wait on it. Every
+    pass takes SQLite's write lock up front (BEGIN IMMEDIATE), so sweepers
+    running in several gunicorn workers serialize instead of settling the
+    same game twice.
+    """
+
+    def __init__(self, get_db, idle_timeout=1800, archive_after=86400,
+                 interval=60, batch_size=500, vacuum_pages=200):
+        self.get_db = get_db
+        self.idle_timeout = idle_timeout
+        self.archive_after = archive_after
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'runs': 0, 'expired': 0, 'refunded': 0, 'archived': 0, 'errors': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='game-sweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception('game sweep failed')
+
+    def sweep(self):
+        """One full pass: expire, archive, then reclaim free pages"""
+        conn = self.get_db()
+        try:
+            self.expire_idle_games(conn)
+            self.archive_finished_games(conn)
+            conn.execute(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)})').fetchall()
+            self.stats['runs'] += 1
+        finally:
+            conn.close()
+
+    def expire_idle_games(self, conn):
+        """Close games with no calls, marks or card selection for idle_timeout, in one transaction
+
+        Games that never had a number called get their stake back; games
+        abandoned mid-play are closed as expired and the stake is kept.
+        """
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cutoff = f'-{int(self.idle_timeout)} seconds'
+            cursor.execute(f'''
+                SELECT g.id, g.user_id, g.stake_amount, COALESCE(g.total_stake, g.stake_amount) AS staked,
+                       EXISTS (SELECT 1 FROM called_numbers c WHERE c.game_id = g.id) AS started
+                FROM games g
+                WHERE g.status IN ({','.join('?' * len(ACTIVE_STATUSES))})
+                  AND g.created_at < datetime('now', ?)
+                  AND (g.last_active_at IS NULL OR g.last_active_at < datetime('now', ?))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM called_numbers c
+                      WHERE c.game_id = g.id AND c.called_at >= datetime('now', ?)
+                  )
+                LIMIT ?
+            ''', (*ACTIVE_STATUSES, cutoff, cutoff, cutoff, self.batch_size))
+            games = cursor.fetchall()
+
+            refunds = [game for game in games if not game['started']]
+            expired = [game for game in games if game['started']]
+
+            cursor.executemany('''
+                UPDATE games SET status = 'refunded', ended_at = CURRENT_TIMESTAMP, version = version + 1
+                WHERE id = ?
+            ''', [(game['id'],) for game in refunds])
+            cursor.executemany('''
+                UPDATE games SET status = 'expired', ended_at = CURRENT_TIMESTAMP, version = version + 1
+                WHERE id = ?
+            ''', [(game['id'],) for game in expired])
+            credits = self.refund_credits(cursor, refunds)
+            cursor.executemany('UPDATE users SET balance = balance + ? WHERE id = ?',
+                               [(amount, user_id) for _, user_id, amount in credits])
+            cursor.executemany('''
+                INSERT INTO transactions (user_id, type, amount, method, status)
+                VALUES (?, 'refund', ?, ?, 'completed')
+            ''', [(user_id, amount, f'game_{game_id}') for game_id, user_id, amount in credits])
+
+            if games:
+                adjust_gauge(cursor, 'games_in_play', -len(games), -sum(game['staked'] for game in games))
+            if refunds:
+                track(cursor, 'refunds', sum(amount for _, _, amount in credits), len(refunds))
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        self.stats['refunded'] += len(refunds)
+        self.stats['expired'] += len(expired)
+        return len(games)
+
+    def refund_credits(self, cursor, games):
+        """(game_id, user_id, amount) to pay back for each unplayed game
+
+        A single-player game refunds its stake to its player; a shared room
+        refunds the stake of every card to the card's buyer.
+        """
+        credits = []
+        for game in games:
+            cursor.execute('''
+                SELECT user_id, COUNT(*) AS cards FROM cards
+                WHERE game_id = ? AND user_id IS NOT NULL
+                GROUP BY user_id
+            ''', (game['id'],))
+            buyers = cursor.fetchall()
+            if buyers:
+                credits.extend((game['id'], row['user_id'], game['stake_amount'] * row['cards']) for row in buyers)
+            else:
+                credits.append((game['id'], game['user_id'], game['stake_amount']))
+        return credits
+
+    def archive_finished_games(self, conn):
+        """Move finished games older than archive_after, with their cards and calls, to cold tables"""
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute(f'''
+                SELECT id FROM games
+                WHERE status IN ({','.join('?' * len(FINISHED_STATUSES))})
+                  AND ended_at < datetime('now', ?)
+                LIMIT ?
+            ''', (*FINISHED_STATUSES, f'-{int(self.archive_after)} seconds', self.batch_size))
+            game_ids = [(row['id'],) for row in cursor.fetchall()]
+
+            cursor.executemany('''
+                INSERT OR IGNORE INTO games_archive
+                    (id, user_id, stake_amount, total_stake, status, cards_selected, called_numbers,
+                     created_at, ended_at, winner_id)
+                SELECT id, user_id, stake_amount, total_stake, status, cards_selected, called_numbers,
+                       created_at, ended_at, winner_id
+                FROM games WHERE id = ?
+            ''', game_ids)
+            cursor.executemany('''
+                INSERT OR IGNORE INTO cards_archive (id, game_id, user_id, card_number, card_data, marked_numbers)
+                SELECT id, game_id, user_id, card_number, card_data, marked_numbers
+                FROM cards WHERE game_id = ?
+            ''', game_ids)
+            cursor.executemany('''
+                INSERT OR IGNORE INTO called_numbers_archive (id, game_id, number, seq, called_at)
+                SELECT id, game_id, number, seq, called_at
+                FROM called_numbers WHERE game_id = ?
+            ''', game_ids)
+            cursor.executemany('DELETE FROM called_numbers WHERE game_id = ?', game_ids)
+            cursor.executemany('DELETE FROM cards WHERE game_id = ?', game_ids)
+            cursor.executemany('DELETE FROM games WHERE id = ?', game_ids)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        self.stats['archived'] += len(game_ids)
+        return len(game_ids)
+
+
+def enable_incremental_vacuum(conn):
+    """Switch a database to incremental auto-vacuum; VACUUM rewrites the whole file"""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return False
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline maintenance of the game database')
+    parser.add_argument('command', choices=('vacuum',),
+                        help='vacuum: enable incremental auto-vacuum (stop the app first)')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    try:
+        start = time.perf_counter()
+        changed = enable_incremental_vacuum(conn)
+    finally:
+        conn.close()
+    if changed:
+        print(f'{args.db}: incremental auto-vacuum enabled in {time.perf_counter() - start:.1f}s')
+    else:
+        print(f'{args.db}: incremental auto-vacuum already enabled')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# logs.py - JSON-lines logging through a background queue, with request IDs
+#
+# Request threads only enqueue log records; formatting and writing happen on
+# a listener thread, and records are dropped (and counted) rather than
+# blocking if the queue is full. Every record carries the request ID of the
+# API request or Telegram update it was logged under.
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+# Incoming X-Request-ID values are only trusted if they look like an ID
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# LogRecord attributes that are not user-supplied extra fields
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'request_id'}
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def bind_request_id(request_id=None):
+    """Set the request ID for the current thread or task and return it"""
+    if not request_id or not REQUEST_ID_PATTERN.match(request_id):
+        request_id = new_request_id()
+    request_id_var.set(request_id)
+    return request_id
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the request ID of the code that logged them"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; extra= fields are included as top-level keys"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_listener = None
+
+
+def configure_logging(level='INFO', queue_size=10000, stream=None):
+    """Route all logging through one background JSON writer (idempotent)"""
+    global _handler, _listener
+    if _handler is not None:
+        return _handler
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    _handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _handler.addFilter(RequestIdFilter())
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [_handler]
+    root.setLevel(level)
+    return _handler
+
+
+def logging_stats():
+    return {
+        'queued': _handler.queue.qsize() if _handler else 0,
+        'dropped': _handler.dropped if _handler else 0,
+        'slow_queries': dict(slow_queries.stats),
+    }
+
+
+# ===================== TELEGRAM UPDATES =====================
+
+_update_request_ids = OrderedDict()
+_update_lock = threading.Lock()
+
+
+def tag_update(update_id, max_pending=10000):
+    """Remember which webhook request delivered an update"""
+    with _update_lock:
+        _update_request_ids[update_id] = request_id_var.get()
+        if len(_update_request_ids) > max_pending:
+            _update_request_ids.popitem(last=False)
+
+
+def bind_update(update_id):
+    """Adopt the request ID of the webhook call that delivered update_id"""
+    with _update_lock:
+        request_id = _update_request_ids.pop(update_id, None)
+    return bind_request_id(request_id)
+
+
+# ===================== SLOW QUERIES =====================
+
+class SlowQueryLog:
+    """Log a sample of queries slower than threshold_ms"""
+
+    def __init__(self, threshold_ms=100.0, sample_rate=1.0):
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.logger = logging.getLogger('bingo.sql')
+        self.stats = {'slow': 0, 'logged': 0}
+
+    def observe(self, sql, elapsed_ms, rows):
+        if elapsed_ms < self.threshold_ms:
+            return
+        self.stats['slow'] += 1
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        self.stats['logged'] += 1
+        self.logger.warning('slow query', extra={
+            'sql': ' '.join(sql.split())[:500],
+            'duration_ms': round(elapsed_ms, 2),
+            'rows': rows,
+        })
+
+
+slow_queries = SlowQueryLog()
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement's duration to the slow query log
+
+    execute() covers preparing the statement and stepping to the first row,
+    which is where sorting, grouping and writes spend their time; rows
+    fetched afterwards are not timed.
+    """
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            slow_queries.observe(sql, (time.perf_counter() - start) * 1000, self.rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            slow_queries.observe(sql, (time.perf_counter() - start) * 1000, self.rowcount)
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection whose cursors are timed; pass as sqlite3.connect(factory=...)"""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
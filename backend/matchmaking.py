@@ -0,0 +1,335 @@
+# matchmaking.py - Shared game rooms, one open room per stake tier
+#
+# Each tier has exactly one open room, guarded by its own lock, so joins on
+# different tiers never contend and a join is a couple of appends under the
+# lock. Stakes are charged before a player is admitted. The join that fills
+# a room, or the ticker once its first player has waited max_wait, swaps in
+# a fresh room under the lock and then writes the closed room to the
+# database as one game, outside the lock, so admission never waits on SQLite.
+#
+# Each paid stake is a pending 'stake' transaction until its room starts, so
+# stakes held by a worker that dies before starting the room are refunded.
+# Started rooms have their numbers called by the ticker, on whichever worker
+# runs it first; the check and the call share one write transaction.
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from cards import encode_card, generate_card
+from dashboard import adjust_gauge, track
+
+logger = logging.getLogger('bingo.matchmaking')
+
+# games.user_id of shared rooms, which belong to no single player
+HOUSE_USER_ID = 0
+
+MATCHMAKING_SCHEMA = [
+    # Only pending stakes are indexed, so the abandoned-stake check stays cheap
+    '''
+    CREATE INDEX IF NOT EXISTS idx_transactions_pending_stakes
+    ON transactions (created_at) WHERE type = 'stake' AND status = 'pending'
+    ''',
+]
+
+
+def create_matchmaking_tables(cursor):
+    for statement in MATCHMAKING_SCHEMA:
+        cursor.execute(statement)
+
+
+class Room:
+    """An open or started room; tickets are (user_id, cards, stake_id) in join order"""
+    __slots__ = ('id', 'stake', 'opened_at', 'tickets', 'cards', 'game_id', 'card_ids', 'error', 'started')
+
+    def __init__(self, room_id, stake):
+        self.id = room_id
+        self.stake = stake
+        self.opened_at = None
+        self.tickets = []
+        self.cards = 0
+        self.game_id = None
+        self.card_ids = None
+        self.error = None
+        self.started = threading.Event()
+
+    def to_dict(self):
+        return {
+            'room_id': self.id,
+            'stake': self.stake,
+            'players': len(self.tickets),
+            'cards': self.cards,
+            'started': self.started.is_set() and self.error is None,
+            'game_id': self.game_id,
+        }
+
+
+class Matchmaker:
+    """Admit paid tickets into the open room of their stake tier"""
+
+    def __init__(self, get_db, tiers=(10, 20, 25, 30, 50), room_size=100, max_wait=30.0,
+                 interval=1.0, max_rooms=1000, call_interval=3, abandon_after=600):
+        self.get_db = get_db
+        self.room_size = room_size
+        self.max_wait = max_wait
+        self.interval = interval
+        self.max_rooms = max_rooms
+        self.call_interval = call_interval
+        self.abandon_after = abandon_after
+        self._ids = itertools.count(1)
+        self._locks = {stake: threading.Lock() for stake in tiers}
+        self._open = {}
+        self._rooms = OrderedDict()
+        self._rooms_lock = threading.Lock()
+        for stake in tiers:
+            self._open[stake] = self._new_room(stake)
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'admitted': 0, 'cards_sold': 0, 'rooms_started': 0, 'start_failures': 0,
+                      'numbers_called': 0, 'abandoned_refunds': 0}
+
+    @property
+    def tiers(self):
+        return sorted(self._locks)
+
+    def _new_room(self, stake):
+        room = Room(next(self._ids), stake)
+        with self._rooms_lock:
+            self._rooms[room.id] = room
+            if len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+        return room
+
+    def room(self, room_id):
+        with self._rooms_lock:
+            return self._rooms.get(room_id)
+
+    def admit(self, stake, user_id, cards=1, stake_id=None):
+        """Add a ticket to the tier's open room
+
+        stake_id is the pending 'stake' transaction the caller wrote when
+        charging for the ticket. Returns (room, ticket, closed): closed is
+        the room this join filled (or found overdue), which the caller must
+        hand to start_room().
+        """
+        card_data = [generate_card() for _ in range(cards)]
+        with self._locks[stake]:
+            room = self._open[stake]
+            ticket = len(room.tickets)
+            room.tickets.append((user_id, card_data, stake_id))
+            room.cards += cards
+            if room.opened_at is None:
+                room.opened_at = time.monotonic()
+            self.stats['admitted'] += 1
+            self.stats['cards_sold'] += cards
+
+            closed = None
+            if room.cards >= self.room_size or time.monotonic() - room.opened_at >= self.max_wait:
+                closed = room
+                self._open[stake] = self._new_room(stake)
+        return room, ticket, closed
+
+    def close_overdue(self):
+        """Close every room whose first player has waited max_wait"""
+        closed = []
+        now = time.monotonic()
+        for stake, lock in self._locks.items():
+            with lock:
+                room = self._open[stake]
+                if room.opened_at is not None and now - room.opened_at >= self.max_wait:
+                    closed.append(room)
+                    self._open[stake] = self._new_room(stake)
+        return closed
+
+    def start_room(self, room):
+        """Write a closed room as one game in play, with every player's cards"""
+        conn = self.get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            total_stake = room.stake * room.cards
+            cursor.execute('''
+                INSERT INTO games (user_id, stake_amount, total_stake, status, cards_selected, called_numbers)
+                VALUES (?, ?, ?, 'playing', ?, '[]')
+            ''', (HOUSE_USER_ID, room.stake, total_stake, room.cards))
+            game_id = cursor.lastrowid
+
+            # The stakes now back a game; any refunded as abandoned void the start
+            stake_ids = [(f'game_{game_id}', stake_id) for _, _, stake_id in room.tickets if stake_id is not None]
+            cursor.executemany('''
+                UPDATE transactions SET status = 'completed', method = ? WHERE id = ? AND status = 'pending'
+            ''', stake_ids)
+            if stake_ids and cursor.rowcount != len(stake_ids):
+                raise RuntimeError('room stakes were already refunded')
+
+            # Card ids are needed per ticket, so cards go in one at a time
+            card_ids = []
+            for user_id, card_data, _ in room.tickets:
+                ids = []
+                for i, card in enumerate(card_data):
+                    cursor.execute('''
+                        INSERT INTO cards (game_id, user_id, card_number, card_data, marked_numbers)
+                        VALUES (?, ?, ?, ?, '[]')
+                    ''', (game_id, user_id, i + 1, encode_card(card['numbers'])))
+                    ids.append(cursor.lastrowid)
+                card_ids.append(ids)
+
+            adjust_gauge(cursor, 'games_in_play', 1, total_stake)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            self.stats['start_failures'] += 1
+            room.error = 'Room could not be started'
+            logger.exception('room start failed', extra={'room_id': room.id, 'stake': room.stake})
+            self._refund(room)
+            room.started.set()
+            raise
+        finally:
+            conn.close()
+
+        room.game_id = game_id
+        room.card_ids = card_ids
+        room.started.set()
+        self.stats['rooms_started'] += 1
+        logger.info('room started', extra={
+            'room_id': room.id, 'game_id': game_id, 'stake': room.stake,
+            'players': len(room.tickets), 'cards': room.cards
+        })
+        return game_id
+
+    def _refund(self, room):
+        """Give back the stakes of a room that could not be started"""
+        stakes = [(stake_id, user_id, room.stake * len(card_data))
+                  for user_id, card_data, stake_id in room.tickets if stake_id is not None]
+        conn = self.get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            refund_stakes(cursor, stakes)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception('room refund failed', extra={'room_id': room.id})
+        finally:
+            conn.close()
+
+    def refund_abandoned(self):
+        """Refund stakes still pending after abandon_after, whose room died with its worker"""
+        conn = self.get_db()
+        try:
+            cursor = conn.cursor()
+            cutoff = f'-{int(self.abandon_after)} seconds'
+            query = '''
+                SELECT id, user_id, amount FROM transactions
+                WHERE type = 'stake' AND status = 'pending' AND created_at < datetime('now', ?)
+            '''
+            if cursor.execute(query, (cutoff,)).fetchone() is None:
+                return 0
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute(query, (cutoff,))
+                refunded = refund_stakes(cursor, [tuple(row) for row in cursor.fetchall()])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        finally:
+            conn.close()
+        self.stats['abandoned_refunds'] += refunded
+        if refunded:
+            logger.warning('refunded abandoned stakes', extra={'stakes': refunded})
+        return refunded
+
+    def call_numbers(self):
+        """Call the next number in every shared room whose last call is call_interval old"""
+        conn = self.get_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM games WHERE user_id = ? AND status = 'playing'", (HOUSE_USER_ID,))
+            called = sum(self._call_next(conn, row['id']) for row in cursor.fetchall())
+        finally:
+            conn.close()
+        self.stats['numbers_called'] += called
+        return called
+
+    def _call_next(self, conn, game_id):
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-checked under the write lock, so workers racing on one room call once
+            cursor.execute('''
+                SELECT called_numbers FROM games g
+                WHERE id = ? AND status = 'playing' AND NOT EXISTS (
+                    SELECT 1 FROM called_numbers c
+                    WHERE c.game_id = g.id AND c.called_at > datetime('now', ?)
+                )
+            ''', (game_id, f'-{int(self.call_interval)} seconds'))
+            game = cursor.fetchone()
+            called_numbers = json.loads(game['called_numbers']) if game else []
+            available = [n for n in range(1, 76) if n not in called_numbers]
+            if not game or not available:
+                conn.rollback()
+                return 0
+            called_numbers.append(random.choice(available))
+            cursor.execute('''
+                UPDATE games SET called_numbers = ?, version = version + 1, last_active_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (json.dumps(called_numbers), game_id))
+            cursor.execute('INSERT INTO called_numbers (game_id, number, seq) VALUES (?, ?, ?)',
+                           (game_id, called_numbers[-1], len(called_numbers)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return 1
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='matchmaker', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for room in self.close_overdue():
+                try:
+                    self.start_room(room)
+                except Exception:
+                    pass  # logged and refunded by start_room
+            try:
+                self.call_numbers()
+                self.refund_abandoned()
+            except Exception:
+                logger.exception('matchmaker tick failed')
+
+    def snapshot(self):
+        open_rooms = {}
+        for stake, lock in self._locks.items():
+            with lock:
+                room = self._open[stake]
+                open_rooms[stake] = {'room_id': room.id, 'players': len(room.tickets), 'cards': room.cards}
+        return {'open': open_rooms, 'stats': dict(self.stats)}
+
+
+def refund_stakes(cursor, stakes):
+    """Refund (stake_id, user_id, amount) stakes that are still pending; returns how many were"""
+    refunds = []
+    for stake_id, user_id, amount in stakes:
+        cursor.execute("UPDATE transactions SET status = 'refunded' WHERE id = ? AND status = 'pending'",
+                       (stake_id,))
+        if cursor.rowcount:
+            refunds.append((stake_id, user_id, amount))
+    cursor.executemany('UPDATE users SET balance = balance + ? WHERE id = ?',
+                       [(amount, user_id) for _, user_id, amount in refunds])
+    cursor.executemany('''
+        INSERT INTO transactions (user_id, type, amount, method, status)
+        VALUES (?, 'refund', ?, ?, 'completed')
+    ''', [(user_id, amount, f'stake_{stake_id}') for stake_id, user_id, amount in refunds])
+    if refunds:
+        track(cursor, 'refunds', sum(amount for _, _, amount in refunds), len(refunds))
+    return len(refunds)
@@ -0,0 +1,102 @@
+# rate_limit.py - In-memory token bucket rate limiting for hot endpoints
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Per-endpoint limits: endpoint name -> (tokens refilled per second, bucket size)
+DEFAULT_LIMITS = {
+    'call_number': (2.0, 5),
+    'mark_number': (5.0, 20),
+    'check_bingo': (1.0, 5),
+    'select_cards': (0.5, 3),
+    'create_game': (0.5, 5),
+    'join_room': (0.5, 5),
+    'register_user': (0.2, 3),
+    'deposit': (0.5, 5),
+    'withdraw': (0.2, 3),
+    'transfer': (0.2, 3),
+}
+
+
+class TokenBucket:
+    """A single token bucket, refilled lazily when checked"""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, capacity, now):
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def refill(self, rate, capacity, now):
+        """Add the tokens earned since the last check"""
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class RateLimiter:
+    """Token buckets keyed by (endpoint, client key), bounded in size"""
+
+    def __init__(self, limits=None, max_buckets=50000):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._allowed = {}
+        self._throttled = {}
+
+    def configure(self, endpoint, rate, capacity):
+        """Set or replace the limit for an endpoint"""
+        with self._lock:
+            self.limits[endpoint] = (rate, capacity)
+
+    def check(self, endpoint, keys):
+        """Take a token for every key; return 0 if allowed, else seconds to wait"""
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            return 0
+        rate, capacity = limit
+        now = time.monotonic()
+
+        with self._lock:
+            buckets = [self._bucket((endpoint, key), capacity, now) for key in keys]
+            for bucket in buckets:
+                bucket.refill(rate, capacity, now)
+
+            # Only consume when every bucket has a token, so a throttled
+            # request does not also drain the buckets that still had room
+            empty = [bucket for bucket in buckets if bucket.tokens < 1]
+            if empty:
+                self._throttled[endpoint] = self._throttled.get(endpoint, 0) + 1
+                deficit = max(1 - bucket.tokens for bucket in empty)
+                return max(1, math.ceil(deficit / rate))
+
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self._allowed[endpoint] = self._allowed.get(endpoint, 0) + 1
+            return 0
+
+    def _bucket(self, key, capacity, now):
+        """Get or create a bucket, evicting the least recently used one when full"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(capacity, now)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def stats(self):
+        """Counters of allowed and throttled requests per endpoint"""
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'endpoints': {
+                    endpoint: {
+                        'allowed': self._allowed.get(endpoint, 0),
+                        'throttled': self._throttled.get(endpoint, 0)
+                    }
+                    for endpoint in self.limits
+                }
+            }
@@ -0,0 +1,134 @@
+# referrals.py - Referral attribution and batched bonus payouts
+import logging
+import secrets
+import threading
+
+logger = logging.getLogger('bingo.referrals')
+
+REFERRAL_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS referral_bonuses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referrer_id INTEGER NOT NULL,
+        referee_id INTEGER NOT NULL UNIQUE,
+        amount REAL NOT NULL,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        paid_at TIMESTAMP,
+        FOREIGN KEY (referrer_id) REFERENCES users(id),
+        FOREIGN KEY (referee_id) REFERENCES users(id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)',
+    'CREATE INDEX IF NOT EXISTS idx_referral_bonuses_status ON referral_bonuses (status, referrer_id)',
+]
+
+
+def make_referral_code(telegram_id):
+    """Referral code that cannot collide: telegram_id is already unique
+
+    The random suffix only keeps codes from being guessed from an ID.
+    """
+    return f'ref_{telegram_id}_{secrets.token_hex(3)}'
+
+
+def create_referral_tables(cursor):
+    for statement in REFERRAL_SCHEMA:
+        cursor.execute(statement)
+
+
+def attribute_referral(cursor, user_id, telegram_id, referral_code, bonus):
+    """Link a newly registered user to their referrer, inside the caller's transaction
+
+    Bumps the referrer's referral_count and queues a pending bonus; the
+    bonus itself is credited later by ReferralPayer. Returns the
+    referrer's user id, or None if the code is unknown or self-referral.
+    """
+    if not referral_code:
+        return None
+    cursor.execute('SELECT id, telegram_id FROM users WHERE referral_code = ?', (referral_code,))
+    referrer = cursor.fetchone()
+    if not referrer or str(referrer['telegram_id']) == str(telegram_id):
+        return None
+
+    cursor.execute('UPDATE users SET referred_by = ? WHERE id = ?', (referrer['id'], user_id))
+    cursor.execute('UPDATE users SET referral_count = referral_count + 1 WHERE id = ?', (referrer['id'],))
+    cursor.execute('''
+        INSERT OR IGNORE INTO referral_bonuses (referrer_id, referee_id, amount)
+        VALUES (?, ?, ?)
+    ''', (referrer['id'], user_id, bonus))
+    return referrer['id']
+
+
+class ReferralPayer:
+    """Periodically credits pending referral bonuses in one batched transaction
+
+    All pending bonuses are summed per referrer, so a referrer who brought
+    in a hundred players during a spike gets one balance update and one
+    ledger row per pass rather than a hundred.
+    """
+
+    def __init__(self, get_db, interval=300, batch_size=5000):
+        self.get_db = get_db
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'runs': 0, 'bonuses_paid': 0, 'referrers_credited': 0, 'errors': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='referral-payer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.pay()
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception('referral payout failed')
+
+    def pay(self):
+        """Credit up to batch_size pending bonuses; returns how many were paid"""
+        conn = self.get_db()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT id, referrer_id, amount FROM referral_bonuses
+                WHERE status = 'pending'
+                ORDER BY id
+                LIMIT ?
+            ''', (self.batch_size,))
+            bonuses = cursor.fetchall()
+
+            totals = {}
+            for bonus in bonuses:
+                totals[bonus['referrer_id']] = totals.get(bonus['referrer_id'], 0.0) + bonus['amount']
+
+            cursor.executemany('UPDATE users SET bonus_balance = bonus_balance + ? WHERE id = ?',
+                               [(amount, referrer_id) for referrer_id, amount in totals.items()])
+            cursor.executemany('''
+                INSERT INTO transactions (user_id, type, amount, method, status)
+                VALUES (?, 'referral_bonus', ?, 'referral', 'completed')
+            ''', list(totals.items()))
+            cursor.executemany('''
+                UPDATE referral_bonuses SET status = 'paid', paid_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', [(bonus['id'],) for bonus in bonuses])
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        self.stats['runs'] += 1
+        self.stats['bonuses_paid'] += len(bonuses)
+        self.stats['referrers_credited'] += len(totals)
+        return len(bonuses)
@@ -0,0 +1,197 @@
+# resilience.py - Circuit breaking, load shedding and fault injection around SQLite
+#
+# Every statement runs through GuardedCursor. Lock timeouts and very slow
+# statements count as failures; after enough consecutive failures the
+# breaker opens, and the app fails writes fast and answers cached reads from
+# memory until a probe request finds the database healthy again.
+import contextvars
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from logs import TracedConnection, TracedCursor
+
+# Set when a statement in the current request hit a lock timeout
+db_fault_var = contextvars.ContextVar('db_fault', default=False)
+
+# Set in the request the half-open breaker let through as its probe
+probe_var = contextvars.ContextVar('breaker_probe', default=False)
+
+
+def is_lock_error(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+class CircuitBreaker:
+    """Closed -> open after failure_threshold consecutive failures -> half-open after reset_timeout
+
+    While half-open one probe request at a time is let through; its outcome
+    closes the breaker or opens it for another reset_timeout. Statements from
+    anywhere else (background jobs included) can open it but never close it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0, slow_ms=1000.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_ms = slow_ms
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'failures': 0, 'rejected': 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """True if a database request may go ahead, 'probe' if it is the half-open trial"""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probing:
+                self._probing = True
+                probe_var.set(True)
+                return 'probe'
+            self.stats['rejected'] += 1
+            return False
+
+    def record(self, elapsed_ms, error=None):
+        failed = (error is not None and is_lock_error(error)) or elapsed_ms >= self.slow_ms
+        if not failed and error is not None:
+            return
+        with self._lock:
+            probe = probe_var.get() and self._probing
+            if failed:
+                self.stats['failures'] += 1
+                self._failures += 1
+                if probe or (self._opened_at is None and self._failures >= self.failure_threshold):
+                    self._opened_at = time.monotonic()
+                    self.stats['opened'] += 1
+            elif probe or self._opened_at is None:
+                self._failures = 0
+                self._opened_at = None
+            if probe:
+                self._probing = False
+        if probe:
+            probe_var.set(False)
+
+    def release_probe(self):
+        """End a probe request that never reached the database"""
+        probe_var.set(False)
+        with self._lock:
+            self._probing = False
+
+
+class FaultInjector:
+    """Artificial DB slowness and lock errors, for exercising the breaker"""
+
+    def __init__(self, delay_ms=0.0, lock_rate=0.0):
+        self.delay_ms = delay_ms
+        self.lock_rate = lock_rate
+
+    @property
+    def active(self):
+        return self.delay_ms > 0 or self.lock_rate > 0
+
+    def apply(self):
+        if self.delay_ms > 0:
+            time.sleep(self.delay_ms / 1000)
+        if self.lock_rate > 0 and random.random() < self.lock_rate:
+            raise sqlite3.OperationalError('database is locked (injected)')
+
+
+breaker = CircuitBreaker()
+faults = FaultInjector()
+
+
+class GuardedCursor(TracedCursor):
+    """Timed cursor that also feeds the circuit breaker"""
+
+    def _guarded(self, run, sql, parameters):
+        start = time.perf_counter()
+        error = None
+        try:
+            if faults.active:
+                faults.apply()
+            return run(sql, parameters)
+        except Exception as e:
+            error = e
+            if is_lock_error(e):
+                db_fault_var.set(True)
+            raise
+        finally:
+            breaker.record((time.perf_counter() - start) * 1000, error)
+
+    def execute(self, sql, parameters=()):
+        return self._guarded(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._guarded(super().executemany, sql, seq_of_parameters)
+
+
+class GuardedConnection(TracedConnection):
+    def cursor(self, factory=GuardedCursor):
+        return super().cursor(factory)
+
+
+class LoadShedder:
+    """Reject new requests once max_in_flight are already being served"""
+
+    def __init__(self, max_in_flight=64):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self.stats = {'shed': 0, 'peak': 0}
+
+    def enter(self):
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.stats['shed'] += 1
+                return False
+            self.in_flight += 1
+            self.stats['peak'] = max(self.stats['peak'], self.in_flight)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class StaleCache:
+    """Last good response bodies for reads that may be served while the DB is down"""
+
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'served': 0, 'missed': 0}
+
+    def put(self, key, body, mimetype):
+        with self._lock:
+            self._entries[key] = (body, mimetype, time.time())
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Return (body, mimetype, stored_at) or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            self.stats['served' if entry else 'missed'] += 1
+            return entry
+
+    def __len__(self):
+        return len(self._entries)
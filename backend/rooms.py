@@ -0,0 +1,255 @@
+# rooms.py - Route each game to one owner worker and keep its live state in memory
+#
+# Under gunicorn every worker is a separate process. Each worker listens on
+# a Unix socket in a shared directory; the set of live sockets forms a
+# consistent-hash ring over game_id. A request for a game that lands on a
+# worker that does not own it is forwarded to the owner over its socket, so
+# the owner's in-memory room state sees every change to its games.
+import atexit
+import bisect
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response
+
+# WSGI environ keys set on forwarded requests (cannot be sent by HTTP clients)
+FORWARDED_KEY = 'bingo.room_forwarded'
+TELEGRAM_ID_KEY = 'bingo.telegram_id'
+
+HOP_BY_HOP_HEADERS = {'host', 'content-length', 'connection'}
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes"""
+
+    def __init__(self, nodes=(), replicas=64):
+        self.nodes = sorted(nodes)
+        points = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class RoomStore:
+    """In-memory called numbers and version of the games this worker owns
+
+    Entries expire after ttl seconds so out-of-band writes (the lifecycle
+    sweeper, or a request handled locally after a failed forward) are
+    picked up; callers also guard writes with the cached version.
+    """
+
+    def __init__(self, ttl=30, max_rooms=10000):
+        self.ttl = ttl
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, game_id):
+        """Return (called_numbers, version) or None"""
+        with self._lock:
+            entry = self._rooms.get(game_id)
+            if entry is None or entry[2] < time.monotonic():
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(game_id)
+            self.hits += 1
+            return list(entry[0]), entry[1]
+
+    def put(self, game_id, called_numbers, version):
+        with self._lock:
+            self._rooms[game_id] = (list(called_numbers), version, time.monotonic() + self.ttl)
+            self._rooms.move_to_end(game_id)
+            if len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+
+    def bump(self, game_id):
+        """Record a version increment made by another handler on this worker"""
+        with self._lock:
+            entry = self._rooms.get(game_id)
+            if entry is not None:
+                self._rooms[game_id] = (entry[0], entry[1] + 1, entry[2])
+
+    def drop(self, game_id):
+        with self._lock:
+            self._rooms.pop(game_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rooms), 'hits': self.hits, 'misses': self.misses}
+
+
+def send_frame(sock, meta, body):
+    """Send a length-prefixed JSON header followed by a length-prefixed body"""
+    header = json.dumps(meta).encode()
+    sock.sendall(struct.pack('!II', len(header), len(body)) + header + body)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise ConnectionError('room socket closed mid-frame')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    header_len, body_len = struct.unpack('!II', _recv_exact(sock, 8))
+    meta = json.loads(_recv_exact(sock, header_len))
+    return meta, _recv_exact(sock, body_len)
+
+
+def _gateway_error(status, message):
+    return Response(json.dumps({'status': 'error', 'message': message}), status=status,
+                    mimetype='application/json')
+
+
+class _OwnerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class RoomRouter:
+    """Consistent-hash routing of game requests to the owning worker"""
+
+    def __init__(self, app, socket_dir, refresh_interval=2.0, timeout=30.0):
+        self.app = app
+        self.socket_dir = socket_dir
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.node = None
+        self.ring = HashRing()
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+        self.stats = {'local': 0, 'forwarded': 0, 'served_for_peers': 0, 'forward_failures': 0,
+                      'forward_errors': 0, 'forward_timeouts': 0}
+
+    def start(self):
+        """Listen on this worker's socket and join the ring"""
+        os.makedirs(self.socket_dir, exist_ok=True)
+        self.node = f'worker-{os.getpid()}.sock'
+        path = os.path.join(self.socket_dir, self.node)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        router = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                router._serve(self.request)
+
+        server = _OwnerServer(path, Handler)
+        threading.Thread(target=server.serve_forever, name='room-owner', daemon=True).start()
+        atexit.register(self._leave, path)
+        self._refresh()
+
+    def _leave(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _refresh(self):
+        try:
+            nodes = sorted(name for name in os.listdir(self.socket_dir) if name.endswith('.sock'))
+        except OSError:
+            nodes = []
+        with self._lock:
+            if nodes != self.ring.nodes:
+                self.ring = HashRing(nodes)
+            self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def owner(self, game_id):
+        if time.monotonic() >= self._next_refresh:
+            self._refresh()
+        return self.ring.owner(game_id)
+
+    def is_local(self, game_id):
+        if self.node is None:
+            return True
+        owner = self.owner(game_id)
+        return owner is None or owner == self.node
+
+    def forward(self, game_id, request, telegram_id=None):
+        """Proxy the request to the game's owner; None means handle it locally
+
+        Only a request that never reached the owner is handled locally.
+        Once it has been sent, the owner may already have run it, so a
+        lost or late reply is a 502/504 for the client to retry.
+        """
+        if self.is_local(game_id):
+            self.stats['local'] += 1
+            return None
+
+        node = self.owner(game_id)
+        meta = {
+            'method': request.method,
+            'path': request.path,
+            'query_string': request.query_string.decode('latin-1'),
+            'headers': [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS],
+            'telegram_id': telegram_id,
+            'remote_addr': request.remote_addr,
+        }
+        path = os.path.join(self.socket_dir, node)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Owner died or is restarting: drop its socket and rebalance
+                self.stats['forward_failures'] += 1
+                self._leave(path)
+                self._refresh()
+                return None
+            except OSError:
+                # Owner is alive but not accepting; nothing was sent yet
+                self.stats['forward_failures'] += 1
+                return None
+            try:
+                send_frame(sock, meta, request.get_data())
+                reply, body = recv_frame(sock)
+            except TimeoutError:
+                self.stats['forward_timeouts'] += 1
+                return _gateway_error(504, 'Game server timed out')
+            except OSError:
+                self.stats['forward_errors'] += 1
+                return _gateway_error(502, 'Game server closed the connection')
+
+        self.stats['forwarded'] += 1
+        return Response(body, status=reply['status'], headers=reply['headers'])
+
+    def _serve(self, sock):
+        """Run a forwarded request through the app on this (owner) worker"""
+        meta, body = recv_frame(sock)
+        client = self.app.test_client()
+        response = client.open(
+            meta['path'],
+            method=meta['method'],
+            query_string=meta['query_string'],
+            headers=meta['headers'],
+            data=body,
+            environ_base={FORWARDED_KEY: True, TELEGRAM_ID_KEY: meta['telegram_id'],
+                          'REMOTE_ADDR': meta.get('remote_addr') or '127.0.0.1'}
+        )
+        self.stats['served_for_peers'] += 1
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS]
+        send_frame(sock, {'status': response.status_code, 'headers': headers}, response.get_data())
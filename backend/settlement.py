@@ -0,0 +1,166 @@
+# settlement.py - Pay out a won game to every winning card at once
+import json
+import math
+
+from cards import decode_card, is_bingo
+from dashboard import adjust_gauge, track
+
+SETTLEMENT_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS settlements (
+        game_id INTEGER PRIMARY KEY,
+        pot REAL NOT NULL,
+        house_take REAL NOT NULL,
+        winners INTEGER NOT NULL,
+        settled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (game_id) REFERENCES games(id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS payouts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        game_id INTEGER NOT NULL,
+        card_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        UNIQUE (game_id, card_id),
+        FOREIGN KEY (game_id) REFERENCES games(id),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+]
+
+
+def create_settlement_tables(cursor):
+    for statement in SETTLEMENT_SCHEMA:
+        cursor.execute(statement)
+
+
+def split_pot(pot, house_cut, winners):
+    """Return (share per winner, house take); odd cents go to the house"""
+    if winners == 0:
+        return 0.0, 0.0
+    net = pot * (1 - house_cut)
+    share = math.floor(round(net * 100 / winners, 6)) / 100
+    return share, round(pot - share * winners, 2)
+
+
+class SettlementEngine:
+    """Settle a game's pot across all of its winning cards in one transaction
+
+    Every card completed when the claim is processed shares the pot, so
+    simultaneous winners on the same call are paid together. The settlements
+    row is written in the same transaction as the payouts, which makes
+    repeated or concurrent claims for a game return the original result
+    instead of paying again.
+
+    A shared room's pot is the total its players staked; a single-player
+    game's is its stake times pot_multiplier.
+    """
+
+    def __init__(self, house_cut=0.0, pot_multiplier=2.0):
+        self.house_cut = house_cut
+        self.pot_multiplier = pot_multiplier
+        self.stats = {'settled': 0, 'duplicate_claims': 0, 'winners_paid': 0}
+
+    def settle(self, conn, game_id):
+        """Settle game_id and return its settlement, or None if it is not in play"""
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            settlement = self._load(cursor, game_id)
+            if settlement is not None:
+                conn.rollback()
+                self.stats['duplicate_claims'] += 1
+                return settlement
+
+            cursor.execute('''
+                SELECT user_id, stake_amount, total_stake, status, called_numbers FROM games WHERE id = ?
+            ''', (game_id,))
+            game = cursor.fetchone()
+            if not game or game['status'] != 'playing':
+                conn.rollback()
+                return None
+
+            # Cards in shared rooms belong to their buyer, otherwise to the game's player
+            cursor.execute('''
+                SELECT id, COALESCE(user_id, ?) AS user_id, card_data, marked_numbers
+                FROM cards WHERE game_id = ? ORDER BY id
+            ''', (game['user_id'], game_id))
+            # Marks only count for numbers that were actually called
+            called = set(json.loads(game['called_numbers'] or '[]'))
+            winning_cards = [
+                (card['id'], card['user_id']) for card in cursor.fetchall()
+                if is_bingo(decode_card(card['card_data']), called.intersection(json.loads(card['marked_numbers'])))
+            ]
+            if not winning_cards:
+                conn.rollback()
+                return None
+
+            if game['total_stake'] is not None:
+                pot = game['total_stake']
+            else:
+                pot = game['stake_amount'] * self.pot_multiplier
+            share, house_take = split_pot(pot, self.house_cut, len(winning_cards))
+            payouts = [(game_id, card_id, user_id, share) for card_id, user_id in winning_cards]
+
+            totals = {}
+            for _, _, user_id, amount in payouts:
+                totals[user_id] = totals.get(user_id, 0.0) + amount
+
+            cursor.execute('''
+                INSERT INTO settlements (game_id, pot, house_take, winners)
+                VALUES (?, ?, ?, ?)
+            ''', (game_id, pot, house_take, len(payouts)))
+            cursor.executemany('''
+                INSERT INTO payouts (game_id, card_id, user_id, amount) VALUES (?, ?, ?, ?)
+            ''', payouts)
+            cursor.executemany('UPDATE users SET balance = balance + ? WHERE id = ?',
+                               [(amount, user_id) for user_id, amount in totals.items()])
+            cursor.executemany('''
+                INSERT INTO transactions (user_id, type, amount, method, status)
+                VALUES (?, 'winnings', ?, 'game', 'completed')
+            ''', list(totals.items()))
+            cursor.executemany('''
+                UPDATE user_stats
+                SET games_won = games_won + 1,
+                    total_winnings = total_winnings + ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            ''', [(amount, user_id) for user_id, amount in totals.items()])
+            cursor.execute('''
+                UPDATE games SET status = 'won', ended_at = CURRENT_TIMESTAMP, winner_id = ?, version = version + 1
+                WHERE id = ?
+            ''', (payouts[0][2], game_id))
+            adjust_gauge(cursor, 'games_in_play', -1, -(game['total_stake'] or game['stake_amount']))
+            track(cursor, 'payouts', pot - house_take, len(payouts))
+            track(cursor, 'house_take', house_take)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        self.stats['settled'] += 1
+        self.stats['winners_paid'] += len(payouts)
+        return {
+            'game_id': game_id,
+            'pot': pot,
+            'house_take': house_take,
+            'payouts': {card_id: amount for _, card_id, _, amount in payouts},
+            'duplicate': False
+        }
+
+    def _load(self, cursor, game_id):
+        cursor.execute('SELECT pot, house_take FROM settlements WHERE game_id = ?', (game_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute('SELECT card_id, amount FROM payouts WHERE game_id = ?', (game_id,))
+        return {
+            'game_id': game_id,
+            'pot': row['pot'],
+            'house_take': row['house_take'],
+            'payouts': {payout['card_id']: payout['amount'] for payout in cursor.fetchall()},
+            'duplicate': True
+        }
@@ -0,0 +1,150 @@
+# simulate.py - Offline simulation of calls-to-first-win for large rooms
+# Usage: python simulate.py --cards 1000 --games 1000000 [--pattern full|line|four_corners|all]
+#                           [--workers 4] [--verify 2000]
+#
+# Games are simulated in NumPy batches: a random call order gives every
+# number the call at which it comes up, so a card is complete at the latest
+# call among the positions of its pattern and the room's first win is the
+# earliest of those. Card shape and patterns come from cards.py, payouts
+# from the settlement engine's split_pot, and --verify replays games through
+# the server's own generate_card/is_bingo to check the vectorized model.
+#
+# Requires numpy, which the server itself does not need.
+import argparse
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cards import CARD_SIZE, NUMBER_RANGE, PATTERNS, generate_card, is_bingo
+from settlement import split_pot
+
+# Cap on card cells held in memory per batch, per worker
+BATCH_CELLS = 1 << 24
+
+
+def simulate_chunk(job):
+    """Simulate games of one room size; returns (first-win histogram, winners histogram)"""
+    games, cards, pattern, seed = job
+    rng = np.random.default_rng(seed)
+    alternatives = np.array(PATTERNS[pattern])
+    first_hist = np.zeros(NUMBER_RANGE + 1, dtype=np.int64)
+    winner_hist = np.zeros(cards + 1, dtype=np.int64)
+    batch = max(1, BATCH_CELLS // (cards * NUMBER_RANGE))
+
+    for start in range(0, games, batch):
+        size = min(batch, games - start)
+        # call_at[g, n] = call (1-75) at which number n + 1 comes up in game g
+        order = rng.permuted(np.tile(np.arange(NUMBER_RANGE, dtype=np.int8), (size, 1)), axis=1)
+        call_at = np.empty((size, NUMBER_RANGE), dtype=np.int8)
+        np.put_along_axis(call_at, order.astype(np.intp),
+                          np.broadcast_to(np.arange(1, NUMBER_RANGE + 1, dtype=np.int8), order.shape), axis=1)
+
+        # Cards are CARD_SIZE distinct numbers in grid order, like generate_card()
+        deck = rng.permuted(np.tile(np.arange(NUMBER_RANGE, dtype=np.int8), (size * cards, 1)), axis=1)
+        deck = deck[:, :CARD_SIZE].reshape(size, cards, CARD_SIZE)
+        called = call_at[np.arange(size)[:, None, None], deck]
+
+        complete = called[:, :, alternatives].max(axis=3).min(axis=2)
+        first = complete.min(axis=1)
+        winners = (complete == first[:, None]).sum(axis=1)
+
+        first_hist += np.bincount(first, minlength=NUMBER_RANGE + 1)
+        winner_hist += np.bincount(winners, minlength=cards + 1)
+
+    return first_hist, winner_hist
+
+
+def simulate(games, cards, pattern, workers=1, seed=None):
+    """Spread games over a process pool and merge the histograms"""
+    chunks = max(1, workers * 4) if workers > 1 else 1
+    seeds = np.random.SeedSequence(seed).spawn(chunks)
+    jobs = [(games // chunks + (i < games % chunks), cards, pattern, seeds[i]) for i in range(chunks)]
+    jobs = [job for job in jobs if job[0]]
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(simulate_chunk, jobs))
+    else:
+        results = [simulate_chunk(job) for job in jobs]
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def simulate_reference(games, cards, pattern, seed=None):
+    """Slow path through the server's own card and win-check code"""
+    rng = random.Random(seed)
+    first_hist = np.zeros(NUMBER_RANGE + 1, dtype=np.int64)
+    winner_hist = np.zeros(cards + 1, dtype=np.int64)
+    for _ in range(games):
+        room = [generate_card(rng) for _ in range(cards)]
+        calls = rng.sample(range(1, NUMBER_RANGE + 1), NUMBER_RANGE)
+        for count in range(1, NUMBER_RANGE + 1):
+            winners = sum(is_bingo(card, calls[:count], pattern) for card in room)
+            if winners:
+                first_hist[count] += 1
+                winner_hist[winners] += 1
+                break
+    return first_hist, winner_hist
+
+
+def percentile(hist, q):
+    return int(np.searchsorted(np.cumsum(hist), q * hist.sum()))
+
+
+def report(pattern, cards, first_hist, winner_hist, elapsed, args):
+    games = int(first_hist.sum())
+    calls = np.arange(len(first_hist))
+    counts = np.arange(len(winner_hist))
+    mean_calls = (calls * first_hist).sum() / games
+    mean_winners = (counts * winner_hist).sum() / games
+
+    pot = args.stake * args.multiplier
+    shares = {n: split_pot(pot, args.house_cut, n) for n in np.nonzero(winner_hist)[0]}
+    house_take = sum(winner_hist[n] * shares[n][1] for n in shares) / games
+    winner_share = sum(winner_hist[n] * shares[n][0] for n in shares) / games
+
+    print(f'pattern {pattern}, {cards} cards, {games} games')
+    print(f'  throughput       : {games / elapsed:,.0f} games/s ({games * cards / elapsed:,.0f} cards/s)')
+    print(f'  calls to 1st win : mean {mean_calls:.2f}  p5 {percentile(first_hist, 0.05)}  '
+          f'p50 {percentile(first_hist, 0.5)}  p95 {percentile(first_hist, 0.95)}')
+    print(f'  winners at 1st   : mean {mean_winners:.3f}  P(split) {winner_hist[2:].sum() / games:.3f}')
+    print(f'  payout           : pot {pot:.2f}, {winner_share:.2f} to each winner, '
+          f'house {house_take:.4f} per game')
+
+    peak = first_hist.max()
+    for call in range(percentile(first_hist, 0.001), percentile(first_hist, 0.999) + 1):
+        bar = '#' * int(round(50 * first_hist[call] / peak))
+        print(f'  {call:3d} {first_hist[call] / games:7.4f} {bar}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate calls-to-first-win for rooms of N cards')
+    parser.add_argument('--cards', type=int, default=100, help='cards in play per room')
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--pattern', choices=sorted(PATTERNS) + ['all'], default='full')
+    parser.add_argument('--workers', type=int, default=1, help='processes to spread games over')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--stake', type=float, default=1.0)
+    parser.add_argument('--multiplier', type=float, default=2.0, help='pot as a multiple of the stake')
+    parser.add_argument('--house-cut', type=float, default=0.0)
+    parser.add_argument('--verify', type=int, default=0, metavar='GAMES',
+                        help='also replay GAMES games through generate_card/is_bingo and compare')
+    args = parser.parse_args()
+
+    patterns = sorted(PATTERNS) if args.pattern == 'all' else [args.pattern]
+    for pattern in patterns:
+        start = time.perf_counter()
+        first_hist, winner_hist = simulate(args.games, args.cards, pattern, args.workers, args.seed)
+        report(pattern, args.cards, first_hist, winner_hist, time.perf_counter() - start, args)
+
+        if args.verify:
+            ref_first, _ = simulate_reference(args.verify, args.cards, pattern, args.seed)
+            calls = np.arange(len(ref_first))
+            print(f'  reference mean   : {(calls * ref_first).sum() / ref_first.sum():.2f} '
+                  f'over {args.verify} games through cards.is_bingo')
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,45 @@
 # telegram_bot.py
 
+import logging
 import os
+import re
+from urllib.parse import urlencode
 from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, WebAppInfo
+from telegram.ext import Application, CommandHandler, ContextTypes, TypeHandler
+
+from logs import bind_update
 
 load_dotenv()
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 WEBAPP_URL = os.getenv("WEBAPP_URL")
 
+logger = logging.getLogger("bingo.bot")
+
+# Deep-link payloads look like ref_<telegram_id>_<suffix>
+REFERRAL_CODE = re.compile(r"^ref_[A-Za-z0-9_]{1,48}$")
+
+def webapp_url(referral_code=None):
+    """Web app URL, carrying the referral code through to registration"""
+    if not referral_code:
+        return WEBAPP_URL
+    separator = "&" if "?" in WEBAPP_URL else "?"
+    return f"{WEBAPP_URL}{separator}{urlencode({'ref': referral_code})}"
+
 async def start(update, context: ContextTypes.DEFAULT_TYPE):
+    # /start ref_123_4567 when opened through a referral link
+    payload = context.args[0] if context.args else None
+    referral_code = payload if payload and REFERRAL_CODE.match(payload) else None
+    logger.info("start command", extra={
+        "telegram_id": update.effective_user.id if update.effective_user else None,
+        "referred": referral_code is not None
+    })
+    
     keyboard = [[
         InlineKeyboardButton(
             "🎮 Play Bingo Game",
-            web_app=WebAppInfo(url=WEBAPP_URL)
+            web_app=WebAppInfo(url=webapp_url(referral_code))
         )
     ]]
     await update.message.reply_text(
@@ -22,9 +47,19 @@ async def start(update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-def main():
+async def trace_update(update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before every other handler so their logs share the webhook's request ID
+    bind_update(update.update_id)
+
+def build_bot():
+    """Build the bot Application with all handlers registered"""
     app = Application.builder().token(TOKEN).build()
+    app.add_handler(TypeHandler(Update, trace_update), group=-1)
     app.add_handler(CommandHandler("start", start))
+    return app
+
+def main():
+    app = build_bot()
     app.run_polling()
 
 if __name__ == "__main__":
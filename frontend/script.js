@@ -20,6 +20,12 @@ function initTelegramWebApp() {
             localStorage.setItem('telegramUsername', user.username || user.first_name);
         }
     }
+
+    // Referral code from the bot's /start deep link
+    const referralCode = new URLSearchParams(window.location.search).get('ref');
+    if (referralCode) {
+        localStorage.setItem('referralCode', referralCode);
+    }
 }
 
 // Call on page load
@@ -27,6 +33,10 @@ document.addEventListener('DOMContentLoaded', initTelegramWebApp);
 
 const API_BASE_URL = 'https://bingo-bot-gwg6.onrender.com';
 const REFRESH_INTERVAL = 2000; // 2 seconds
+const ROOM_WAIT = 5; // seconds each ticket poll waits for the room to start
+
+// Asks the server for v2 cards: 25 numbers as base64 bytes plus a marked bitmask
+const CARD_FORMAT_V2 = 'application/vnd.bingo.v2+json';
 
 // Global State
 let gameState = {
@@ -42,7 +52,11 @@ let gameState = {
     calledNumbers: [],
     autoMark: false,
     gameStartTime: null,
-    refreshInterval: null
+    refreshInterval: null,
+    callSeq: 0,
+    gameVersion: 0,
+    serverGame: false,
+    syncing: false
 };
 
 // ============================================================
@@ -76,6 +90,12 @@ document.addEventListener('DOMContentLoaded', async () => {
         // Load user stats
         await loadUserStats();
 
+        // First visit from Telegram creates the account (with any referral)
+        await ensureRegistered();
+
+        // Warm the data cache so screen switches render from memory
+        prefetchScreenData();
+
     } catch (error) {
         console.error('Initialization error:', error);
         showError('Failed to initialize application');
@@ -98,6 +118,32 @@ function initializeDemoUser() {
     localStorage.setItem('userData', JSON.stringify(userData));
 }
 
+async function ensureRegistered() {
+    if (!currentTelegramId() || localStorage.getItem('registered')) {
+        return;
+    }
+    try {
+        await loadResource({ op: 'profile' });
+    } catch (error) {
+        if (error.status !== 404) {
+            console.error('Error checking registration:', error);
+            return;
+        }
+        const phone = prompt('Enter your phone number to finish registering');
+        if (!phone || !validatePhoneNumber(phone)) {
+            showError('Please enter a valid phone number to play');
+            return;
+        }
+        try {
+            await registerUser(phone, localStorage.getItem('telegramUsername'));
+        } catch (registerError) {
+            showError('Failed to register');
+            return;
+        }
+    }
+    localStorage.setItem('registered', '1');
+}
+
 function updateUserDisplay() {
     document.getElementById('usernameBadge').textContent = gameState.username;
     document.getElementById('balanceDisplay').textContent = gameState.balance.toFixed(2) + ' ETB';
@@ -209,6 +255,14 @@ function initializeGame() {
     gameState.gameStartTime = new Date();
     gameState.calledNumbers = [];
     gameState.cardData = [];
+    gameState.callSeq = 0;
+    gameState.gameVersion = 0;
+
+    // Inside Telegram the game is a real matchmaking room
+    if (currentTelegramId()) {
+        startServerGame();
+        return;
+    }
 
     // Generate bingo cards
     for (let i = 0; i < gameState.selectedCards; i++) {
@@ -237,6 +291,39 @@ function initializeGame() {
     updateLeaderboardDisplay();
 }
 
+async function startServerGame() {
+    gameState.serverGame = true;
+    document.getElementById('gameIdDisplay').textContent = '-';
+    document.getElementById('stakeDisplay').textContent = gameState.selectedStake + ' ETB';
+    document.getElementById('gameStatusDisplay').textContent = 'Waiting for players';
+    document.getElementById('cardsContainer').innerHTML = '';
+    updateCalledNumbersDisplay();
+
+    try {
+        const ticket = await joinRoom(gameState.selectedStake, gameState.selectedCards);
+        gameState.balance -= gameState.selectedStake * gameState.selectedCards;
+        updateUserDisplay();
+        invalidateResources('balance', 'transactions', 'stats');
+
+        gameState.gameId = ticket.game_id;
+        gameState.cardData = ticket.cards;
+        gameState.gameStartTime = new Date();
+        renderBingoCards();
+        checkForBingo();
+
+        document.getElementById('gameIdDisplay').textContent = gameState.gameId;
+        document.getElementById('gameStatusDisplay').textContent = 'Active';
+
+        startGameUpdates();
+        updateLeaderboardDisplay();
+
+    } catch (error) {
+        console.error('Error joining game:', error);
+        showError('Failed to join a game');
+        endGameSession();
+    }
+}
+
 function generateBingoCard(cardNumber) {
     const card = {
         number: cardNumber,
@@ -251,9 +338,29 @@ function generateBingoCard(cardNumber) {
     return card;
 }
 
+// Server cards in the v2 wire format -> the shape the game screen uses
+function decodeCard(card) {
+    if (card.card === undefined) {
+        return card;
+    }
+    const numbers = Array.from(atob(card.card), ch => ch.charCodeAt(0));
+    return {
+        id: card.id,
+        number: card.card_number,
+        numbers: numbers,
+        markedNumbers: decodeMarks(numbers, card.marked)
+    };
+}
+
+// Bit i of the mask is set when the number at grid position i is marked
+function decodeMarks(numbers, mask) {
+    return numbers.filter((_, i) => mask & (1 << i));
+}
+
 function renderBingoCards() {
     const container = document.getElementById('cardsContainer');
     container.innerHTML = '';
+    gameState.cardData = gameState.cardData.map(decodeCard);
 
     gameState.cardData.forEach((card, index) => {
         const cardEl = document.createElement('div');
@@ -291,6 +398,11 @@ function renderBingoCards() {
 
 function toggleNumberMark(cardIndex, number, cellElement) {
     const card = gameState.cardData[cardIndex];
+
+    if (gameState.serverGame) {
+        markServerNumber(card, number, cellElement);
+        return;
+    }
     
     if (card.markedNumbers.includes(number)) {
         // Unmark
@@ -306,9 +418,24 @@ function toggleNumberMark(cardIndex, number, cellElement) {
     checkForBingo();
 }
 
+// Server cards are marked by the server, and only with numbers already called
+function markServerNumber(card, number, cellElement) {
+    if (card.markedNumbers.includes(number) || !gameState.calledNumbers.includes(number)) {
+        return;
+    }
+    apiCallWithRetry(`/api/games/${gameState.gameId}/mark-number`, 'POST', { card_id: card.id, number: number })
+        .then(response => {
+            card.markedNumbers = response.marked_numbers;
+            if (cellElement) {
+                cellElement.classList.add('marked');
+            }
+        })
+        .catch(error => console.error('Error marking number:', error));
+}
+
 function checkForBingo() {
-    // Check if any card has all 75 numbers marked
-    const hasWinner = gameState.cardData.some(card => card.markedNumbers.length === 75);
+    // Check if any card has all 75 numbers marked; the server checks its own cards
+    const hasWinner = gameState.serverGame || gameState.cardData.some(card => card.markedNumbers.length === 75);
 
     if (hasWinner) {
         document.getElementById('bingoBtn').style.display = 'block';
@@ -322,8 +449,10 @@ function checkForBingo() {
 // ============================================================
 
 function startGameUpdates() {
-    // Simulate calling numbers
-    simulateCalledNumbers();
+    // Simulate calling numbers; server games sync them instead
+    if (!gameState.serverGame) {
+        simulateCalledNumbers();
+    }
 
     // Update called numbers display
     updateCalledNumbersDisplay();
@@ -334,11 +463,41 @@ function startGameUpdates() {
     }
 
     gameState.refreshInterval = setInterval(() => {
+        if (gameState.serverGame) {
+            syncServerGame();
+        }
         updateCalledNumbersDisplay();
         updateGameTimer();
     }, REFRESH_INTERVAL);
 }
 
+async function syncServerGame() {
+    if (gameState.syncing) {
+        return;
+    }
+    gameState.syncing = true;
+    try {
+        const calledBefore = gameState.calledNumbers.length;
+        const delta = await syncGameDelta(gameState.gameId);
+        if (!delta || !gameState.serverGame) {
+            return;
+        }
+        if (delta.cards.length > 0) {
+            renderBingoCards();
+        }
+        if (gameState.autoMark) {
+            gameState.calledNumbers.slice(calledBefore).forEach(autoMarkNumber);
+        }
+        if (delta.game_status !== 'playing') {
+            document.getElementById('gameStatusDisplay').textContent = 'Ended';
+            showError('This game has ended');
+            endGameSession();
+        }
+    } finally {
+        gameState.syncing = false;
+    }
+}
+
 function simulateCalledNumbers() {
     // Simulate calling random numbers
     if (gameState.calledNumbers.length < 75) {
@@ -360,12 +519,17 @@ function simulateCalledNumbers() {
 function autoMarkNumber(number) {
     gameState.cardData.forEach((card, cardIndex) => {
         if (card.numbers.includes(number) && !card.markedNumbers.includes(number)) {
-            card.markedNumbers.push(number);
-
-            // Update UI
             const cell = document.querySelector(
                 `[data-cardIndex="${cardIndex}"][data-number="${number}"]`
             );
+            if (gameState.serverGame) {
+                markServerNumber(card, number, cell);
+                return;
+            }
+
+            card.markedNumbers.push(number);
+
+            // Update UI
             if (cell) {
                 cell.classList.add('marked');
             }
@@ -402,7 +566,9 @@ function updateGameTimer() {
     }
 
     // Continue simulating calls
-    simulateCalledNumbers();
+    if (!gameState.serverGame) {
+        simulateCalledNumbers();
+    }
 }
 
 function toggleAutoMark() {
@@ -416,6 +582,11 @@ function toggleAutoMark() {
 // ============================================================
 
 function claimBingo() {
+    if (gameState.serverGame) {
+        claimServerBingo();
+        return;
+    }
+
     // Calculate winnings
     const winnings = gameState.selectedStake * 10; // 10x multiplier for demo
     gameState.balance += winnings;
@@ -441,6 +612,36 @@ function claimBingo() {
     endGameSession();
 }
 
+async function claimServerBingo() {
+    try {
+        for (const card of gameState.cardData) {
+            const result = await apiCallWithRetry(`/api/games/${gameState.gameId}/check-bingo`, 'POST', {
+                card_id: card.id
+            });
+            if (!result.is_bingo) {
+                continue;
+            }
+
+            invalidateResources('balance', 'transactions', 'stats', 'profile', 'leaderboard');
+            if (!result.winnings) {
+                showError(result.message);
+                endGameSession();
+                return;
+            }
+            gameState.balance += result.winnings;
+            updateUserDisplay();
+            showWinModal(result.winnings);
+            endGameSession();
+            return;
+        }
+        showError('Not a bingo yet');
+
+    } catch (error) {
+        console.error('Error claiming bingo:', error);
+        showError('Failed to claim bingo');
+    }
+}
+
 function showWinModal(amount) {
     document.getElementById('winAmount').textContent = '+' + amount.toFixed(2) + ' ETB';
     document.getElementById('winModal').style.display = 'flex';
@@ -468,6 +669,9 @@ function endGameSession() {
     gameState.cardData = [];
     gameState.calledNumbers = [];
     gameState.autoMark = false;
+    gameState.serverGame = false;
+    gameState.callSeq = 0;
+    gameState.gameVersion = 0;
 
     // Return to game selection
     goToGameSelection();
@@ -506,12 +710,69 @@ async function loadProfileData() {
             : 0;
         document.getElementById('profileWinRate').textContent = winRate + '%';
 
+        // Replace with server data when running inside Telegram
+        if (currentTelegramId()) {
+            withResources([{ op: 'profile' }, { op: 'stats' }], ([profile, serverStats]) => {
+                const user = profile.user;
+                document.getElementById('profileUsername').textContent = user.username || user.name;
+                document.getElementById('profilePhone').textContent = user.phone || 'Not provided';
+                document.getElementById('profileMemberSince').textContent = new Date(user.created_at).toLocaleDateString();
+                document.getElementById('profileBalance').textContent = user.balance.toFixed(2) + ' ETB';
+                document.getElementById('profileGamesPlayed').textContent = serverStats.stats.games_played;
+                document.getElementById('profileTotalWins').textContent = serverStats.stats.games_won;
+                document.getElementById('profileWinRate').textContent = Math.round(serverStats.stats.win_rate) + '%';
+            });
+            loadGameHistory();
+        }
+
     } catch (error) {
         console.error('Error loading profile data:', error);
         showError('Failed to load profile data');
     }
 }
 
+let gameHistoryCursor = null;
+
+async function loadGameHistory(more = false) {
+    const page = await getGameHistory(more ? gameHistoryCursor : null);
+    gameHistoryCursor = page.next_cursor;
+    document.getElementById('moreGamesBtn').style.display = gameHistoryCursor ? 'block' : 'none';
+    renderGameHistory(page.games, more);
+}
+
+function renderGameHistory(games, append = false) {
+    const container = document.getElementById('gameHistoryList');
+
+    if (games.length === 0) {
+        if (!append) {
+            container.innerHTML = '<p class="empty-message">No games yet</p>';
+        }
+        return;
+    }
+
+    const html = games.map(game => `
+        <div class="transaction-item">
+            <div class="transaction-info">
+                <div class="transaction-type">
+                    ${game.won ? '🏆' : '🎮'} Game #${game.id}
+                </div>
+                <div class="transaction-date">
+                    ${new Date(game.created_at).toLocaleString()} • ${game.status}
+                </div>
+            </div>
+            <div class="transaction-amount ${game.won ? 'deposit' : 'withdraw'}">
+                ${(game.stake_amount || 0).toFixed(2)} ETB
+            </div>
+        </div>
+    `).join('');
+
+    if (append) {
+        container.insertAdjacentHTML('beforeend', html);
+    } else {
+        container.innerHTML = html;
+    }
+}
+
 async function updateProfileData(profileInfo) {
     try {
         // Save to localStorage
@@ -537,8 +798,22 @@ async function loadWalletData() {
         document.getElementById('walletBalance').textContent = gameState.balance.toFixed(2) + ' ETB';
         document.getElementById('walletBonus').textContent = gameState.bonus.toFixed(2) + ' ETB';
 
-        // Load transaction history
-        loadTransactionHistory();
+        if (!currentTelegramId()) {
+            // Load transaction history
+            loadTransactionHistory();
+            return;
+        }
+
+        withResources([{ op: 'balance' }, { op: 'transactions', limit: 20 }], ([wallet, history]) => {
+            gameState.balance = wallet.balance;
+            gameState.bonus = wallet.bonus_balance;
+            updateUserDisplay();
+            document.getElementById('walletBalance').textContent = wallet.balance.toFixed(2) + ' ETB';
+            document.getElementById('walletBonus').textContent = wallet.bonus_balance.toFixed(2) + ' ETB';
+            renderTransactionList(history.transactions.map(txn => ({ ...txn, timestamp: txn.created_at })));
+            transactionCursor = history.next_cursor;
+            document.getElementById('moreTransactionsBtn').style.display = transactionCursor ? 'block' : 'none';
+        });
 
     } catch (error) {
         console.error('Error loading wallet data:', error);
@@ -546,6 +821,16 @@ async function loadWalletData() {
     }
 }
 
+let transactionCursor = null;
+
+// The first page comes from the batched wallet read; later pages page on from it
+async function loadMoreTransactions() {
+    const page = await getTransactionHistory(transactionCursor, { limit: 20 });
+    transactionCursor = page.next_cursor;
+    document.getElementById('moreTransactionsBtn').style.display = transactionCursor ? 'block' : 'none';
+    renderTransactionList(page.transactions.map(txn => ({ ...txn, timestamp: txn.created_at })), true);
+}
+
 function showDepositForm() {
     document.getElementById('formTitle').textContent = '💸 Deposit Funds';
     document.getElementById('transactionType').value = 'deposit';
@@ -627,6 +912,7 @@ async function processTransaction(event) {
 
         updateUserDisplay();
         hideTransactionForm();
+        invalidateResources('balance', 'transactions', 'profile');
         loadWalletData();
 
         showSuccess(`${type.charAt(0).toUpperCase() + type.slice(1)} of ${amount.toFixed(2)} ETB processed successfully!`);
@@ -659,15 +945,24 @@ async function saveTransaction(transaction) {
 
 function loadTransactionHistory() {
     try {
-        const transactions = JSON.parse(localStorage.getItem('transactions')) || [];
+        renderTransactionList(JSON.parse(localStorage.getItem('transactions')) || []);
+    } catch (error) {
+        console.error('Error loading transaction history:', error);
+    }
+}
+
+function renderTransactionList(transactions, append = false) {
+    try {
         const container = document.getElementById('transactionsList');
 
         if (transactions.length === 0) {
-            container.innerHTML = '<p class="empty-message">No transactions yet</p>';
+            if (!append) {
+                container.innerHTML = '<p class="empty-message">No transactions yet</p>';
+            }
             return;
         }
 
-        container.innerHTML = transactions.map(txn => `
+        const html = transactions.map(txn => `
             <div class="transaction-item">
                 <div class="transaction-info">
                     <div class="transaction-type">
@@ -683,8 +978,14 @@ function loadTransactionHistory() {
             </div>
         `).join('');
 
+        if (append) {
+            container.insertAdjacentHTML('beforeend', html);
+        } else {
+            container.innerHTML = html;
+        }
+
     } catch (error) {
-        console.error('Error loading transaction history:', error);
+        console.error('Error rendering transaction history:', error);
     }
 }
 
@@ -703,6 +1004,18 @@ function getTransactionIcon(type) {
 
 async function loadLeaderboardData() {
     try {
+        if (currentTelegramId()) {
+            withResources([{ op: 'leaderboard' }], ([result]) => {
+                displayLeaderboard(result.leaderboard.map(player => ({
+                    rank: player.rank,
+                    name: player.username,
+                    wins: player.games_won,
+                    balance: player.balance
+                })));
+            });
+            return;
+        }
+
         // For demo, generate sample leaderboard data
         const leaderboardData = generateSampleLeaderboard();
         displayLeaderboard(leaderboardData);
@@ -844,16 +1157,22 @@ function showSuccess(message) {
 // API INTEGRATION (Ready for backend)
 // ============================================================
 
-async function apiCall(endpoint, method = 'GET', data = null) {
+async function apiCall(endpoint, method = 'GET', data = null, idempotencyKey = null) {
     try {
         const options = {
             method: method,
             headers: {
+                'Accept': `${CARD_FORMAT_V2}, application/json`,
                 'Content-Type': 'application/json',
-                'Authorization': `Bearer ${localStorage.getItem('authToken') || ''}`
+                'X-Telegram-Init-Data': tg ? tg.initData : ''
             }
         };
 
+        // Retries of a write reuse its key, so the server runs it only once
+        if (idempotencyKey) {
+            options.headers['Idempotency-Key'] = idempotencyKey;
+        }
+
         if (data && (method === 'POST' || method === 'PUT')) {
             options.body = JSON.stringify(data);
         }
@@ -861,7 +1180,10 @@ async function apiCall(endpoint, method = 'GET', data = null) {
         const response = await fetch(`${API_BASE_URL}${endpoint}`, options);
 
         if (!response.ok) {
-            throw new Error(`API Error: ${response.status} ${response.statusText}`);
+            const error = new Error(`API Error: ${response.status} ${response.statusText}`);
+            error.status = response.status;
+            error.retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 0;
+            throw error;
         }
 
         return await response.json();
@@ -872,6 +1194,176 @@ async function apiCall(endpoint, method = 'GET', data = null) {
     }
 }
 
+// ------------------------------------------------------------
+// Client data layer: reads are deduplicated while in flight,
+// cached with stale-while-revalidate, collected into one
+// /api/batch request, and retried with exponential backoff.
+// ------------------------------------------------------------
+
+// How long each resource is served without revalidating (ms)
+const CACHE_TTL = {
+    profile: 60000,
+    stats: 30000,
+    balance: 10000,
+    transactions: 15000,
+    referrals: 300000,
+    leaderboard: 15000
+};
+const DEFAULT_CACHE_TTL = 10000;
+const BATCH_DELAY = 10; // ms to collect reads before sending a batch
+const BATCH_MAX_OPS = 10; // server-side limit per /api/batch call
+const RETRY_LIMIT = 3;
+const RETRY_BASE_DELAY = 500; // ms, doubled on every attempt
+
+const dataCache = new Map(); // key -> { value, fetchedAt }
+const inFlight = new Map(); // key -> Promise
+let batchQueue = [];
+let batchTimer = null;
+
+function currentTelegramId() {
+    return localStorage.getItem('telegramUserId');
+}
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+function isRetryable(error) {
+    // Network failures have no status; 429, 5xx and 409 (the first attempt
+    // with this Idempotency-Key is still running) are worth another try
+    return !error.status || error.status === 409 || error.status === 429 || error.status >= 500;
+}
+
+async function apiCallWithRetry(endpoint, method = 'GET', data = null) {
+    // One key for every attempt of a write; the batch endpoint only reads
+    const idempotencyKey = method === 'GET' || endpoint === '/api/batch' ? null : generateUUID();
+    for (let attempt = 0; ; attempt++) {
+        try {
+            return await apiCall(endpoint, method, data, idempotencyKey);
+        } catch (error) {
+            if (attempt >= RETRY_LIMIT || !isRetryable(error)) {
+                throw error;
+            }
+            const backoff = RETRY_BASE_DELAY * 2 ** attempt;
+            await sleep(Math.max(error.retryAfter * 1000, backoff / 2 + Math.random() * backoff / 2));
+        }
+    }
+}
+
+function resourceKey(op) {
+    return JSON.stringify(op);
+}
+
+// Resolve with the cached value if there is one, revalidating it in the
+// background once older than its TTL; onUpdate gets the fresh value.
+function loadResource(op, onUpdate = null) {
+    const key = resourceKey(op);
+    const cached = dataCache.get(key);
+
+    if (!cached) {
+        return fetchResource(op, key);
+    }
+    if (Date.now() - cached.fetchedAt > (CACHE_TTL[op.op] || DEFAULT_CACHE_TTL)) {
+        fetchResource(op, key)
+            .then(value => onUpdate && onUpdate(value))
+            .catch(error => console.error('Revalidation failed:', error));
+    }
+    return Promise.resolve(cached.value);
+}
+
+function fetchResource(op, key) {
+    if (inFlight.has(key)) {
+        return inFlight.get(key);
+    }
+
+    const promise = new Promise((resolve, reject) => {
+        batchQueue.push({ op, resolve, reject });
+        if (!batchTimer) {
+            batchTimer = setTimeout(flushBatch, BATCH_DELAY);
+        }
+    })
+        .then(value => {
+            dataCache.set(key, { value, fetchedAt: Date.now() });
+            return value;
+        })
+        .finally(() => inFlight.delete(key));
+
+    inFlight.set(key, promise);
+    return promise;
+}
+
+async function flushBatch() {
+    const queue = batchQueue;
+    batchQueue = [];
+    batchTimer = null;
+
+    for (let start = 0; start < queue.length; start += BATCH_MAX_OPS) {
+        const chunk = queue.slice(start, start + BATCH_MAX_OPS);
+        try {
+            const response = await apiCallWithRetry('/api/batch', 'POST', {
+                telegram_id: currentTelegramId(),
+                ops: chunk.map(entry => entry.op)
+            });
+            response.results.forEach((result, i) => {
+                if (result.status === 'success') {
+                    chunk[i].resolve(result);
+                } else {
+                    chunk[i].reject(new Error(result.message));
+                }
+            });
+        } catch (error) {
+            chunk.forEach(entry => entry.reject(error));
+        }
+    }
+}
+
+// Render from the cache (or one batched fetch), and again on revalidation
+function withResources(ops, render) {
+    const refresh = () => Promise.all(ops.map(op => loadResource(op))).then(render);
+    return Promise.all(ops.map(op => loadResource(op, refresh)))
+        .then(render)
+        .catch(error => console.error('Error loading resources:', error));
+}
+
+function invalidateResources(...names) {
+    for (const key of dataCache.keys()) {
+        if (names.includes(JSON.parse(key).op)) {
+            dataCache.delete(key);
+        }
+    }
+}
+
+function prefetchScreenData() {
+    if (!currentTelegramId()) {
+        return;
+    }
+    [
+        { op: 'profile' },
+        { op: 'stats' },
+        { op: 'balance' },
+        { op: 'transactions', limit: 20 },
+        { op: 'leaderboard' }
+    ].forEach(op => loadResource(op).catch(error => console.error('Prefetch failed:', error)));
+}
+
+async function registerUser(phone, name) {
+    try {
+        const response = await apiCall('/api/users/register', 'POST', {
+            telegram_id: localStorage.getItem('telegramUserId'),
+            username: localStorage.getItem('telegramUsername'),
+            phone: phone,
+            name: name,
+            referral_code: localStorage.getItem('referralCode')
+        });
+        localStorage.removeItem('referralCode');
+        return response;
+
+    } catch (error) {
+        console.error('Error registering user:', error);
+        throw error;
+    }
+}
+
 async function createGame(stake, cardCount) {
     try {
         const gameData = {
@@ -882,7 +1374,7 @@ async function createGame(stake, cardCount) {
             createdAt: new Date().toISOString()
         };
 
-        const response = await apiCall('/games', 'POST', gameData);
+        const response = await apiCallWithRetry('/games', 'POST', gameData);
         return response;
 
     } catch (error) {
@@ -891,6 +1383,50 @@ async function createGame(stake, cardCount) {
     }
 }
 
+// Buy cards in the open room of a stake tier and wait until the room starts
+async function joinRoom(stake, cardCount) {
+    let ticket = await apiCallWithRetry(`/api/matchmaking/${stake}/join`, 'POST', {
+        telegram_id: currentTelegramId(),
+        num_cards: cardCount
+    });
+    const ticketUrl = `/api/matchmaking/${stake}/rooms/${ticket.room_id}/tickets/${ticket.ticket}`;
+
+    while (!ticket.started && !ticket.error) {
+        ticket = await apiCallWithRetry(`${ticketUrl}?wait=${ROOM_WAIT}`);
+    }
+    if (ticket.error) {
+        throw new Error(ticket.error);
+    }
+    return ticket;
+}
+
+async function syncGameDelta(gameId) {
+    try {
+        const response = await apiCall(
+            `/api/games/${gameId}/delta?since=${gameState.callSeq || 0}&version=${gameState.gameVersion || 0}`
+        );
+
+        response.numbers.forEach(number => {
+            if (!gameState.calledNumbers.includes(number)) {
+                gameState.calledNumbers.push(number);
+            }
+        });
+        response.cards.forEach(update => {
+            const card = gameState.cardData.find(c => c.id === update.id);
+            if (card) {
+                card.markedNumbers = decodeMarks(card.numbers, update.marked);
+            }
+        });
+        gameState.callSeq = response.seq;
+        gameState.gameVersion = response.version;
+        return response;
+
+    } catch (error) {
+        console.error('Error syncing game:', error);
+        return null;
+    }
+}
+
 async function updateGameStatus(gameId, status) {
     try {
         const response = await apiCall(`/games/${gameId}`, 'PUT', { status: status });
@@ -916,14 +1452,33 @@ async function submitBingo(gameId, winnings) {
     }
 }
 
-async function getGameHistory() {
+async function getGameHistory(cursor = null) {
     try {
-        const response = await apiCall(`/users/${gameState.userId}/games`);
+        const telegramId = localStorage.getItem('telegramUserId') || gameState.userId;
+        const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+        const response = await apiCall(`/api/games/history/${telegramId}${query}`);
         return response;
 
     } catch (error) {
         console.error('Error fetching game history:', error);
-        return [];
+        return { games: [], next_cursor: null };
+    }
+}
+
+async function getTransactionHistory(cursor = null, filters = {}) {
+    try {
+        const telegramId = localStorage.getItem('telegramUserId') || gameState.userId;
+        const params = new URLSearchParams(filters);
+        if (cursor) {
+            params.set('cursor', cursor);
+        }
+
+        const response = await apiCall(`/api/wallet/transactions/${telegramId}?${params}`);
+        return response;
+
+    } catch (error) {
+        console.error('Error fetching transaction history:', error);
+        return { transactions: [], next_cursor: null };
     }
 }
 
@@ -940,7 +1495,7 @@ async function getTopPlayers(limit = 20) {
 
 async function processDeposit(amount, method, description) {
     try {
-        const response = await apiCall('/transactions/deposit', 'POST', {
+        const response = await apiCallWithRetry('/transactions/deposit', 'POST', {
             userId: gameState.userId,
             amount: amount,
             method: method,
@@ -957,7 +1512,7 @@ async function processDeposit(amount, method, description) {
 
 async function processWithdraw(amount, method, accountDetails) {
     try {
-        const response = await apiCall('/transactions/withdraw', 'POST', {
+        const response = await apiCallWithRetry('/transactions/withdraw', 'POST', {
             userId: gameState.userId,
             amount: amount,
             method: method,
@@ -1249,6 +1804,9 @@ if (typeof module !== 'undefined' && module.exports) {
         loadWalletData,
         loadLeaderboardData,
         apiCall,
+        loadResource,
+        invalidateResources,
+        decodeCard,
         showError,
         showSuccess
     };